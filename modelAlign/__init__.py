@@ -1,3 +1,9 @@
 from .align import coarse_to_fine_align, coarse_aligner_3D, fine_aligner_3D
+from .align import SearchStopped, aligned_orientations, shift_cache
+from .align import ShiftCache
 from .data_preprocessing import load_poses, load_rtk_data
-from .app import alignment, to_geoJson
+from .app import alignment, to_geoJson, multi_session_alignment
+from .app import archive_alignment
+from .results_store import ResultsStore
+from .spatial_index import SessionIndex
+from .transform import AlignmentTransform
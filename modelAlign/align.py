@@ -11,12 +11,44 @@ import os
 import sys
 import math
 import json
+import time
+import hashlib
+import threading
 
 #NOTICE: pdb only for testing,delete it when you finish the code
 import pdb
 
+from collections import OrderedDict
 from types import SimpleNamespace
+from scipy.spatial.transform import Rotation
 from geoToolbox import wgs84_to_cartesian, cartesian_to_wgs84
+from .data_preprocessing import DIFF_STATUSES, DIFF_STATUS_VARIANCES
+from .parallel import map_shared
+
+ALIGNER_MODES = ('3d', 'yaw')
+RESIDUAL_PERCENTILES = (50, 90, 95, 99)
+
+# Rotates the y-up AR frame into the z-up RTK frame
+Y_UP_TO_Z_UP = np.array([[1, 0, 0], [0, 0, -1], [0, -1, 0]])
+# Columns used by the association, shared with worker processes
+POSE_TRACK_KEYS = ('timeStamp', 'x', 'y', 'z')
+RTK_TRACK_KEYS = ('timeStamp', 'x', 'y', 'z', 'variance', 'verticalAccuracy',
+                  'horizontalAccuracy')
+# Time shifts associated at once, and evaluated between two checks of the
+# search budget
+SEARCH_BLOCK = 8
+# A time shift is feasible when it pairs at least MIN_PAIRS RTK data points
+# and MIN_OVERLAP of the largest overlap any time shift can reach
+MIN_PAIRS = 3
+MIN_OVERLAP = 0.5
+# The cost curve has bottomed out once EARLY_STOP_PATIENCE shifts on each side
+# of the minimum rise monotonically to more than EARLY_STOP_RISE above it
+EARLY_STOP_PATIENCE = 3
+EARLY_STOP_RISE = 0.1
+# Evaluated time shifts kept by the shift cache, and the resolution in seconds
+# shifts are quantized to, so that coarse and fine grid points coincide
+SHIFT_CACHE_SIZE = 4096
+SHIFT_QUANTUM = 1e-6
 
 
 def data_association(pose_data, rtk_data, time_shift):
@@ -58,8 +90,7 @@ def data_association(pose_data, rtk_data, time_shift):
                                                            prev_timestamp)
                 mid_pose = percent * (curr_pose - prev_pose) + prev_pose
 
-                rotation_matrix = np.array([[1, 0, 0], [0, 0, -1], [0, -1, 0]])
-                mid_pose = np.dot(rotation_matrix, mid_pose)
+                mid_pose = np.dot(Y_UP_TO_Z_UP, mid_pose)
                 variances.append(
                     np.array([
                         rtk_datum['variance'], rtk_datum['verticalAccuracy'],
@@ -76,110 +107,1042 @@ def data_association(pose_data, rtk_data, time_shift):
     return pose_shifted, rtk_data_shifted, variances
 
 
-def aligner_SVD_2D(poses, rtk_datas):
+def residual_diagnostics(residuals, variances=None):
     """
-    Aligns 2D poses with corresponding RTK data using Singular Value Decomposition (SVD).
+    Summarizes the per-pair residuals of an alignment.
 
     Args:
-        poses (list): List of 2D poses, where each pose is a list or array-like object with at least 2 elements.
-        rtk_datas (list): List of RTK data points, where each data point is a list or array-like object with at least 2 elements.
+        residuals (numpy.ndarray): (N, D) residual vectors, rtk - (R @ pose + t).
+        variances (array-like, optional): (N, 3) variances from `data_association`,
+            used to break the errors down by RTK fix status.
 
     Returns:
-        tuple: A tuple containing the rotation matrix (R), translation vector (t), and the alignment error.
+        SimpleNamespace: residuals, per-pair errors (norms), count, mean_error,
+        rmse, median_error, percentiles (dict), max_error and by_status, a dict
+        of count, mean_error and rmse per fix status.
+    """
+    residuals = np.asarray(residuals, dtype=float)
+    errors = np.linalg.norm(residuals, axis=1)
+    diagnostics = SimpleNamespace(
+        residuals=residuals,
+        errors=errors,
+        count=len(errors),
+        mean_error=float(np.mean(errors)),
+        rmse=float(np.sqrt(np.mean(errors**2))),
+        median_error=float(np.median(errors)),
+        percentiles={
+            p: float(value)
+            for p, value in zip(RESIDUAL_PERCENTILES,
+                                np.percentile(errors, RESIDUAL_PERCENTILES))
+        },
+        max_error=float(np.max(errors)),
+        by_status={})
+    if variances is not None and len(errors):
+        variance = np.asarray(variances, dtype=float).reshape(len(errors),
+                                                              -1)[:, 0]
+        status_names = list(DIFF_STATUSES) + ['unknown']
+        for value in np.unique(variance):
+            selected = errors[variance == value]
+            known = np.flatnonzero(DIFF_STATUS_VARIANCES == value)
+            name = status_names[known[0]] if len(known) else str(value)
+            diagnostics.by_status[name] = SimpleNamespace(
+                count=len(selected),
+                mean_error=float(np.mean(selected)),
+                rmse=float(np.sqrt(np.mean(selected**2))))
+    return diagnostics
 
-    Raises:
-        None
 
+def _aligner_SVD(poses, rtk_datas, dim):
+    """
+    Closed-form rigid alignment of (N, dim) poses with (N, dim) RTK data.
+
+    Returns:
+        tuple: A tuple containing the rotation matrix (R), translation vector (t)
+        and the (N, dim) residuals.
     """
     N = len(poses)
-    #TODO: only get the pose first two elements,
-    # and the first two elements of rkt
-    temp_poses = np.array([[pose[0], pose[1]] for pose in poses])
-    poses = temp_poses
-    rtk_datas = np.array([[rtk_data[0], rtk_data[1]]
-                          for rtk_data in rtk_datas])
-    if N != len(rtk_datas) or N < 2:
-        print("Wrong input data!")
-        return None, None, None
-    poses = np.array(poses)
-    rtk_datas = np.array(rtk_datas)
     # Calculate mean
     poses_mean = np.mean(poses, axis=0)
     rtk_data_mean = np.mean(rtk_datas, axis=0)
     # Calculate Sigma
-    Sigma = np.zeros((2, 2))
-    for i in range(N):
-        rtk_diff = (rtk_datas[i] - rtk_data_mean).reshape(2, 1)
-        ar_diff = (poses[i] - poses_mean).reshape(1, 2)
-        Sigma += (rtk_diff @ ar_diff) / N
+    Sigma = (rtk_datas - rtk_data_mean).T @ (poses - poses_mean) / N
     # Perform SVD
-    U, S, Vt = np.linalg.svd(Sigma, full_matrices=True)
-    W = np.identity(2)
+    U, _, Vt = np.linalg.svd(Sigma, full_matrices=True)
+    W = np.identity(dim)
     if np.linalg.det(U) * np.linalg.det(Vt) < 0:
-        W[1, 1] = -1
+        W[dim - 1, dim - 1] = -1  # NOTICE: W:error here
     # Calculate rotation (R) and translation (t)
     R = U @ W @ Vt
     scale = 1.0
     t = rtk_data_mean - scale * (R @ poses_mean)
-    # Calculate error
-    error = 0
-    for i in range(N):
-        error += np.linalg.norm(rtk_datas[i] - (scale * R @ poses[i] + t)) / N
+    # Calculate all residuals at once
+    residuals = rtk_datas - (scale * poses @ R.T + t)
+    return R, t, residuals
+
+
+def aligner_SVD_2D(poses, rtk_datas, variances=None, return_diagnostics=False):
+    """
+    Aligns 2D poses with corresponding RTK data using Singular Value Decomposition (SVD).
+
+    Args:
+        poses (list): List of 2D poses, where each pose is a list or array-like object with at least 2 elements.
+        rtk_datas (list): List of RTK data points, where each data point is a list or array-like object with at least 2 elements.
+        variances (list, optional): Variances from `data_association`, used by the diagnostics.
+        return_diagnostics (bool, optional): Also return the residual diagnostics,
+            see `residual_diagnostics`. Defaults to False.
+
+    Returns:
+        tuple: A tuple containing the rotation matrix (R), translation vector (t), and the alignment error,
+        followed by the diagnostics if requested.
+
+    Raises:
+        None
 
+    """
+    N = len(poses)
+    if N != len(rtk_datas) or N < 2:
+        print("Wrong input data!")
+        return (None, None, None) + ((None, ) if return_diagnostics else ())
+    # Only use the first two elements of the poses and of the rtk data
+    poses = np.asarray(poses, dtype=float).reshape(N, -1)[:, :2]
+    rtk_datas = np.asarray(rtk_datas, dtype=float).reshape(N, -1)[:, :2]
+    R, t, residuals = _aligner_SVD(poses, rtk_datas, 2)
+    # Calculate error
+    error = np.mean(np.linalg.norm(residuals, axis=1))
+    if return_diagnostics:
+        return R, t, error, residual_diagnostics(residuals, variances)
     return R, t, error
 
 
-def aligner_SVD_3D(poses, rtk_datas):
+def aligner_SVD_3D(poses, rtk_datas, variances=None, return_diagnostics=False):
     """
     Aligns 3D poses with corresponding RTK data using Singular Value Decomposition (SVD).
 
     Args:
         poses (list): List of 3D poses.
         rtk_datas (list): List of corresponding RTK data.
+        variances (list, optional): Variances from `data_association`, used by the diagnostics.
+        return_diagnostics (bool, optional): Also return the residual diagnostics,
+            see `residual_diagnostics`. Defaults to False.
 
     Returns:
-        tuple: A tuple containing the rotation matrix (R), translation vector (t), and error value.
+        tuple: A tuple containing the rotation matrix (R), translation vector (t), and error value,
+        followed by the diagnostics if requested.
     """
     N = len(poses)
     if N != len(rtk_datas) or N < 2:
         print("Wrong input data!")
-        return None, None, None
+        return (None, None, None) + ((None, ) if return_diagnostics else ())
 
-    poses = np.array(poses)
-    rtk_datas = np.array(rtk_datas)
+    poses = np.asarray(poses, dtype=float).reshape(N, 3)
+    rtk_datas = np.asarray(rtk_datas, dtype=float).reshape(N, 3)
+    R, t, residuals = _aligner_SVD(poses, rtk_datas, 3)
+    # Calculate error
+    error = np.mean(np.linalg.norm(residuals, axis=1))
+    if return_diagnostics:
+        return R, t, error, residual_diagnostics(residuals, variances)
+    return R, t, error
 
-    # Calculate mean
-    poses_mean = np.mean(poses, axis=0)
-    rtk_data_mean = np.mean(rtk_datas, axis=0)
-    # Calculate Sigma
-    Sigma = np.zeros((3, 3))
-    for i in range(N):
-        ar_diff = (poses[i] - poses_mean).reshape(1, 3)
-        rtk_diff = (rtk_datas[i] - rtk_data_mean).reshape(3, 1)
-        Sigma += (rtk_diff @ ar_diff) / N
 
-    # Perform SVD
-    U, _, Vt = np.linalg.svd(Sigma, full_matrices=True)
-    W = np.identity(3)
-    if np.linalg.det(U) * np.linalg.det(Vt) < 0:
-        W[2, 2] = -1  # NOTICE: W:error here
+def _track_array(data, keys):
+    """
+    Stacks the given keys of the pose or RTK data into an (N, len(keys)) array.
 
-    # Calculate rotation (R) and translation (t)
-    R = U @ W @ Vt
-    scale = 1.0
-    t = rtk_data_mean - scale * (R @ poses_mean)
+    Args:
+        data (list or dict): List of dictionaries (one per datum), or a dictionary
+            of equally long arrays (one per key).
+        keys (list): Keys to stack, in column order.
+
+    Returns:
+        numpy.ndarray: Array of shape (N, len(keys)).
+    """
+    if isinstance(data, dict):
+        return np.column_stack(
+            [np.asarray(data[key], dtype=float) for key in keys])
+    return np.array([[datum[key] for key in keys] for datum in data],
+                    dtype=float).reshape(-1, len(keys))
+
+
+def _as_track(data, keys):
+    """
+    Returns the given keys of the pose or RTK data as a track, a dictionary of
+    float arrays.
+    """
+    columns = _track_array(data, keys)
+    return {key: columns[:, k].copy() for k, key in enumerate(keys)}
 
+
+def slerp(q0, q1, fraction):
+    """
+    Spherical linear interpolation of unit quaternions, batched over any
+    leading dimensions.
+
+    Args:
+        q0 (numpy.ndarray): (..., 4) quaternions at fraction 0.
+        q1 (numpy.ndarray): (..., 4) quaternions at fraction 1.
+        fraction (numpy.ndarray): (...) interpolation fractions.
+
+    Returns:
+        numpy.ndarray: (..., 4) unit quaternions along the shorter arc.
+    """
+    fraction = np.asarray(fraction, dtype=float)[..., None]
+    dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+    # q and -q are the same rotation, take the shorter arc
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.clip(np.abs(dot), 0.0, 1.0)
+    angle = np.arccos(dot)
+    sin_angle = np.sin(angle)
+    # Nearly equal quaternions fall back to the normalized linear interpolation
+    close = sin_angle < 1e-6
+    safe_sin = np.where(close, 1.0, sin_angle)
+    w0 = np.where(close, 1.0 - fraction,
+                  np.sin((1.0 - fraction) * angle) / safe_sin)
+    w1 = np.where(close, fraction, np.sin(fraction * angle) / safe_sin)
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def associate_shifts(pose_data, rtk_data, time_shifts, orientations=False):
+    """
+    Performs data association between pose data and RTK data for several time
+    shifts at once. For every shift the pairs are exactly those produced by
+    `data_association`, but all shifts are interpolated in one vectorized pass.
+
+    Args:
+        pose_data (list or dict): Pose data sorted by timeStamp.
+        rtk_data (list or dict): RTK data sorted by timeStamp.
+        time_shifts (array-like): S time shift values.
+        orientations (bool, optional): Also interpolate the camera
+            orientations with `slerp`. The pose data must be a track with an
+            (N, 4) quaternion column, see `load_pose_track`.
+
+    Returns:
+        tuple: A tuple containing:
+            - poses: (S, M, 3) array of interpolated z-up poses for each of
+              the M RTK data points, NaN where no pose brackets the stamp.
+            - rtk_datas: (M, 3) array of RTK positions.
+            - mask: (S, M) boolean array, True where a pair was associated.
+            - variances: (M, 3) array of variances of each RTK data point.
+            - quaternions: (S, M, 4) array of interpolated camera orientations
+              in the pose frame, NaN where not associated. Only returned with
+              orientations, see `world_orientations`.
+    """
+    time_shifts = np.atleast_1d(np.asarray(time_shifts, dtype=float))
+    pose_times = _track_array(pose_data, ['timeStamp'])[:, 0]
+    pose_xyz = _track_array(pose_data, ['x', 'y', 'z'])
+    rtk_times = _track_array(rtk_data, ['timeStamp'])[:, 0]
+    rtk_datas = _track_array(rtk_data, ['x', 'y', 'z'])
+    variances = _track_array(
+        rtk_data, ['variance', 'verticalAccuracy', 'horizontalAccuracy'])
+    if orientations:
+        if not isinstance(pose_data, dict) or 'quaternion' not in pose_data:
+            raise ValueError('Interpolating orientations needs a pose track '
+                             'with a quaternion column')
+        pose_quaternions = np.asarray(pose_data['quaternion'], dtype=float)
+
+    time_stamps = rtk_times[None, :] - time_shifts[:, None]
+    # j is the last pose with pose_times[j] <= time_stamp, the pair is valid
+    # only if the next pose is strictly later, as in data_association
+    j = np.searchsorted(pose_times, time_stamps, side='right') - 1
+    mask = (j >= 0) & (j < len(pose_times) - 1)
+    j = np.clip(j, 0, max(len(pose_times) - 2, 0))
+    if len(pose_times) < 2:
+        mask[:] = False
+        poses = np.full(time_stamps.shape + (3, ), np.nan)
+        if orientations:
+            return (poses, rtk_datas, mask, variances,
+                    np.full(time_stamps.shape + (4, ), np.nan))
+        return poses, rtk_datas, mask, variances
+    prev_timestamp = pose_times[j]
+    curr_timestamp = pose_times[j + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent = (time_stamps - prev_timestamp) / (curr_timestamp -
+                                                    prev_timestamp)
+    prev_pose = pose_xyz[j]
+    curr_pose = pose_xyz[j + 1]
+    mid_pose = percent[..., None] * (curr_pose - prev_pose) + prev_pose
+    poses = mid_pose @ Y_UP_TO_Z_UP.T
+    poses[~mask] = np.nan
+    if orientations:
+        quaternions = np.full(time_stamps.shape + (4, ), np.nan)
+        quaternions[mask] = slerp(pose_quaternions[j[mask]],
+                                  pose_quaternions[j[mask] + 1],
+                                  percent[mask])
+        return poses, rtk_datas, mask, variances, quaternions
+    return poses, rtk_datas, mask, variances
+
+
+def world_orientations(quaternions, R):
+    """
+    Rotates camera orientations from the y-up pose frame into the z-up
+    RTK/world frame of an alignment.
+
+    Y_UP_TO_Z_UP is a reflection, so the camera axes are mapped through it
+    as well: the result is the rotation R @ Y_UP_TO_Z_UP @ C @ Y_UP_TO_Z_UP
+    of every camera rotation C, and a direction d in camera coordinates
+    points along result.apply(Y_UP_TO_Z_UP @ d) in the world frame.
+
+    Args:
+        quaternions (numpy.ndarray): (..., 4) camera orientations in the pose
+            frame, scalar-last, NaN rows are kept.
+        R (numpy.ndarray): Rotation matrix of the alignment.
+
+    Returns:
+        numpy.ndarray: (..., 4) quaternions in the world frame.
+    """
+    quaternions = np.asarray(quaternions, dtype=float)
+    flat = quaternions.reshape(-1, 4)
+    valid = ~np.isnan(flat).any(axis=1)
+    world = np.full(flat.shape, np.nan)
+    if valid.any():
+        matrices = Rotation.from_quat(flat[valid]).as_matrix()
+        matrices = R @ Y_UP_TO_Z_UP @ matrices @ Y_UP_TO_Z_UP
+        world[valid] = Rotation.from_matrix(matrices).as_quat()
+    return world.reshape(quaternions.shape)
+
+
+def aligned_orientations(pose_data, rtk_data, R, time_shift):
+    """
+    The camera orientations in the world frame at the RTK stamps of an
+    alignment, interpolated in one batched pass.
+
+    Args:
+        pose_data (dict): Pose track with a quaternion column.
+        rtk_data (list or dict): RTK data sorted by timeStamp.
+        R (numpy.ndarray): Rotation matrix of the alignment.
+        time_shift (float): Time shift of the alignment, e.g.
+            diagnostics.time_shift of `coarse_to_fine_align`.
+
+    Returns:
+        tuple: (M, 4) world quaternions, NaN where no pose brackets the RTK
+        stamp, and the (M,) boolean mask of the associated RTK data points.
+    """
+    _, _, mask, _, quaternions = associate_shifts(pose_data,
+                                                  rtk_data, [time_shift],
+                                                  orientations=True)
+    return world_orientations(quaternions[0], R), mask[0]
+
+
+def aligner_yaw_batch(poses, rtk_datas, mask, return_residuals=False):
+    """
+    Aligns z-up poses with RTK data estimating only a rotation around the
+    vertical axis (yaw) and a 3D translation, for S associations at once.
+
+    Gravity-aligned AR frames (ARKit/ARCore) only drift in yaw, so the
+    closed-form yaw is atan2 of the summed cross and dot products of the
+    centered horizontal coordinates; no SVD is needed.
+
+    Args:
+        poses (numpy.ndarray): (S, M, 3) associated poses.
+        rtk_datas (numpy.ndarray): (M, 3) or (S, M, 3) RTK positions.
+        mask (numpy.ndarray): (S, M) boolean array of valid pairs.
+        return_residuals (bool, optional): Also return the (S, M, 3) residuals,
+            zero where mask is False. Defaults to False.
+
+    Returns:
+        tuple: A tuple containing the (S, 3, 3) rotation matrices (R),
+        (S, 3) translation vectors (t) and (S,) errors. Errors are inf where
+        fewer than 2 pairs are associated.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    rtk_datas = np.broadcast_to(rtk_datas, np.shape(poses))
+    weights = mask.astype(float)
+    N = weights.sum(axis=1)
+    safe_N = np.maximum(N, 1.0)
+    poses = np.where(mask[..., None], poses, 0.0)
+    rtk_datas = np.where(mask[..., None], rtk_datas, 0.0)
+    # Calculate mean
+    poses_mean = poses.sum(axis=1) / safe_N[:, None]
+    rtk_data_mean = rtk_datas.sum(axis=1) / safe_N[:, None]
+    ar_diff = (poses - poses_mean[:, None, :]) * weights[..., None]
+    rtk_diff = (rtk_datas - rtk_data_mean[:, None, :]) * weights[..., None]
+    # Closed-form yaw from the summed dot and cross terms
+    dot = np.sum(ar_diff[..., 0] * rtk_diff[..., 0] +
+                 ar_diff[..., 1] * rtk_diff[..., 1],
+                 axis=1)
+    cross = np.sum(ar_diff[..., 0] * rtk_diff[..., 1] -
+                   ar_diff[..., 1] * rtk_diff[..., 0],
+                   axis=1)
+    yaw = np.arctan2(cross, dot)
+    cos_yaw, sin_yaw = np.cos(yaw), np.sin(yaw)
+    R = np.zeros((len(yaw), 3, 3))
+    R[:, 0, 0] = cos_yaw
+    R[:, 0, 1] = -sin_yaw
+    R[:, 1, 0] = sin_yaw
+    R[:, 1, 1] = cos_yaw
+    R[:, 2, 2] = 1.0
+    t = rtk_data_mean - np.einsum('sij,sj->si', R, poses_mean)
     # Calculate error
-    error = 0
-    for i in range(N):
-        error += np.linalg.norm(rtk_datas[i] - (scale * R @ poses[i] + t)) / N
+    residuals = (rtk_datas -
+                 (np.einsum('sij,smj->smi', R, poses) + t[:, None, :])
+                 ) * weights[..., None]
+    error = np.sum(np.linalg.norm(residuals, axis=2), axis=1) / safe_N
+    error[N < 2] = np.inf
+    if return_residuals:
+        return R, t, error, residuals
     return R, t, error
 
 
+def aligner_yaw_3D(poses, rtk_datas):
+    """
+    Aligns 3D poses with corresponding RTK data estimating only yaw and a 3D
+    translation, see `aligner_yaw_batch`.
+
+    Args:
+        poses (list): List of 3D poses.
+        rtk_datas (list): List of corresponding RTK data.
+
+    Returns:
+        tuple: A tuple containing the rotation matrix (R), translation vector (t), and error value.
+    """
+    N = len(poses)
+    if N != len(rtk_datas) or N < 2:
+        print("Wrong input data!")
+        return None, None, None
+    poses = np.asarray(poses, dtype=float).reshape(1, N, 3)
+    rtk_datas = np.asarray(rtk_datas, dtype=float).reshape(1, N, 3)
+    R, t, error = aligner_yaw_batch(poses, rtk_datas, np.ones((1, N), bool))
+    return R[0], t[0], error[0]
+
+
+def _check_mode(mode):
+    if mode not in ALIGNER_MODES:
+        raise ValueError("Unknown aligner mode {!r}, expected one of {}".format(
+            mode, ALIGNER_MODES))
+
+
+def _smoothed_speed(times, xyz, grid, resolution, smoothing):
+    """
+    Speed along the track on the grid, from positions smoothed by a moving
+    average, and the mask of the grid points inside the track.
+    """
+    width = max(int(round(smoothing / resolution)), 1)
+    kernel = np.ones(width) / width
+    positions = np.column_stack([
+        np.convolve(np.interp(grid, times, xyz[:, k]), kernel, mode='same')
+        for k in range(3)
+    ])
+    speed = np.linalg.norm(np.gradient(positions, axis=0), axis=1) / resolution
+    inside = (grid >= times[0] + smoothing) & (grid <= times[-1] - smoothing)
+    return np.where(inside, speed, 0.0), inside.astype(float)
+
+
+def estimate_time_shift(pose_data,
+                        rtk_data,
+                        time_shift_interval=[-1, 1],
+                        resolution=0.05,
+                        smoothing=0.5):
+    """
+    Estimates the time shift by correlating the speed of the poses with the
+    speed of the RTK data. The speed does not depend on the unknown rotation
+    and translation, so the estimate is cheap but coarse; it is used to order
+    the time shift search so that good shifts come early.
+
+    The normalized cross-correlation over the overlap of both tracks is
+    computed for all lags at once from FFT correlations of the signals,
+    their squares and their masks.
+
+    Args:
+        pose_data (list or dict): Pose data sorted by timeStamp.
+        rtk_data (list or dict): RTK data sorted by timeStamp.
+        time_shift_interval (list, optional): Range of the estimate.
+        resolution (float, optional): Sampling step of the speed signals in seconds.
+        smoothing (float, optional): Width of the moving average applied to
+            the positions in seconds, suppresses RTK noise and walking sway.
+
+    Returns:
+        float: The time shift with the highest correlation, None when the
+        tracks are too short or do not overlap within the interval.
+    """
+    pose_times = _track_array(pose_data, ['timeStamp'])[:, 0]
+    rtk_times = _track_array(rtk_data, ['timeStamp'])[:, 0]
+    if len(pose_times) < 2 or len(rtk_times) < 2:
+        return None
+    start = min(pose_times[0], rtk_times[0])
+    end = max(pose_times[-1], rtk_times[-1])
+    grid = np.arange(start, end + resolution, resolution)
+    pose_speed, pose_inside = _smoothed_speed(
+        pose_times, _track_array(pose_data, ['x', 'y', 'z']), grid,
+        resolution, smoothing)
+    rtk_speed, rtk_inside = _smoothed_speed(
+        rtk_times, _track_array(rtk_data, ['x', 'y', 'z']), grid, resolution,
+        smoothing)
+    # Zero padded so that the circular correlation does not wrap
+    size = 1 << int(2 * len(grid) - 1).bit_length()
+    left_edge, right_edge = time_shift_interval
+    lags = np.arange(math.ceil(left_edge / resolution),
+                     math.floor(right_edge / resolution) + 1)
+
+    def correlate(rtk_signal, pose_signal):
+        # sum over t of rtk_signal[t] * pose_signal[t - lag]
+        spectrum = np.fft.rfft(rtk_signal, size) * np.conj(
+            np.fft.rfft(pose_signal, size))
+        return np.fft.irfft(spectrum, size)[lags % size]
+
+    count = correlate(rtk_inside, pose_inside)
+    rtk_sum = correlate(rtk_speed, pose_inside)
+    pose_sum = correlate(rtk_inside, pose_speed)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = correlate(rtk_speed, pose_speed) - rtk_sum * pose_sum / count
+        rtk_variance = correlate(rtk_speed**2, pose_inside) - rtk_sum**2 / count
+        pose_variance = correlate(rtk_inside, pose_speed**2) - pose_sum**2 / count
+        ncc = covariance / np.sqrt(rtk_variance * pose_variance)
+    # At least one smoothing window of overlap
+    ncc[~(count >= 2 * smoothing / resolution)] = np.nan
+    if not np.isfinite(ncc).any():
+        return None
+    return float(lags[np.nanargmax(ncc)] * resolution)
+
+
+class SearchStopped(RuntimeError):
+    """
+    Raised when a time shift search that is not in anytime mode runs out of
+    its budget or is cancelled.
+    """
+
+
+class SearchBudget:
+    """
+    Wall-clock and evaluation budget, cancellation and progress reporting of
+    a time shift search, shared by the coarse and fine stages.
+
+    The budget is checked before every block of SEARCH_BLOCK time shifts. Once
+    it is exhausted or cancelled `stopped` is set and the search returns the
+    best shift evaluated so far.
+    """
+
+    def __init__(self,
+                 time_budget=None,
+                 max_evaluations=None,
+                 cancel=None,
+                 progress=None):
+        """
+        Args:
+            time_budget (float, optional): Wall-clock budget in seconds.
+            max_evaluations (int, optional): Maximum number of evaluated time shifts.
+            cancel (threading.Event, optional): Any object with an is_set()
+                method, the search stops once it is set.
+            progress (callable, optional): Called after every block as
+                progress(stage, evaluated, total, best_error) with the stage
+                name ('coarse' or 'fine'), the number of shifts evaluated and
+                planned in that stage and the best error so far (None if no
+                shift could be aligned yet).
+        """
+        self.deadline = None
+        if time_budget is not None:
+            self.deadline = time.monotonic() + time_budget
+        self.max_evaluations = max_evaluations
+        self.cancel = cancel
+        self.progress = progress
+        self.evaluations = 0
+        self.stopped = False
+
+    def allowance(self, n):
+        """
+        Returns how many of the next n time shifts may be evaluated, 0 once
+        the search has to stop.
+        """
+        if self.cancel is not None and self.cancel.is_set():
+            self.stopped = True
+        elif self.deadline is not None and time.monotonic() >= self.deadline:
+            self.stopped = True
+        elif self.max_evaluations is not None:
+            n = min(n, self.max_evaluations - self.evaluations)
+            self.stopped = n <= 0
+        return 0 if self.stopped else n
+
+
+class ShiftCache:
+    """
+    Bounded LRU cache of evaluated time shifts, shared by every search
+    strategy through `_evaluate_shifts`.
+
+    Entries are keyed by a fingerprint of the tracks (see
+    `track_fingerprint`), the aligner mode and the time shift quantized to
+    SHIFT_QUANTUM, and hold the rotation, translation, error and pair count
+    of the shift. The coarse and fine stages, the ordered search and repeated
+    calls on the same tracks thus never evaluate a shift twice. Worker
+    processes keep their own copy. Setting max_size to 0 disables it.
+
+    The module-level `shift_cache` is used unless the aligners are given a
+    cache of their own. A lock guards the entries and counters, so threads
+    can share a cache.
+    """
+
+    def __init__(self, max_size=SHIFT_CACHE_SIZE):
+        """
+        Args:
+            max_size (int, optional): Maximum number of cached shifts.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(fingerprint, mode, time_shift):
+        return (fingerprint, mode, int(round(time_shift / SHIFT_QUANTUM)))
+
+    def get(self, key):
+        """
+        Returns the (R, t, error, pair_count) of a key, None when it is not
+        cached. The hit and miss counters are kept by the evaluator with
+        `record`, which only counts the shifts it actually needs.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, R, t, error, pair_count):
+        if self.max_size <= 0:
+            return
+        if R is not None:
+            R, t = R.copy(), t.copy()
+            R.flags.writeable = t.flags.writeable = False
+        with self._lock:
+            self._entries[key] = (R, t, error, pair_count)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def record(self, hit):
+        """Counts a needed shift as a hit or a miss."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def clear(self):
+        """Drops all entries and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+shift_cache = ShiftCache()
+
+
+def track_fingerprint(pose_data, rtk_data):
+    """
+    Hash identifying the pose and RTK data of an alignment, the timestamps
+    and positions the evaluation of a time shift depends on.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for data in (pose_data, rtk_data):
+        array = _track_array(data, ['timeStamp', 'x', 'y', 'z'])
+        digest.update(np.int64(len(array)).tobytes())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.digest()
+
+
+def cost_curve_diagnostics(time_shifts, errors, pair_counts, evaluated=None):
+    """
+    Describes the shape of the alignment cost curve over the time shifts.
+
+    Returns:
+        SimpleNamespace: time_shifts, errors and pair_counts arrays, the
+        evaluated mask (errors of shifts that were skipped are inf), the
+        best_index, whether the minimum lies on the edge of the searched
+        interval (min_at_edge) and the discrete curvature at the minimum
+        (NaN on the edge), a flat curve means a poorly determined time shift.
+    """
+    time_shifts = np.asarray(time_shifts, dtype=float)
+    errors = np.asarray(errors, dtype=float)
+    if evaluated is None:
+        evaluated = np.ones(len(errors), dtype=bool)
+    finite = np.isfinite(errors)
+    best_index = int(np.argmin(np.where(finite, errors, np.inf))) \
+        if finite.any() else -1
+    curvature = float('nan')
+    min_at_edge = best_index in (0, len(errors) - 1)
+    if 0 < best_index < len(errors) - 1 and finite[best_index - 1:best_index +
+                                                  2].all():
+        step = (time_shifts[best_index + 1] - time_shifts[best_index - 1]) / 2
+        curvature = float((errors[best_index - 1] - 2 * errors[best_index] +
+                           errors[best_index + 1]) / step**2)
+    return SimpleNamespace(time_shifts=time_shifts,
+                           errors=errors,
+                           pair_counts=np.asarray(pair_counts),
+                           evaluated=np.asarray(evaluated, dtype=bool),
+                           best_index=best_index,
+                           min_at_edge=bool(min_at_edge),
+                           curvature=curvature)
+
+
+def shift_overlap(pose_data, rtk_data, time_shifts):
+    """
+    Counts for every time shift the RTK data points inside the shifted time
+    extent of the poses, the pairs `associate_shifts` can find, with two
+    binary searches per shift and without interpolating anything.
+
+    Args:
+        pose_data (list or dict): Pose data sorted by timeStamp.
+        rtk_data (list or dict): RTK data sorted by timeStamp.
+        time_shifts (array-like): S time shift values.
+
+    Returns:
+        numpy.ndarray: (S,) pair counts.
+    """
+    time_shifts = np.atleast_1d(np.asarray(time_shifts, dtype=float))
+    pose_times = _track_array(pose_data, ['timeStamp'])[:, 0]
+    rtk_times = _track_array(rtk_data, ['timeStamp'])[:, 0]
+    if len(pose_times) < 2:
+        return np.zeros(len(time_shifts), dtype=int)
+    first = np.searchsorted(rtk_times, pose_times[0] + time_shifts)
+    last = np.searchsorted(rtk_times, pose_times[-1] + time_shifts)
+    return last - first
+
+
+def _min_pairs(pose_data, rtk_data, min_overlap):
+    """
+    Number of pairs a feasible time shift needs: min_overlap times the largest
+    overlap any time shift can reach, and at least MIN_PAIRS.
+    """
+    pose_times = _track_array(pose_data, ['timeStamp'])[:, 0]
+    rtk_times = _track_array(rtk_data, ['timeStamp'])[:, 0]
+    if len(pose_times) < 2 or len(rtk_times) == 0:
+        return MIN_PAIRS
+    # The RTK data points in a window of the pose duration starting at each one
+    duration = pose_times[-1] - pose_times[0]
+    ends = np.searchsorted(rtk_times, rtk_times + duration)
+    max_overlap = int((ends - np.arange(len(rtk_times))).max())
+    return max(MIN_PAIRS, math.ceil(min_overlap * max_overlap))
+
+
+def _feasible_shifts(pose_data, rtk_data, time_shifts, min_overlap):
+    pair_counts = shift_overlap(pose_data, rtk_data, time_shifts)
+    return pair_counts, pair_counts >= _min_pairs(pose_data, rtk_data,
+                                                  min_overlap)
+
+
+def feasible_time_shift_interval(pose_data,
+                                 rtk_data,
+                                 step=0.1,
+                                 min_overlap=MIN_OVERLAP):
+    """
+    Derives the time shift interval from the time extents of the tracks, the
+    range of the time shifts on a grid of the given step whose overlap meets
+    min_overlap.
+
+    Args:
+        pose_data (list or dict): Pose data sorted by timeStamp.
+        rtk_data (list or dict): RTK data sorted by timeStamp.
+        step (float, optional): Step of the time shift grid.
+        min_overlap (float, optional): Required fraction of the largest
+            possible overlap, see `coarse_aligner_3D`.
+
+    Returns:
+        list: The [left, right] time shift interval, None when no time shift
+        is feasible.
+    """
+    pose_times = _track_array(pose_data, ['timeStamp'])[:, 0]
+    rtk_times = _track_array(rtk_data, ['timeStamp'])[:, 0]
+    if len(pose_times) < 2 or len(rtk_times) == 0:
+        return None
+    time_shifts = np.arange(rtk_times[0] - pose_times[-1],
+                            rtk_times[-1] - pose_times[0] + step, step)
+    _, feasible = _feasible_shifts(pose_data, rtk_data, time_shifts,
+                                   min_overlap)
+    if not feasible.any():
+        return None
+    indices = np.flatnonzero(feasible)
+    return [float(time_shifts[indices[0]]), float(time_shifts[indices[-1]])]
+
+
+def _bottomed_out(errors):
+    """
+    Tells whether the cost curve has clearly bottomed out. errors holds the
+    curve over the sorted time shifts, NaN where not evaluated yet. On each
+    side of the best shift, either nothing is left to evaluate, or the last
+    EARLY_STOP_PATIENCE evaluated shifts next to the minimum rise
+    monotonically away from it and lie more than EARLY_STOP_RISE above it.
+    """
+    finite = np.isfinite(errors)
+    if not finite.any():
+        return False
+    best = int(np.argmin(np.where(finite, errors, np.inf)))
+    threshold = errors[best] * (1 + EARLY_STOP_RISE)
+    for side in (errors[best + 1:], errors[:best][::-1]):
+        pending = np.isnan(side)
+        if not pending.any():
+            continue
+        recent = side[:np.argmax(pending)][-EARLY_STOP_PATIENCE:]
+        if (len(recent) < EARLY_STOP_PATIENCE
+                or not np.all(np.diff(recent) > 0) or recent[0] <= threshold):
+            return False
+    return True
+
+
+def _evaluate_shifts(pose_data,
+                     rtk_data,
+                     time_shifts,
+                     indices,
+                     errors,
+                     pair_counts,
+                     mode,
+                     cache,
+                     fingerprint,
+                     best=None,
+                     early_stop=False):
+    """
+    Evaluates the time shifts at the given indices in blocks of SEARCH_BLOCK
+    and writes their errors and pair counts into the arrays in place. Shifts
+    found in the cache are not evaluated again.
+
+    Returns:
+        tuple: The (R, t, error, time_shift) of the best shift so far, None
+        when no shift could be aligned, and whether the '3d' sweep stopped
+        early.
+    """
+    for start in range(0, len(indices), SEARCH_BLOCK):
+        block = indices[start:start + SEARCH_BLOCK]
+        keys = [
+            cache.key(fingerprint, mode, time_shift)
+            for time_shift in time_shifts[block]
+        ]
+        cached = [cache.get(key) for key in keys]
+        # Only the shifts missing from the cache are associated
+        missing = {}
+        for k, value in enumerate(cached):
+            if value is None:
+                missing[k] = len(missing)
+        if missing:
+            poses, rtk_datas, mask, _ = associate_shifts(
+                pose_data, rtk_data, time_shifts[block[list(missing)]])
+            if mode == 'yaw':
+                yaw_R, yaw_t, yaw_errors = aligner_yaw_batch(
+                    poses, rtk_datas, mask)
+        for k, index in enumerate(block):
+            if cached[k] is None:
+                m = missing[k]
+                if mode == 'yaw':
+                    valid = np.isfinite(yaw_errors[m])
+                    cached[k] = (yaw_R[m] if valid else None,
+                                 yaw_t[m] if valid else None, yaw_errors[m],
+                                 int(mask[m].sum()))
+                else:
+                    R, t, error = aligner_SVD_3D(poses[m][mask[m]],
+                                                 rtk_datas[mask[m]])
+                    cached[k] = (R, t, np.inf if error is None else error,
+                                 int(mask[m].sum()))
+                cache.put(keys[k], *cached[k])
+            cache.record(hit=k not in missing)
+            R, t, error, pair_counts[index] = cached[k]
+            errors[index] = error
+            if R is not None and (best is None or error < best[2]):
+                best = (R, t, error, time_shifts[index])
+            # The yaw shifts of a block are evaluated at once, no sweep to stop
+            if mode != 'yaw' and early_stop and _bottomed_out(errors):
+                return best, True
+    return best, False
+
+
+def _shift_result(pose_data, rtk_data, time_shifts, errors, pair_counts,
+                  feasible, best):
+    """
+    Builds the result of a time shift search from the best shift found by
+    `_evaluate_shifts` and the cost curve, see `_align_shifts`.
+    """
+    evaluated = feasible & ~np.isnan(errors)
+    errors[np.isnan(errors)] = np.inf
+    if best is not None:
+        best_R, best_t, best_error, best_time_shift = best
+        best_R, best_t = best_R.copy(), best_t.copy()
+        # Only the best shift is associated again, for its residuals
+        best_poses, best_rtk, best_mask, best_variances = associate_shifts(
+            pose_data, rtk_data, [best_time_shift])
+        diagnostics = residual_diagnostics(
+            best_rtk[best_mask[0]] -
+            (best_poses[0][best_mask[0]] @ best_R.T + best_t),
+            best_variances[best_mask[0]])
+    else:
+        best_R = None
+        best_t = None
+        best_error = sys.float_info.max
+        best_time_shift = 0
+        diagnostics = SimpleNamespace()
+    diagnostics.time_shift = best_time_shift
+    diagnostics.cost_curve = cost_curve_diagnostics(time_shifts, errors,
+                                                    pair_counts, evaluated)
+    return best_R, best_t, best_error, best_time_shift, diagnostics
+
+
+def _align_shifts(pose_data,
+                  rtk_data,
+                  time_shifts,
+                  mode,
+                  min_overlap=MIN_OVERLAP,
+                  early_stop=False,
+                  cache=None,
+                  fingerprint=None):
+    """
+    Evaluates the alignment for every feasible time shift and returns the best one.
+
+    Time shifts whose overlap is below min_overlap are skipped without any
+    association. The feasible shifts are associated in blocks of SEARCH_BLOCK,
+    so memory stays bounded by the block whatever the number of shifts, and
+    the 'yaw' aligner solves every block at once. With early_stop the '3d'
+    sweep stops once the cost curve has clearly bottomed out. Shifts found in
+    the cache (`shift_cache` by default) are not evaluated again, the
+    fingerprint of the tracks is computed when not given.
+
+    Returns:
+        tuple: A tuple containing the best rotation matrix (R), translation vector (t),
+        alignment error, time shift and the diagnostics of the best shift
+        together with the cost curve.
+    """
+    time_shifts = np.atleast_1d(np.asarray(time_shifts, dtype=float))
+    pair_counts, feasible = _feasible_shifts(pose_data, rtk_data, time_shifts,
+                                             min_overlap)
+    # NaN marks the feasible shifts that are not evaluated yet
+    errors = np.where(feasible, np.nan, np.inf)
+    if cache is None:
+        cache = shift_cache
+    if fingerprint is None and cache.max_size > 0:
+        fingerprint = track_fingerprint(pose_data, rtk_data)
+    best, _ = _evaluate_shifts(pose_data,
+                               rtk_data,
+                               time_shifts,
+                               np.flatnonzero(feasible),
+                               errors,
+                               pair_counts,
+                               mode,
+                               cache,
+                               fingerprint,
+                               early_stop=early_stop)
+    return _shift_result(pose_data, rtk_data, time_shifts, errors,
+                         pair_counts, feasible, best)
+
+
+def _align_shifts_shared(tracks, time_shifts, mode, min_overlap, early_stop,
+                         fingerprint):
+    return _align_shifts(tracks['poses'],
+                         tracks['rtk'],
+                         time_shifts,
+                         mode,
+                         min_overlap,
+                         early_stop,
+                         fingerprint=fingerprint)
+
+
+def _align_shifts_parallel(pose_data,
+                           rtk_data,
+                           time_shifts,
+                           mode,
+                           workers,
+                           min_overlap,
+                           early_stop,
+                           executor=None,
+                           fingerprint=None):
+    """
+    Evaluates contiguous chunks of the time shifts in worker processes, the
+    tracks are passed through shared memory. Returns the same result as
+    `_align_shifts`, early stopping applies to every chunk on its own.
+    """
+    tracks = {
+        'poses': _as_track(pose_data, POSE_TRACK_KEYS),
+        'rtk': _as_track(rtk_data, RTK_TRACK_KEYS)
+    }
+    chunks = np.array_split(time_shifts,
+                            min(workers or os.cpu_count(), len(time_shifts)))
+    results = map_shared(_align_shifts_shared,
+                         tracks,
+                         [(chunk, mode, min_overlap, early_stop, fingerprint)
+                          for chunk in chunks],
+                         workers,
+                         executor=executor)
+    # The first chunk wins ties, as the sequential sweep does
+    best = 0
+    for k, result in enumerate(results):
+        if result[2] < results[best][2]:
+            best = k
+    R, t, error, time_shift, diagnostics = results[best]
+    curves = [result[4].cost_curve for result in results]
+    diagnostics.cost_curve = cost_curve_diagnostics(
+        time_shifts, np.concatenate([curve.errors for curve in curves]),
+        np.concatenate([curve.pair_counts for curve in curves]),
+        np.concatenate([curve.evaluated for curve in curves]))
+    return R, t, error, time_shift, diagnostics
+
+
+def _ordered_shift_search(pose_data,
+                          rtk_data,
+                          time_shifts,
+                          mode,
+                          seed,
+                          budget,
+                          stage,
+                          min_overlap,
+                          early_stop,
+                          cache=None,
+                          fingerprint=None):
+    """
+    Evaluates the feasible time shifts in blocks, ordered outward from the
+    seed, until all are evaluated, the cost curve has bottomed out on both
+    sides (with early_stop) or the budget stops the search. Returns the same
+    result as `_align_shifts`.
+    """
+    tracks = (_as_track(pose_data, POSE_TRACK_KEYS),
+              _as_track(rtk_data, RTK_TRACK_KEYS))
+    if cache is None:
+        cache = shift_cache
+    # Computed once for all blocks
+    if fingerprint is None and cache.max_size > 0:
+        fingerprint = track_fingerprint(*tracks)
+    pair_counts, feasible = _feasible_shifts(*tracks, time_shifts, min_overlap)
+    errors = np.where(feasible, np.nan, np.inf)
+    indices = np.flatnonzero(feasible)
+    order = indices[np.argsort(np.abs(time_shifts[indices] - seed),
+                               kind='stable')]
+    best = None
+    done = 0
+    while done < len(order):
+        n = budget.allowance(min(SEARCH_BLOCK, len(order) - done))
+        if n == 0:
+            break
+        best, _ = _evaluate_shifts(*tracks,
+                                   time_shifts,
+                                   order[done:done + n],
+                                   errors,
+                                   pair_counts,
+                                   mode,
+                                   cache,
+                                   fingerprint,
+                                   best=best)
+        done += n
+        budget.evaluations += n
+        if budget.progress is not None:
+            budget.progress(stage, done, len(order),
+                            None if best is None else float(best[2]))
+        if early_stop and _bottomed_out(errors):
+            break
+    # The residuals are only computed for the final best shift
+    return _shift_result(*tracks, time_shifts, errors, pair_counts, feasible,
+                         best)
+
+
 def coarse_aligner_3D(pose_data,
                       rtk_data,
                       time_shift_interval=[-1, 1],
-                      coarse_step=0.1):
+                      coarse_step=0.1,
+                      mode='3d',
+                      return_diagnostics=False,
+                      workers=None,
+                      prior_time_shift=None,
+                      budget=None,
+                      min_overlap=MIN_OVERLAP,
+                      early_stop=False,
+                      executor=None,
+                      cache=None,
+                      fingerprint=None):
     '''
     Performs coarse alignment in 3D by finding the best rotation matrix (R), translation vector (t),
     alignment error, and time shift for a given pose data and RTK data.
@@ -187,36 +1150,92 @@ def coarse_aligner_3D(pose_data,
     Args:
         pose_data (list): List of pose data points.
         rtk_data (list): List of RTK data points.
-        time_shift_interval (int): Maximum time shift interval to consider.
+        time_shift_interval (list): Time shift interval to consider, None to
+            derive it from the time extents of the tracks, see
+            `feasible_time_shift_interval`.
         interval_step (int): Step size for iterating over the time shift interval.
+        mode (str, optional): '3d' for the full SVD rotation, 'yaw' for the
+            yaw-only closed form evaluated for all shifts at once. Defaults to '3d'.
+        return_diagnostics (bool, optional): Also return the residual
+            diagnostics of the best shift and the cost curve over all shifts,
+            computed in the same pass. Defaults to False.
+        workers (int, optional): Number of worker processes sharing the time
+            shifts, the tracks are placed in shared memory instead of being
+            pickled to every worker. None to sweep in this process. Not used
+            by the ordered search.
+        executor (concurrent.futures.ProcessPoolExecutor, optional): Worker
+            processes to sweep in instead of a pool created for the call, the
+            shifts are split into `workers` chunks (the number of CPUs by
+            default). Not shut down.
+        prior_time_shift (float, optional): Prior estimate of the time shift.
+            Given a prior or a budget the shifts are evaluated outward from
+            the prior, or from `estimate_time_shift` without one, so that
+            good answers come early.
+        budget (SearchBudget, optional): Budget, cancellation and progress of
+            the search. When it stops the search, the best shift evaluated so
+            far is returned and budget.stopped is set.
+        min_overlap (float, optional): Time shifts whose pairs are fewer than
+            this fraction of the largest overlap any shift can reach (or
+            fewer than MIN_PAIRS) are skipped without being evaluated.
+            Defaults to MIN_OVERLAP.
+        early_stop (bool, optional): Stop the '3d' and the ordered search once
+            the cost curve has clearly bottomed out. On cost curves with
+            several minima the result can differ from the full sweep.
+            Defaults to False.
+        cache (ShiftCache, optional): Cache of the evaluated time shifts,
+            `shift_cache` by default. Worker processes use their own.
+        fingerprint (bytes, optional): The `track_fingerprint` of the
+            tracks, computed when not given.
 
     Returns:
         tuple: A tuple containing the best rotation matrix (R), translation vector (t),
-        alignment error, and time shift.
+        alignment error, and time shift, followed by the diagnostics if requested.
 
     '''
-    best_error = sys.float_info.max
-    best_R = None
-    best_t = None
-    best_time_shift = 0
-    left_edge, right_edge = time_shift_interval
-    for i in np.arange(left_edge, right_edge + coarse_step, coarse_step):
-        shifted_poses, shifted_rtk, variances = data_association(
-            pose_data, rtk_data, i)
-        R, t, error = aligner_SVD_3D(shifted_poses, shifted_rtk)
-        if error < best_error:
-            best_error = error
-            best_R = R
-            best_t = t
-            best_time_shift = i
-    return best_R, best_t, best_error, best_time_shift
+    _check_mode(mode)
+    if time_shift_interval is None:
+        time_shift_interval = feasible_time_shift_interval(
+            pose_data, rtk_data, coarse_step, min_overlap)
+    if time_shift_interval is None:
+        time_shifts = np.array([])
+    else:
+        left_edge, right_edge = time_shift_interval
+        time_shifts = np.arange(left_edge, right_edge + coarse_step,
+                                coarse_step)
+    if len(time_shifts) and (budget is not None
+                             or prior_time_shift is not None):
+        seed = prior_time_shift
+        if seed is None:
+            seed = estimate_time_shift(pose_data, rtk_data, time_shift_interval)
+        if seed is None:
+            seed = (left_edge + right_edge) / 2
+        result = _ordered_shift_search(pose_data, rtk_data, time_shifts, mode,
+                                       seed, budget or SearchBudget(),
+                                       'coarse', min_overlap, early_stop,
+                                       cache, fingerprint)
+    elif ((executor is not None or (workers and workers > 1))
+          and len(time_shifts) > 1):
+        result = _align_shifts_parallel(pose_data, rtk_data, time_shifts,
+                                        mode, workers, min_overlap, early_stop,
+                                        executor, fingerprint)
+    else:
+        result = _align_shifts(pose_data, rtk_data, time_shifts, mode,
+                               min_overlap, early_stop, cache, fingerprint)
+    return result if return_diagnostics else result[:4]
 
 
 def fine_aligner_3D(pose_data,
                     rtk_data,
                     best_time_shift,
                     step=0.01,
-                    max_iter=20):
+                    max_iter=20,
+                    mode='3d',
+                    return_diagnostics=False,
+                    budget=None,
+                    min_overlap=MIN_OVERLAP,
+                    early_stop=False,
+                    cache=None,
+                    fingerprint=None):
     '''
     Perform fine alignment of 3D pose data and RTK data.
 
@@ -226,35 +1245,54 @@ def fine_aligner_3D(pose_data,
         best_time_shift (int): The best time shift value.
         step (int): The step size for iterating over time shifts.
         max_iter (int, optional): Maximum number of iterations. Defaults to 10.
+        mode (str, optional): Aligner mode, '3d' or 'yaw'. Defaults to '3d'.
+        return_diagnostics (bool, optional): Also return the diagnostics, see
+            `coarse_aligner_3D`. Defaults to False.
+        budget (SearchBudget, optional): Budget of the search, the shifts are
+            then evaluated outward from best_time_shift, see `coarse_aligner_3D`.
+        min_overlap (float, optional): See `coarse_aligner_3D`.
+        early_stop (bool, optional): See `coarse_aligner_3D`.
+        cache (ShiftCache, optional): See `coarse_aligner_3D`.
+        fingerprint (bytes, optional): See `coarse_aligner_3D`.
 
     Returns:
         tuple: A tuple containing the best rotation matrix (best_R), 
                the best translation vector (best_t), the best error (best_error),
-               and the best time shift value (best_time_shift).
+               and the best time shift value (best_time_shift), followed by the
+               diagnostics if requested.
     '''
-    best_error = sys.float_info.max
-    best_R = None
-    best_t = None
-    best_time_shift = 0
-    for i in np.arange(best_time_shift - max_iter / 2 * step,
-                       best_time_shift + max_iter / 2 * step, step):
-        shifted_poses, shifted_rtk, variances = data_association(
-            pose_data, rtk_data, i)
-        R, t, error = aligner_SVD_3D(shifted_poses, shifted_rtk)
-        if error < best_error:
-            best_error = error
-            best_R = R
-            best_t = t
-            best_time_shift = i
-
-    return best_R, best_t, best_error, best_time_shift
+    _check_mode(mode)
+    time_shifts = np.arange(best_time_shift - max_iter / 2 * step,
+                            best_time_shift + max_iter / 2 * step, step)
+    if budget is not None:
+        result = _ordered_shift_search(pose_data, rtk_data, time_shifts, mode,
+                                       best_time_shift, budget, 'fine',
+                                       min_overlap, early_stop, cache,
+                                       fingerprint)
+    else:
+        result = _align_shifts(pose_data, rtk_data, time_shifts, mode,
+                               min_overlap, early_stop, cache, fingerprint)
+    return result if return_diagnostics else result[:4]
 
 
 def coarse_to_fine_align(pose_data,
                          rtk_data,
                          time_shift_interval=[-1, 1],
                          coarse_step=0.1,
-                         fine_step=0.01):
+                         fine_step=0.01,
+                         mode='3d',
+                         return_diagnostics=False,
+                         workers=None,
+                         progress=None,
+                         cancel=None,
+                         time_budget=None,
+                         max_evaluations=None,
+                         prior_time_shift=None,
+                         anytime=False,
+                         min_overlap=MIN_OVERLAP,
+                         early_stop=False,
+                         executor=None,
+                         cache=None):
     '''
     Aligns the pose data with the RTK data using a two-step alignment process.
 
@@ -262,16 +1300,100 @@ def coarse_to_fine_align(pose_data,
         pose_data (list): List of pose data.
         rtk_data (list): List of RTK data.
         time_shift_interval (list, optional): Time shift interval for coarse alignment. Defaults to [-1, 1].
+            None derives the interval from the overlap of the tracks.
         coarse_step (float, optional): Coarse alignment step size. Defaults to 0.1.
         fine_step (float, optional): Fine alignment step size. Defaults to 0.01.
+        mode (str, optional): Aligner mode, '3d' for the full SVD rotation or
+            'yaw' for yaw plus 3D translation, which is cheaper and better
+            conditioned on short or near-straight gravity-aligned captures.
+            Defaults to '3d'.
+        return_diagnostics (bool, optional): Also return the diagnostics of the
+            final alignment: per-pair residuals, error statistics, breakdown
+            by fix status, time shift, and the fine and coarse cost curves
+            (cost_curve, coarse_cost_curve). Defaults to False.
+        workers (int, optional): Number of worker processes for the coarse
+            time shift sweep, see `coarse_aligner_3D`.
+        executor (concurrent.futures.ProcessPoolExecutor, optional): Worker
+            processes for the coarse sweep, see `coarse_aligner_3D`.
+        progress (callable, optional): Progress callback, see `SearchBudget`.
+        cancel (threading.Event, optional): Cancellation token, see `SearchBudget`.
+        time_budget (float, optional): Wall-clock budget in seconds.
+        max_evaluations (int, optional): Maximum number of evaluated time shifts.
+        prior_time_shift (float, optional): Prior estimate of the time shift,
+            the coarse sweep starts there and moves outward. With a budget
+            and no prior the sweep starts from `estimate_time_shift`.
+        anytime (bool, optional): Return the best transform found when the
+            budget runs out or the search is cancelled, diagnostics.converged
+            tells whether the search converged, so return_diagnostics is
+            required. Without anytime a stopped search raises SearchStopped.
+            Defaults to False.
+        min_overlap (float, optional): Minimum overlap of a feasible time
+            shift, see `coarse_aligner_3D`.
+        early_stop (bool, optional): Stop the sweeps once the cost curve has
+            clearly bottomed out, see `coarse_aligner_3D`. Defaults to False.
+        cache (ShiftCache, optional): Cache of the evaluated time shifts,
+            `shift_cache` by default. The tracks are fingerprinted once for
+            both stages.
 
     Returns:
-        tuple: A tuple containing the rotation matrix (R), translation vector (t), and alignment error.
+        tuple: A tuple containing the rotation matrix (R), translation vector (t), and alignment error,
+        followed by the diagnostics if requested.
+
+    Raises:
+        ValueError: If anytime is set without return_diagnostics.
+        SearchStopped: If the search stops without anytime.
     '''
-    _, _, _, best_coarse_time_shift = coarse_aligner_3D(
-        pose_data, rtk_data, time_shift_interval, coarse_step=coarse_step)
-    max_iter = math.ceil(coarse_step / fine_step) * 2
-    R, t, error, _ = fine_aligner_3D(pose_data, rtk_data,
-                                     best_coarse_time_shift, fine_step,
-                                     max_iter)
-    return R, t, error
+    if anytime and not return_diagnostics:
+        raise ValueError('anytime requires return_diagnostics, the '
+                         'diagnostics tell whether the search converged')
+    budget = None
+    if any(value is not None
+           for value in (progress, cancel, time_budget, max_evaluations)):
+        budget = SearchBudget(time_budget, max_evaluations, cancel, progress)
+    if cache is None:
+        cache = shift_cache
+    fingerprint = None
+    if cache.max_size > 0:
+        fingerprint = track_fingerprint(pose_data, rtk_data)
+    R, t, error, best_coarse_time_shift, coarse_diagnostics = coarse_aligner_3D(
+        pose_data,
+        rtk_data,
+        time_shift_interval,
+        coarse_step=coarse_step,
+        mode=mode,
+        return_diagnostics=True,
+        workers=workers,
+        prior_time_shift=prior_time_shift,
+        budget=budget,
+        min_overlap=min_overlap,
+        early_stop=early_stop,
+        executor=executor,
+        cache=cache,
+        fingerprint=fingerprint)
+    if budget is not None and budget.stopped:
+        # The fine search is skipped, the coarse result is the best so far
+        diagnostics = coarse_diagnostics
+    else:
+        max_iter = math.ceil(coarse_step / fine_step) * 2
+        R, t, error, _, diagnostics = fine_aligner_3D(pose_data,
+                                                      rtk_data,
+                                                      best_coarse_time_shift,
+                                                      fine_step,
+                                                      max_iter,
+                                                      mode=mode,
+                                                      return_diagnostics=True,
+                                                      budget=budget,
+                                                      min_overlap=min_overlap,
+                                                      early_stop=early_stop,
+                                                      cache=cache,
+                                                      fingerprint=fingerprint)
+    converged = budget is None or not budget.stopped
+    if not converged and not anytime:
+        raise SearchStopped(
+            'Time shift search stopped after {} evaluations'.format(
+                budget.evaluations))
+    if not return_diagnostics:
+        return R, t, error
+    diagnostics.coarse_cost_curve = coarse_diagnostics.cost_curve
+    diagnostics.converged = converged
+    return R, t, error, diagnostics
@@ -1,23 +1,99 @@
+import math
+
 from .align import coarse_to_fine_align
+from .icp import icp_align
 from .data_preprocessing import load_poses, load_rtk_data
+from .data_preprocessing import load_capture_archive
+from .data_preprocessing import load_pose_track, load_rtk_track, slice_track
+from .parallel import map_shared
 from scipy.spatial.transform import Rotation
 
 
-def alignment(rtk_folder, pose_folder):
+MATCHINGS = ('time', 'icp')
+
+
+def _check_matching(matching):
+    if matching not in MATCHINGS:
+        raise ValueError("Unknown matching {!r}, expected one of {}".format(
+            matching, MATCHINGS))
+
+
+def alignment(rtk_folder,
+              pose_folder,
+              mode='3d',
+              return_diagnostics=False,
+              matching='time'):
     '''
     Aligns the poses from the given pose folder with the RTK data from the RTK folder.
     
     Args:
         rtk_folder (str): The path to the folder containing the RTK data.
         pose_folder (str): The path to the folder containing the pose data.
+        mode (str, optional): Aligner mode, '3d' or 'yaw' for gravity-aligned
+            AR trajectories. Defaults to '3d'.
+        return_diagnostics (bool, optional): Also return the alignment
+            diagnostics, see `coarse_to_fine_align`. Defaults to False.
+        matching (str, optional): 'time' to pair poses and RTK data by their
+            timestamps, 'icp' for spatial registration with `icp_align` when
+            the timestamps can not be trusted. Defaults to 'time'.
     
     Returns:
-        str: The JSON representation of the aligned data.
+        str: The JSON representation of the aligned data, followed by the
+        diagnostics if requested.
     '''
+    _check_matching(matching)
     poses = load_poses(pose_folder)
     rtk_data, origin = load_rtk_data(rtk_folder)
-    R, t, error = coarse_to_fine_align(poses, rtk_data)
+    return _align_loaded(poses, rtk_data, origin, mode, return_diagnostics,
+                         matching)
+
+
+def archive_alignment(archive_path,
+                      rtk_name='rtk',
+                      pose_name='cameras',
+                      mode='3d',
+                      return_diagnostics=False,
+                      matching='time',
+                      workers=None):
+    '''
+    Aligns the poses with the RTK data of a zip or tar capture archive,
+    without extracting it. Tar archives are read in a single pass, see
+    `load_capture_archive`.
+
+    Args:
+        archive_path (str): The path to the zip or tar file.
+        rtk_name (str, optional): Name of the RTK folder inside the archive.
+        pose_name (str, optional): Name of the pose folder inside the archive.
+        mode (str, optional): Aligner mode, see `alignment`.
+        return_diagnostics (bool, optional): See `alignment`.
+        matching (str, optional): See `alignment`.
+        workers (int, optional): Number of worker processes parsing zip
+            archives, 1 inside worker processes, see `map_archive_files`.
+
+    Returns:
+        str: The JSON representation of the aligned data, followed by the
+        diagnostics if requested.
+    '''
+    _check_matching(matching)
+    poses, rtk_data, origin = load_capture_archive(archive_path, rtk_name,
+                                                   pose_name, workers)
+    return _align_loaded(poses, rtk_data, origin, mode, return_diagnostics,
+                         matching)
+
+
+def _align_loaded(poses, rtk_data, origin, mode, return_diagnostics,
+                  matching):
+    if matching == 'icp':
+        R, t, error, diagnostics = icp_align(poses,
+                                             rtk_data,
+                                             mode=mode,
+                                             return_diagnostics=True)
+    else:
+        R, t, error, diagnostics = coarse_to_fine_align(
+            poses, rtk_data, mode=mode, return_diagnostics=True)
     json = to_geoJson(R, t, origin)
+    if return_diagnostics:
+        return json, diagnostics
     return json
 
 
@@ -42,3 +118,103 @@ def to_geoJson(R, t, origin):
         "origin": [origin[0], origin[1]]
     }
     return geo_json
+
+
+def _align_session(pose_folder, rtk_track, origin, align_kwargs, compact=False):
+    '''
+    Aligns one pose session against the shared local RTK track, only the RTK
+    data within the session time extent, plus the time shift interval and the
+    reach of the fine search beyond it, is used.
+    '''
+    poses = load_pose_track(pose_folder, compact)
+    if len(poses['timeStamp']) < 2:
+        return None
+    align_kwargs = dict(align_kwargs)
+    if align_kwargs.pop('matching', 'time') == 'icp':
+        # Timestamps are not trusted, all sessions match the whole track
+        # and reuse its cached KD-tree
+        return _session_result(icp_align(poses, rtk_track, **align_kwargs),
+                               origin)
+    time_shift_interval = align_kwargs.get('time_shift_interval', [-1, 1])
+    if time_shift_interval is None:
+        # The interval is derived from the overlap with the whole track
+        session_rtk = rtk_track
+    else:
+        left_edge, right_edge = time_shift_interval
+        # The fine stage searches this far around the best coarse shift, see
+        # coarse_to_fine_align
+        fine_step = align_kwargs.get('fine_step', 0.01)
+        margin = math.ceil(
+            align_kwargs.get('coarse_step', 0.1) / fine_step) * fine_step
+        session_rtk = slice_track(rtk_track,
+                                  poses['timeStamp'][0] + left_edge - margin,
+                                  poses['timeStamp'][-1] + right_edge + margin)
+    if len(session_rtk['timeStamp']) < 2:
+        return None
+    return _session_result(
+        coarse_to_fine_align(poses, session_rtk, **align_kwargs), origin)
+
+
+def _session_result(result, origin):
+    R, t, error, *diagnostics = result
+    if R is None:
+        return None
+    json = to_geoJson(R, t, origin)
+    # The aligner was asked for its diagnostics
+    if diagnostics:
+        return json, diagnostics[0]
+    return json
+
+
+def _align_session_shared(tracks, pose_folder, origin, align_kwargs, compact):
+    return _align_session(pose_folder, tracks['rtk'], origin, align_kwargs,
+                          compact)
+
+
+def multi_session_alignment(rtk_folder,
+                            pose_folders,
+                            workers=None,
+                            compact=False,
+                            executor=None,
+                            **kwargs):
+    '''
+    Aligns several pose sessions that overlap one RTK log.
+
+    The RTK data is loaded, filtered and converted to the local coordinate
+    system once, so all transforms share the same origin and local frame.
+    Each session is aligned against the part of the RTK track it overlaps.
+
+    Args:
+        rtk_folder (str): The path to the folder containing the RTK data.
+        pose_folders (list): The paths to the pose folders of the sessions.
+        workers (int, optional): Number of worker processes aligning the
+            sessions in parallel, None to align them in this process. The
+            RTK track is placed in shared memory once for all workers.
+        executor (concurrent.futures.ProcessPoolExecutor, optional): Worker
+            processes to align the sessions in instead of a pool created for
+            the call, see `map_shared`.
+        **kwargs: Passed to `coarse_to_fine_align`, e.g. mode, or to
+            `icp_align` with matching='icp'. The KD-tree of the RTK track is
+            built once per process and shared by the sessions. With
+            return_diagnostics the diagnostics of every session are returned
+            with its transform.
+        compact (bool, optional): Keep the RTK and pose tracks in the float32
+            layout of `compact_track`, which also halves the shared memory.
+
+    Returns:
+        list: The GeoJSON transform of every session, or its (transform,
+        diagnostics) with return_diagnostics, in the order of pose_folders,
+        None for sessions that could not be aligned.
+    '''
+    _check_matching(kwargs.get('matching', 'time'))
+    rtk_track, origin, _ = load_rtk_track(rtk_folder, compact)
+    if not workers and executor is None:
+        return [
+            _align_session(pose_folder, rtk_track, origin, kwargs, compact)
+            for pose_folder in pose_folders
+        ]
+    return map_shared(_align_session_shared, {'rtk': rtk_track},
+                      [(pose_folder, origin, kwargs, compact)
+                       for pose_folder in pose_folders],
+                      workers,
+                      executor=executor)
@@ -0,0 +1,239 @@
+import os
+import posixpath
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+# Zip archives with at least this many matching members are parsed in a
+# process pool of ARCHIVE_WORKERS processes
+PARALLEL_MIN_MEMBERS = 2048
+ARCHIVE_WORKERS = os.cpu_count() or 1
+
+
+def _is_archive(path):
+    return os.path.isfile(path) and (zipfile.is_zipfile(path)
+                                     or tarfile.is_tarfile(path))
+
+
+def split_archive_path(path):
+    '''
+    Splits a path into a zip or tar file and a folder inside it, e.g.
+    'capture.zip/cameras' into ('capture.zip', 'cameras').
+
+    Args:
+        path (str): A folder path, possibly going through an archive.
+
+    Returns:
+        tuple: The archive path and the folder inside the archive ('' for its
+        root), None when the path does not go through an archive.
+    '''
+    path = os.path.normpath(path)
+    if os.path.isdir(path):
+        return None
+    inner = []
+    prefix = path
+    while prefix and not os.path.exists(prefix):
+        prefix, name = os.path.split(prefix)
+        if not name:
+            break
+        inner.append(name)
+    if not _is_archive(prefix):
+        return None
+    return prefix, '/'.join(reversed(inner))
+
+
+def _normalize(name):
+    while name.startswith('./'):
+        name = name[2:]
+    return name.rstrip('/')
+
+
+def _in_folder(name, folder, suffix):
+    return (name.endswith(suffix)
+            and posixpath.dirname(_normalize(name)) == folder)
+
+
+def _add_folders(folders, member):
+    parts = _normalize(member).split('/')
+    # Zip files do not always list the folders themselves
+    for depth in range(1, len(parts) + 1):
+        folders.add('/'.join(parts[:depth]))
+
+
+def _shallowest(folders, name):
+    matches = [
+        folder for folder in folders if posixpath.basename(folder) == name
+    ]
+    if not matches:
+        raise ValueError('No {!r} folder in the archive'.format(name))
+    return min(matches, key=lambda folder: (folder.count('/'), folder))
+
+
+def find_archive_folder(archive_path, name):
+    '''
+    Finds the shallowest folder with the given name inside an archive, like
+    os.walk over the extracted archive would.
+
+    Returns:
+        str: The folder path inside the archive.
+
+    Raises:
+        ValueError: If the archive has no such folder.
+    '''
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            names = archive.namelist()
+    else:
+        with tarfile.open(archive_path, mode='r|*') as archive:
+            names = [member.name for member in archive]
+    folders = set()
+    for member in names:
+        _add_folders(folders, member)
+    return _shallowest(folders, name)
+
+
+def iter_archive_files(archive_path, folder, suffix='.json'):
+    '''
+    Streams the regular files directly inside a folder of a zip or tar
+    archive, without extracting them. Tar archives, also compressed ones, are
+    read in a single sequential pass.
+
+    Args:
+        archive_path (str): Path of the zip or tar file.
+        folder (str): Folder inside the archive, '' for its root.
+        suffix (str or tuple, optional): Only files with this suffix, or
+            one of these suffixes.
+
+    Yields:
+        tuple: The member name and a binary file object, valid until the next
+        member is requested.
+    '''
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and _in_folder(info.filename, folder,
+                                                    suffix):
+                    with archive.open(info) as file:
+                        yield info.filename, file
+        return
+    if not tarfile.is_tarfile(archive_path):
+        raise ValueError('Unsupported archive format')
+    with tarfile.open(archive_path, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile() and _in_folder(member.name, folder, suffix):
+                with archive.extractfile(member) as file:
+                    yield member.name, file
+
+
+def _map_zip_members(function, archive_path, names):
+    with zipfile.ZipFile(archive_path) as archive:
+        results = []
+        for name in names:
+            with archive.open(name) as file:
+                results.append(function(name, file))
+        return results
+
+
+def map_archive_files(function,
+                      archive_path,
+                      folder,
+                      suffix='.json',
+                      workers=None):
+    '''
+    Calls function(name, file) for every file directly inside a folder of a
+    zip or tar archive, see `iter_archive_files`.
+
+    Zip archives allow random access, so large ones are split into contiguous
+    slices of members that worker processes parse with their own handle of
+    the archive. Tar archives are streamed in this process.
+
+    Args:
+        function (callable): Picklable function of the member name and its
+            binary file object.
+        archive_path (str): Path of the zip or tar file.
+        folder (str): Folder inside the archive, '' for its root.
+        suffix (str or tuple, optional): Only files with this suffix, or
+            one of these suffixes.
+        workers (int, optional): Number of worker processes for zip archives,
+            None for ARCHIVE_WORKERS once there are PARALLEL_MIN_MEMBERS
+            members, 1 to parse in this process.
+
+    Returns:
+        list: The results in the order of the archive members.
+    '''
+    if not zipfile.is_zipfile(archive_path):
+        return [
+            function(name, file)
+            for name, file in iter_archive_files(archive_path, folder, suffix)
+        ]
+    with zipfile.ZipFile(archive_path) as archive:
+        names = [
+            info.filename for info in archive.infolist()
+            if not info.is_dir() and _in_folder(info.filename, folder, suffix)
+        ]
+    if workers is None:
+        workers = ARCHIVE_WORKERS if len(names) >= PARALLEL_MIN_MEMBERS else 1
+    workers = min(workers, len(names))
+    if workers <= 1:
+        return _map_zip_members(function, archive_path, names)
+    size = -(-len(names) // workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_map_zip_members, function, archive_path,
+                            names[start:start + size])
+            for start in range(0, len(names), size)
+        ]
+        return [result for future in futures for result in future.result()]
+
+
+def map_archive_folders(archive_path, folders, workers=None):
+    '''
+    Finds folders of an archive by name (see `find_archive_folder`) and calls
+    function(name, file) for every file directly inside each of them, see
+    `map_archive_files`.
+
+    Tar archives are read in a single sequential pass that locates the
+    folders and parses their members at once: the files of every folder with
+    a requested name are parsed, and only the results of the shallowest one
+    are kept. Zip archives list their members upfront and are parsed like
+    `map_archive_files` does.
+
+    Args:
+        archive_path (str): Path of the zip or tar file.
+        folders (dict): Folder name to the (function, suffix) of its files.
+        workers (int, optional): Number of worker processes for zip
+            archives, see `map_archive_files`.
+
+    Returns:
+        dict: Folder name to the results in the order of the archive members.
+
+    Raises:
+        ValueError: If the archive has no folder of a requested name.
+    '''
+    if zipfile.is_zipfile(archive_path):
+        return {
+            name: map_archive_files(function, archive_path,
+                                    find_archive_folder(archive_path, name),
+                                    suffix, workers)
+            for name, (function, suffix) in folders.items()
+        }
+    if not tarfile.is_tarfile(archive_path):
+        raise ValueError('Unsupported archive format')
+    found = set()
+    results = {}
+    with tarfile.open(archive_path, mode='r|*') as archive:
+        for member in archive:
+            _add_folders(found, member.name)
+            folder = posixpath.dirname(_normalize(member.name))
+            name = posixpath.basename(folder)
+            if name not in folders or not member.isfile():
+                continue
+            function, suffix = folders[name]
+            if member.name.endswith(suffix):
+                with archive.extractfile(member) as file:
+                    results.setdefault(folder, []).append(
+                        function(member.name, file))
+    return {
+        name: results.get(_shallowest(found, name), [])
+        for name in folders
+    }
@@ -0,0 +1,526 @@
+import math
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+from .align import associate_shifts, _check_mode
+from .align import MIN_PAIRS, MIN_OVERLAP
+from .app import to_geoJson
+from .data_preprocessing import read_pose, pose_to_local, iter_rtk_data
+from .data_preprocessing import RTK_KEYS, DIFF_STATUS_FIXED
+from .data_preprocessing import _columns_to_track, sort_track
+from .data_preprocessing import transfer_rtk_track_to_local
+
+# Poses or RTK data points per chunk
+CHUNK_SIZE = 1 << 14
+
+
+def track_chunks(track, chunk_size=CHUNK_SIZE):
+    '''
+    Splits an in-memory track sorted by timeStamp into chunks.
+
+    Args:
+        track (dict): Track, a dictionary of arrays.
+        chunk_size (int, optional): Rows per chunk.
+
+    Yields:
+        dict: Views of chunk_size consecutive rows of every column.
+    '''
+    size = len(track['timeStamp'])
+    for start in range(0, size, chunk_size):
+        yield {
+            key: column[start:start + chunk_size]
+            for key, column in track.items()
+        }
+
+
+def _timestamp_files(folder_path):
+    '''
+    The JSON files of a folder sorted by the timestamp in their names, the
+    order the chunked readers stream them in.
+    '''
+    names = [
+        filename for filename in os.listdir(folder_path)
+        if filename.endswith('.json')
+        and os.path.isfile(os.path.join(folder_path, filename))
+    ]
+    try:
+        names.sort(key=lambda filename: float(filename[:-len('.json')]))
+    except ValueError:
+        names.sort()
+    return [os.path.join(folder_path, filename) for filename in names]
+
+
+def _ordered(chunks):
+    '''
+    Sorts every chunk and checks that the chunks follow each other in time.
+    '''
+    last_time = -math.inf
+    for chunk in chunks:
+        chunk = sort_track(chunk)
+        if len(chunk['timeStamp']) == 0:
+            continue
+        if chunk['timeStamp'][0] < last_time:
+            raise ValueError('Chunks overlap in time, the files are not '
+                             'named in timestamp order')
+        last_time = chunk['timeStamp'][-1]
+        yield chunk
+
+
+def iter_pose_chunks(pose_folder, chunk_size=CHUNK_SIZE):
+    '''
+    Streams the local poses of a folder as time-sorted chunks, reading
+    chunk_size pose files at a time in the order of the timestamps in their
+    names.
+
+    Args:
+        pose_folder (str): The path to the folder containing the pose data.
+        chunk_size (int, optional): Poses per chunk.
+
+    Yields:
+        dict: Pose track chunks with the timeStamp, x, y and z arrays.
+    '''
+
+    def chunks():
+        files = _timestamp_files(pose_folder)
+        for start in range(0, len(files), chunk_size):
+            local_poses = [
+                pose_to_local(read_pose(file_path))
+                for file_path in files[start:start + chunk_size]
+            ]
+            yield {
+                key: np.array([pose[key] for pose in local_poses],
+                              dtype=float)
+                for key in ('timeStamp', 'x', 'y', 'z')
+            }
+
+    return _ordered(chunks())
+
+
+def _iter_raw_rtk_chunks(rtk_folder, chunk_size):
+    '''
+    Streams the raw RTK data of a folder as time-sorted chunks of whole
+    files, at least chunk_size data points each except the last one.
+    '''
+
+    def chunks():
+        columns = {key: [] for key in RTK_KEYS}
+        for file_path in _timestamp_files(rtk_folder):
+            for data_point in iter_rtk_data(file_path):
+                for key in RTK_KEYS:
+                    columns[key].append(data_point[key])
+            if len(columns['timeStamp']) >= chunk_size:
+                yield _columns_to_track(columns)
+                columns = {key: [] for key in RTK_KEYS}
+        if columns['timeStamp']:
+            yield _columns_to_track(columns)
+
+    return _ordered(chunks())
+
+
+def stream_rtk_origin(rtk_folder, chunk_size=CHUNK_SIZE):
+    '''
+    Finds the origin like `find_rtk_data_origin`, the first fixed solution in
+    time or else the most accurate datum, in one pass over the chunks.
+
+    Returns:
+        list: The WGS84 coordinates of the origin point.
+    '''
+    best_accuracy = math.inf
+    origin = [0, 0]
+    for chunk in _iter_raw_rtk_chunks(rtk_folder, chunk_size):
+        is_fixed = chunk['diffStatus'] == DIFF_STATUS_FIXED
+        if is_fixed.any():
+            index = int(np.argmax(is_fixed))
+            return [
+                float(chunk['latitude'][index]),
+                float(chunk['longitude'][index])
+            ]
+        accuracy = np.maximum(chunk['horizontalAccuracy'],
+                              chunk['verticalAccuracy'])
+        index = int(np.argmin(accuracy))
+        if accuracy[index] < best_accuracy:
+            best_accuracy = accuracy[index]
+            origin = [
+                float(chunk['latitude'][index]),
+                float(chunk['longitude'][index])
+            ]
+    return origin
+
+
+def iter_rtk_chunks(rtk_folder, origin, chunk_size=CHUNK_SIZE):
+    '''
+    Streams the RTK data of a folder as time-sorted chunks in the local
+    coordinate system, keeping the fixed solutions like `load_rtk_track`.
+
+    Args:
+        rtk_folder (str): The path to the folder containing the RTK data.
+        origin (list): The WGS84 coordinates of the origin point, see
+            `stream_rtk_origin`.
+        chunk_size (int, optional): Minimum number of raw data points per
+            chunk, whole files are kept together.
+
+    Yields:
+        dict: Local RTK track chunks, see `transfer_rtk_track_to_local`.
+    '''
+    for chunk in _iter_raw_rtk_chunks(rtk_folder, chunk_size):
+        local_chunk, _ = transfer_rtk_track_to_local(chunk, origin)
+        if len(local_chunk['timeStamp']):
+            yield local_chunk
+
+
+def _time_pieces(chunks, span):
+    '''
+    Splits time-sorted chunks into pieces covering at most span seconds.
+    '''
+    for chunk in chunks:
+        times = np.asarray(chunk['timeStamp'], dtype=float)
+        start = 0
+        while start < len(times):
+            stop = int(
+                np.searchsorted(times, times[start] + span, side='right'))
+            yield {
+                key: np.asarray(column)[start:stop]
+                for key, column in chunk.items()
+            }
+            start = stop
+
+
+def _associated_chunks(pose_chunks, rtk_chunks, time_shifts, span=math.inf):
+    '''
+    Associates streamed pose and RTK chunks for all time shifts, one RTK
+    chunk at a time.
+
+    The poses are kept in a sliding window from the last pose at or before
+    the earliest shifted RTK time to the first pose after the latest one, so
+    the interpolation across pose chunk boundaries pairs exactly like
+    `associate_shifts` over the whole tracks. The window covers the time of
+    the RTK chunk plus the span of the time shifts; RTK chunks longer than
+    span seconds are associated in pieces to bound it.
+
+    Yields:
+        tuple: The (S, m, 3) poses, (m, 3) RTK positions, (S, m) mask and
+        (m,) RTK times of every RTK chunk, see `associate_shifts`.
+    '''
+    pose_iterator = iter(pose_chunks)
+    window = None
+    exhausted = False
+    for rtk_chunk in _time_pieces(rtk_chunks, span):
+        rtk_times = np.asarray(rtk_chunk['timeStamp'], dtype=float)
+        if len(rtk_times) == 0:
+            continue
+        earliest = rtk_times[0] - time_shifts.max()
+        latest = rtk_times[-1] - time_shifts.min()
+        while not exhausted and (window is None
+                                 or window['timeStamp'][-1] <= latest):
+            try:
+                chunk = next(pose_iterator)
+            except StopIteration:
+                exhausted = True
+                break
+            chunk = {
+                key: np.asarray(chunk[key], dtype=float)
+                for key in ('timeStamp', 'x', 'y', 'z')
+            }
+            window = chunk if window is None else {
+                key: np.concatenate([window[key], chunk[key]])
+                for key in window
+            }
+        if window is None:
+            # No poses at all, nothing can be associated
+            window = {key: np.zeros(0) for key in ('timeStamp', 'x', 'y', 'z')}
+        # Poses before the last one at or before earliest are not needed
+        start = max(
+            int(np.searchsorted(window['timeStamp'], earliest, side='right'))
+            - 1, 0)
+        window = {key: column[start:] for key, column in window.items()}
+        poses, rtk_datas, mask, _ = associate_shifts(window, rtk_chunk,
+                                                     time_shifts)
+        yield poses, rtk_datas, mask, rtk_times
+    # Drain the poses after the last RTK chunk, e.g. to record their extent
+    for _ in pose_iterator:
+        pass
+
+
+def _time_extent(chunks, extent):
+    '''
+    Passes the chunks through and records the first and last timeStamp and
+    the number of rows in the extent dictionary.
+    '''
+    for chunk in chunks:
+        times = chunk['timeStamp']
+        if len(times):
+            if extent['count'] == 0:
+                extent['first'] = float(times[0])
+            extent['last'] = float(times[-1])
+            extent['count'] += len(times)
+        yield chunk
+
+
+def _pose_extent(pose_source):
+    extent = {'first': 0.0, 'last': 0.0, 'count': 0}
+    for _ in _time_extent(pose_source(), extent):
+        pass
+    return extent
+
+
+def _window_span(extent, chunk_size):
+    '''
+    Seconds of poses that fit into half a chunk at the mean pose rate, the
+    longest RTK piece and time shift span associated at once.
+    '''
+    duration = extent['last'] - extent['first']
+    if extent['count'] < 2 or duration <= 0:
+        return math.inf
+    return chunk_size / 2 * duration / (extent['count'] - 1)
+
+
+def _shift_groups(time_shifts, span):
+    '''
+    Splits sorted time shifts into slices spanning at most span seconds.
+    '''
+    start = 0
+    while start < len(time_shifts):
+        stop = int(
+            np.searchsorted(time_shifts, time_shifts[start] + span,
+                            side='right'))
+        yield slice(start, stop)
+        start = stop
+
+
+def _accumulate_statistics(pose_source, rtk_source, time_shifts, span):
+    '''
+    First pass: the pair count, sums and cross-covariance sums of every time
+    shift, relative to a reference pair to keep the sums well conditioned,
+    and the time extent of the poses.
+    '''
+    count = np.zeros(len(time_shifts))
+    pose_sum = np.zeros((len(time_shifts), 3))
+    rtk_sum = np.zeros((len(time_shifts), 3))
+    cross = np.zeros((len(time_shifts), 3, 3))
+    reference = None
+    pose_extent = {'first': 0.0, 'last': 0.0, 'count': 0}
+    for poses, rtk_datas, mask, _ in _associated_chunks(
+            _time_extent(pose_source(), pose_extent), rtk_source(),
+            time_shifts, span):
+        if reference is None:
+            if not mask.any():
+                continue
+            shift, index = np.argwhere(mask)[0]
+            reference = (poses[shift, index].copy(), rtk_datas[index].copy())
+        p = np.where(mask[..., None], poses - reference[0], 0.0)
+        q = np.where(mask[..., None], rtk_datas - reference[1], 0.0)
+        count += mask.sum(axis=1)
+        pose_sum += p.sum(axis=1)
+        rtk_sum += q.sum(axis=1)
+        cross += np.einsum('smi,smj->sij', q, p)
+    if reference is None:
+        reference = (np.zeros(3), np.zeros(3))
+    return SimpleNamespace(count=count,
+                           pose_sum=pose_sum,
+                           rtk_sum=rtk_sum,
+                           cross=cross,
+                           reference=reference,
+                           pose_extent=pose_extent)
+
+
+def solve_statistics(statistics, mode='3d'):
+    '''
+    Solves the alignment of every time shift from its sufficient statistics,
+    with the same closed forms as `aligner_SVD_3D` and `aligner_yaw_batch`.
+
+    Args:
+        statistics (SimpleNamespace): count (S,), pose_sum and rtk_sum (S, 3),
+            cross (S, 3, 3) sums of rtk * pose^T, all relative to the
+            reference (pose, rtk) pair.
+        mode (str, optional): Aligner mode, '3d' or 'yaw'.
+
+    Returns:
+        tuple: (S, 3, 3) rotation matrices and (S, 3) translation vectors.
+    '''
+    N = statistics.count
+    safe_N = np.maximum(N, 1.0)
+    poses_mean = statistics.pose_sum / safe_N[:, None]
+    rtk_data_mean = statistics.rtk_sum / safe_N[:, None]
+    Sigma = statistics.cross - N[:, None, None] * (rtk_data_mean[:, :, None] *
+                                                   poses_mean[:, None, :])
+    if mode == 'yaw':
+        yaw = np.arctan2(Sigma[:, 1, 0] - Sigma[:, 0, 1],
+                         Sigma[:, 0, 0] + Sigma[:, 1, 1])
+        R = np.zeros((len(yaw), 3, 3))
+        R[:, 0, 0] = R[:, 1, 1] = np.cos(yaw)
+        R[:, 1, 0] = np.sin(yaw)
+        R[:, 0, 1] = -R[:, 1, 0]
+        R[:, 2, 2] = 1.0
+    else:
+        U, _, Vt = np.linalg.svd(Sigma / safe_N[:, None, None])
+        W = np.broadcast_to(np.identity(3), Sigma.shape).copy()
+        W[np.linalg.det(U) * np.linalg.det(Vt) < 0, 2, 2] = -1
+        R = U @ W @ Vt
+    reference_pose, reference_rtk = statistics.reference
+    t = (rtk_data_mean + reference_rtk) - np.einsum(
+        'sij,sj->si', R, poses_mean + reference_pose)
+    return R, t
+
+
+def _window_counts(times, duration):
+    # The RTK data points in a window of the duration starting at each one
+    ends = np.searchsorted(times, times + duration)
+    return ends - np.arange(len(times)), ends < len(times)
+
+
+def _mean_errors(pose_source, rtk_source, time_shifts, R, t, duration,
+                 span):
+    '''
+    Second pass: the mean residual norm of every time shift, and the largest
+    number of RTK data points in a window of the pose duration (the overlap
+    `_min_pairs` is relative to), counted over a sliding buffer of times.
+    '''
+    error_sum = np.zeros(len(time_shifts))
+    max_overlap = 0
+    pending = np.zeros(0)
+    for poses, rtk_datas, mask, rtk_times in _associated_chunks(
+            pose_source(), rtk_source(), time_shifts, span):
+        aligned = np.einsum('sij,smj->smi', R, np.nan_to_num(poses))
+        norms = np.linalg.norm(rtk_datas - (aligned + t[:, None, :]), axis=2)
+        error_sum += np.where(mask, norms, 0.0).sum(axis=1)
+        pending = np.concatenate([pending, rtk_times])
+        counts, complete = _window_counts(pending, duration)
+        if complete.any():
+            max_overlap = max(max_overlap, int(counts[complete].max()))
+        # Windows that may still grow with the next chunk
+        pending = pending[int(complete.sum()):]
+    if len(pending):
+        max_overlap = max(max_overlap,
+                          int(_window_counts(pending, duration)[0].max()))
+    return error_sum, max_overlap
+
+
+def _shift_errors(pose_source, rtk_source, time_shifts, mode, min_overlap,
+                  span):
+    statistics = _accumulate_statistics(pose_source, rtk_source, time_shifts,
+                                        span)
+    N = statistics.count
+    extent = statistics.pose_extent
+    R, t = solve_statistics(statistics, mode)
+    errors = np.full(len(time_shifts), np.inf)
+    if (N >= MIN_PAIRS).any():
+        error_sum, max_overlap = _mean_errors(pose_source, rtk_source,
+                                              time_shifts, R, t,
+                                              extent['last'] - extent['first'],
+                                              span)
+        min_pairs = MIN_PAIRS
+        if extent['count'] >= 2:
+            min_pairs = max(MIN_PAIRS, math.ceil(min_overlap * max_overlap))
+        feasible = N >= min_pairs
+        errors[feasible] = error_sum[feasible] / N[feasible]
+    return R, t, errors
+
+
+def _align_shifts_chunked(pose_source, rtk_source, time_shifts, mode,
+                          min_overlap, span=math.inf):
+    # Shifts spanning more than span seconds are evaluated in groups, each
+    # streaming the data on its own, to bound the pose window
+    R = np.zeros((len(time_shifts), 3, 3))
+    t = np.zeros((len(time_shifts), 3))
+    errors = np.full(len(time_shifts), np.inf)
+    for group in _shift_groups(time_shifts, span):
+        R[group], t[group], errors[group] = _shift_errors(
+            pose_source, rtk_source, time_shifts[group], mode, min_overlap,
+            span)
+    if not np.isfinite(errors).any():
+        return None, None, sys.float_info.max, 0
+    best = int(np.argmin(errors))
+    return R[best], t[best], errors[best], time_shifts[best]
+
+
+def chunked_coarse_to_fine_align(pose_source,
+                                 rtk_source,
+                                 time_shift_interval=[-1, 1],
+                                 coarse_step=0.1,
+                                 fine_step=0.01,
+                                 mode='3d',
+                                 min_overlap=MIN_OVERLAP,
+                                 chunk_size=CHUNK_SIZE):
+    '''
+    Out-of-core version of `coarse_to_fine_align` for tracks that do not fit
+    in memory.
+
+    The pose and RTK chunks are streamed and associated for all time shifts
+    of a stage at once (see `_associated_chunks`). A first pass accumulates
+    the pair counts, sums and cross-covariance of every shift and solves all
+    transforms; a second pass computes their mean residual norm, the error
+    the in-memory aligners select the shift by. Each stage reads the data
+    twice and peak memory is bounded by the chunk size times the number of
+    shifts. The transform matches the in-memory path without early stopping
+    to rounding.
+
+    The poses paired with an RTK chunk span its time plus the span of the
+    time shifts. The poses are read once more upfront for their mean rate;
+    RTK chunks and time shift ranges covering more than half a chunk of
+    poses are split, a time shift range at the cost of streaming the data
+    again for every part.
+
+    Args:
+        pose_source (callable): Returns a new iterator over time-sorted pose
+            track chunks on every call, e.g. `iter_pose_chunks`.
+        rtk_source (callable): Returns a new iterator over time-sorted local
+            RTK track chunks on every call, e.g. `iter_rtk_chunks`.
+        time_shift_interval (list, optional): Time shift interval for coarse alignment.
+        coarse_step (float, optional): Coarse alignment step size.
+        fine_step (float, optional): Fine alignment step size.
+        mode (str, optional): Aligner mode, '3d' or 'yaw'. Defaults to '3d'.
+        min_overlap (float, optional): Minimum overlap of a feasible shift.
+        chunk_size (int, optional): Poses held at once to associate an RTK
+            chunk, at the mean pose rate, besides the pose chunk being read.
+
+    Returns:
+        tuple: A tuple containing the rotation matrix (R), translation vector (t), and alignment error.
+    '''
+    _check_mode(mode)
+    span = _window_span(_pose_extent(pose_source), chunk_size)
+    left_edge, right_edge = time_shift_interval
+    time_shifts = np.arange(left_edge, right_edge + coarse_step, coarse_step)
+    _, _, _, best_coarse_time_shift = _align_shifts_chunked(
+        pose_source, rtk_source, time_shifts, mode, min_overlap, span)
+    max_iter = math.ceil(coarse_step / fine_step) * 2
+    time_shifts = np.arange(
+        best_coarse_time_shift - max_iter / 2 * fine_step,
+        best_coarse_time_shift + max_iter / 2 * fine_step, fine_step)
+    R, t, error, _ = _align_shifts_chunked(pose_source, rtk_source,
+                                           time_shifts, mode, min_overlap,
+                                           span)
+    return R, t, error
+
+
+def chunked_alignment(rtk_folder,
+                      pose_folder,
+                      chunk_size=CHUNK_SIZE,
+                      mode='3d',
+                      **kwargs):
+    '''
+    Aligns the poses of a pose folder with the RTK data of an RTK folder
+    without loading either into memory, see `chunked_coarse_to_fine_align`.
+
+    Args:
+        rtk_folder (str): The path to the folder containing the RTK data.
+        pose_folder (str): The path to the folder containing the pose data.
+        chunk_size (int, optional): Poses or RTK data points per chunk.
+        mode (str, optional): Aligner mode, '3d' or 'yaw'. Defaults to '3d'.
+        **kwargs: Passed to `chunked_coarse_to_fine_align`.
+
+    Returns:
+        dict: The GeoJSON transform, None if it could not be aligned.
+    '''
+    origin = stream_rtk_origin(rtk_folder, chunk_size)
+    R, t, error = chunked_coarse_to_fine_align(
+        lambda: iter_pose_chunks(pose_folder, chunk_size),
+        lambda: iter_rtk_chunks(rtk_folder, origin, chunk_size),
+        mode=mode,
+        chunk_size=chunk_size,
+        **kwargs)
+    if R is None:
+        return None
+    return to_geoJson(R, t, origin)
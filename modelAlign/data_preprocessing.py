@@ -5,15 +5,63 @@
 #4. Project the 3D model to image
 #5. Calculate the west-south point and the east-north point
 #6. Generate the GeoJson file
+import codecs
+import datetime
 import json
+import math
 import numpy as np
 import os
+import tempfile
 
 #NOTICE: pdb only for testing,delete it when you finish the code
 import pdb
 
 from types import SimpleNamespace
+from scipy.spatial.transform import Rotation
 from geoToolbox import wgs84_to_cartesian, cartesian_to_wgs84
+from .archive import split_archive_path, map_archive_files
+from .archive import map_archive_folders
+
+# Categorical codes of the RTK diffStatus, the code is the index in the tuple
+DIFF_STATUSES = (
+    '固定解',  # fixed
+    '浮点解',  # float
+    '码差分',  # single_2
+    '单点解',  # single
+)
+DIFF_STATUS_FIXED = 0
+DIFF_STATUS_UNKNOWN = len(DIFF_STATUSES)
+
+variance_map = {
+    '单点解': 10.0,  # single
+    '码差分': 5.0,  # single_2
+    '固定解': 0.01,  # fixed
+    '浮点解': 1.0,  # float
+}
+# Variance indexed by diffStatus code, unknown statuses get 100.0
+DIFF_STATUS_VARIANCES = np.array(
+    [variance_map[status] for status in DIFF_STATUSES] + [100.0])
+
+RTK_KEYS = ('timeStamp', 'createTime', 'fixStatus', 'latitude',
+            'verticalAccuracy', 'height', 'diffStatus', 'horizontalAccuracy',
+            'longitude')
+# Columns of local tracks stored as float32 in the compact layout
+COMPACT_KEYS = ('x', 'y', 'z', 'variance', 'horizontalAccuracy',
+                'verticalAccuracy')
+# Sidecar file of a capture folder with the time range of every JSON file
+TIME_INDEX_FILENAME = '.time_index.npz'
+TIME_INDEX_KINDS = ('pose', 'rtk')
+# RTK files with NMEA logs instead of JSON
+NMEA_SUFFIXES = ('.nmea', '.log')
+# diffStatus of the GGA fix quality indicator, other qualities are unknown
+GGA_QUALITY_STATUSES = {
+    1: '单点解',  # GPS fix
+    2: '码差分',  # DGPS fix
+    4: '固定解',  # RTK fixed
+    5: '浮点解',  # RTK float
+}
+NMEA_SENTENCES = ('GGA', 'RMC', 'GST')
+SECONDS_PER_DAY = 86400.0
 
 
 def read_pose(pose_path):
@@ -34,7 +82,13 @@ def read_pose(pose_path):
     '''
     with open(pose_path, 'r') as file:
         pose_data = json.load(file)
+    return _process_pose(pose_data)
+
 
+def _process_pose(pose_data):
+    '''
+    Builds the pose of read_pose from the parsed JSON of a pose file.
+    '''
     globaltimestamp = float(pose_data['globaltimestamp'])
 
     R = np.array([[pose_data['t_00'], pose_data['t_01'], pose_data['t_02']],
@@ -73,14 +127,18 @@ def pose_to_local(pose):
     return local_pose
 
 
-def read_all_pose(folder_path):
+def read_all_pose(folder_path, time_range=None):
     '''
     Reads all pose data JSON files in the specified folder, 
     aggregates them into a list,
     and sorts the list by their timestamp.
     
     Parameters:
-    - folder_path: str, the path to the folder containing pose JSON files.
+    - folder_path: str, the path to the folder containing pose JSON files,
+    or to a folder inside a zip or tar archive (e.g. capture.zip/cameras),
+    whose members are parsed without extracting them.
+    - time_range: [t0, t1], only read the poses within this time range, the
+    files are selected with the time index of the folder, see time_index.
     
     Returns:
     - A sorted list of dictionaries, each containing the pose data, timestamp, 
@@ -88,6 +146,21 @@ def read_all_pose(folder_path):
     '''
     pose_data_list = []
 
+    archive = split_archive_path(folder_path)
+    if archive is not None:
+        pose_data_list = map_archive_files(_read_pose_member, *archive)
+        if time_range is not None:
+            pose_data_list = [
+                pose for pose in pose_data_list
+                if time_range[0] <= pose['timeStamp'] <= time_range[1]
+            ]
+        return sorted(pose_data_list, key=lambda x: x['timeStamp'])
+
+    if time_range is not None:
+        for file_path in indexed_files(folder_path, 'pose', time_range):
+            pose_data_list.append(read_pose(file_path))
+        return sorted(pose_data_list, key=lambda x: x['timeStamp'])
+
     # List all files in the directory specified by folder_path
     for filename in os.listdir(folder_path):
         # Construct the full file path
@@ -133,23 +206,11 @@ def transfer_all_pose_to_local(poses):
     return local_poses_sorted
 
 
-def read_rtk_data(rtk_path):
+def _process_rtk_point(data_point):
     '''
-    Reads a single RTK data entry from an RTK file.
-    
-    Parameters:
-    - rtk_path: str, the file path to the RTK JSON file.
-    
-    Returns:
-    - A dictionary containing properties of the RTK data point,
-    with values in their appropriate Python data types.
+    Converts the properties of a raw RTK data point into their appropriate
+    Python data types.
     '''
-    with open(rtk_path, 'r') as file:
-        rtk_data_raw = json.load(file)
-
-    # Assuming you're reading the first entry for simplicity; adjust as needed
-    data_point = rtk_data_raw['rtkData'][0]
-
     processed_point = {
         'timeStamp': float(data_point['timeStamp']),
         'createTime': float(data_point['createTime']),
@@ -161,18 +222,471 @@ def read_rtk_data(rtk_path):
         'horizontalAccuracy': float(data_point['horizontalAccuracy']),
         'longitude': float(data_point['longitude'])
     }
-
     return processed_point
 
 
-def read_all_rtk_data(folder_path):
+def iter_rtk_data(rtk_path, chunk_size=1 << 16):
+    '''
+    Streams every entry of the rtkData array of an RTK file. The file is read
+    in chunks and each entry is decoded as soon as it is complete, so files
+    with many fixes are never loaded into memory at once.
+
+    Parameters:
+    - rtk_path: str, the file path to the RTK JSON file.
+    - chunk_size: int, number of characters read at a time.
+
+    Yields:
+    - A dictionary per RTK data point, see read_rtk_data.
+    '''
+    with open(rtk_path, 'r', encoding='utf-8') as file:
+        yield from _iter_rtk_file(file, rtk_path, chunk_size)
+
+
+def _iter_rtk_file(file, rtk_path, chunk_size=1 << 16):
+    '''
+    Streams the rtkData entries of an open text file, see iter_rtk_data.
+    '''
+    decoder = json.JSONDecoder()
+    key = '"rtkData"'
+    buffer = ''
+    eof = False
+
+    def read_more():
+        chunk = file.read(chunk_size)
+        return chunk, not chunk
+
+    # Find the start of the rtkData array
+    while True:
+        start = buffer.find(key)
+        if start >= 0:
+            colon = buffer.find(':', start + len(key))
+            bracket = buffer.find('[', colon + 1) if colon >= 0 else -1
+            if bracket >= 0:
+                buffer = buffer[bracket + 1:]
+                break
+        if eof:
+            raise ValueError('No rtkData array in {}'.format(rtk_path))
+        if start < 0:
+            # Keep a tail in case the key is split between two chunks
+            buffer = buffer[-len(key):]
+        chunk, eof = read_more()
+        buffer += chunk
+    # Decode the array entries one by one
+    index = 0
+    while True:
+        while index < len(buffer) and buffer[index] in ' \t\r\n,':
+            index += 1
+        if index < len(buffer) and buffer[index] == ']':
+            return
+        if index < len(buffer):
+            try:
+                data_point, end = decoder.raw_decode(buffer, index)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield _process_rtk_point(data_point)
+                index = end
+                continue
+        elif eof:
+            raise ValueError(
+                'Unterminated rtkData array in {}'.format(rtk_path))
+        # The entry is incomplete, drop the consumed part and read on
+        buffer = buffer[index:]
+        index = 0
+        chunk, eof = read_more()
+        buffer += chunk
+
+
+def read_rtk_data(rtk_path):
+    '''
+    Reads a single RTK data entry from an RTK file, the first entry of its
+    rtkData array. Use iter_rtk_data to read all of them.
+    
+    Parameters:
+    - rtk_path: str, the file path to the RTK JSON file.
+    
+    Returns:
+    - A dictionary containing properties of the RTK data point,
+    with values in their appropriate Python data types.
+    '''
+    return next(iter_rtk_data(rtk_path))
+
+
+def _nmea_fields(line):
+    '''
+    Splits an NMEA sentence into its fields, the first one being the
+    sentence type without the talker (GNGGA and GPGGA are both GGA). Returns
+    None for lines that are not sentences or fail their checksum.
+    '''
+    start = line.find('$')
+    if start < 0:
+        return None
+    body, star, checksum = line[start + 1:].strip().partition('*')
+    if star:
+        computed = 0
+        for character in body:
+            computed ^= ord(character)
+        try:
+            if int(checksum[:2], 16) != computed:
+                return None
+        except ValueError:
+            return None
+    fields = body.split(',')
+    fields[0] = fields[0][-3:]
+    return fields
+
+
+def _nmea_epochs(lines):
+    '''
+    Groups the GGA, RMC and GST sentences of an NMEA log by their UTC time,
+    yields (time, {sentence type: fields}) per epoch.
+    '''
+    epoch_time, sentences = None, {}
+    for line in lines:
+        fields = _nmea_fields(line)
+        if (fields is None or fields[0] not in NMEA_SENTENCES
+                or len(fields) < 2 or not fields[1]):
+            continue
+        if fields[1] != epoch_time:
+            if sentences:
+                yield epoch_time, sentences
+            epoch_time, sentences = fields[1], {}
+        sentences[fields[0]] = fields
+    if sentences:
+        yield epoch_time, sentences
+
+
+def _nmea_degrees(value, hemisphere):
+    # (d)ddmm.mmmm, the minutes always have two integer digits
+    point = value.find('.')
+    point = len(value) if point < 0 else point
+    degrees = float(value[:point - 2]) + float(value[point - 2:]) / 60.0
+    return -degrees if hemisphere in ('S', 'W') else degrees
+
+
+def _nmea_time_of_day(value):
+    return int(value[0:2]) * 3600 + int(value[2:4]) * 60 + float(value[4:])
+
+
+def _nmea_day(value):
+    # ddmmyy, the Unix time of the UTC midnight
+    year = int(value[4:6])
+    year += 2000 if year < 80 else 1900
+    return datetime.datetime(year,
+                             int(value[2:4]),
+                             int(value[0:2]),
+                             tzinfo=datetime.timezone.utc).timestamp()
+
+
+def _nmea_fix(sentences):
+    '''
+    The RTK data point of an epoch without its timeStamp, None when the epoch
+    has no valid GGA fix.
+    '''
+    gga = sentences.get('GGA')
+    if gga is None or len(gga) < 10 or not gga[6]:
+        return None
+    quality = int(gga[6])
+    if quality == 0 or not (gga[2] and gga[4] and gga[9]):
+        return None
+    horizontal_accuracy = vertical_accuracy = float('inf')
+    gst = sentences.get('GST')
+    if gst is not None and len(gst) > 8:
+        if gst[6] and gst[7]:
+            horizontal_accuracy = math.hypot(float(gst[6]), float(gst[7]))
+        if gst[8]:
+            vertical_accuracy = float(gst[8])
+    return {
+        'fixStatus': quality,
+        'latitude': _nmea_degrees(gga[2], gga[3]),
+        'verticalAccuracy': vertical_accuracy,
+        'height': float(gga[9]),
+        'diffStatus': GGA_QUALITY_STATUSES.get(quality, ''),
+        'horizontalAccuracy': horizontal_accuracy,
+        'longitude': _nmea_degrees(gga[4], gga[5])
+    }
+
+
+def iter_nmea_data(nmea_path):
+    '''
+    Streams the RTK data points of an NMEA log, see _iter_nmea_file.
+
+    Parameters:
+    - nmea_path: str, the file path to the NMEA log.
+
+    Yields:
+    - A dictionary per RTK data point, with the keys of read_rtk_data.
+    '''
+    with open(nmea_path, 'r', encoding='ascii', errors='replace') as file:
+        yield from _iter_nmea_file(file, nmea_path)
+
+
+def _iter_nmea_file(file, nmea_path):
+    '''
+    Streams the RTK data points of an open NMEA log, line by line.
+
+    Every epoch with a valid GGA fix is one data point. The GGA fix quality
+    is mapped to the diffStatus of the JSON data (GGA_QUALITY_STATUSES) and
+    kept as fixStatus, the height is the GGA altitude above mean sea level.
+    The accuracies are the GST standard deviations, the horizontal one of
+    latitude and longitude combined, inf without GST. GGA only holds the UTC
+    time of day, the date is taken from RMC and carried over midnight, so
+    timeStamp and createTime are Unix times. Sentences failing their
+    checksum are skipped.
+    '''
+    day = None
+    previous_time = None
+    undated = []
+    for epoch_time, sentences in _nmea_epochs(file):
+        try:
+            time_of_day = _nmea_time_of_day(epoch_time)
+            rmc = sentences.get('RMC')
+            if rmc is not None and len(rmc) > 9 and rmc[9]:
+                epoch_day = _nmea_day(rmc[9])
+            elif day is not None:
+                epoch_day = day
+                if previous_time - time_of_day > SECONDS_PER_DAY / 2:
+                    epoch_day += SECONDS_PER_DAY
+            else:
+                epoch_day = None
+            data_point = _nmea_fix(sentences)
+        except (ValueError, IndexError):
+            # Malformed sentence fields
+            continue
+        if epoch_day is None:
+            if data_point is not None:
+                undated.append((time_of_day, data_point))
+            continue
+        # Fixes before the first date are on that day, or the one before
+        for undated_time, undated_point in undated:
+            undated_day = epoch_day
+            if undated_time > time_of_day:
+                undated_day -= SECONDS_PER_DAY
+            yield _stamp_nmea_fix(undated_point, undated_day + undated_time)
+        undated = []
+        day, previous_time = epoch_day, time_of_day
+        if data_point is not None:
+            yield _stamp_nmea_fix(data_point, epoch_day + time_of_day)
+    if undated:
+        raise ValueError('No RMC date for the fixes of {}'.format(nmea_path))
+
+
+def _stamp_nmea_fix(data_point, time_stamp):
+    return dict(timeStamp=time_stamp, createTime=time_stamp, **data_point)
+
+
+def _iter_rtk_path(file_path):
+    if file_path.endswith(NMEA_SUFFIXES):
+        return iter_nmea_data(file_path)
+    return iter_rtk_data(file_path)
+
+
+def _read_pose_member(name, file):
+    return _process_pose(json.load(file))
+
+
+def _read_rtk_member(name, file):
+    # Stream members of tar files are not seekable, decode incrementally
+    if name.endswith(NMEA_SUFFIXES):
+        return list(
+            _iter_nmea_file(
+                codecs.getreader('ascii')(file, errors='replace'), name))
+    return list(_iter_rtk_file(codecs.getreader('utf-8')(file), name))
+
+
+def _iter_rtk_folder(folder_path, time_range=None):
+    '''
+    Streams the RTK data points of all files of a folder, of a folder inside
+    an archive or of a single NMEA log, see read_rtk_track.
+    '''
+    archive = split_archive_path(folder_path)
+    if archive is not None:
+        for data_points in map_archive_files(_read_rtk_member,
+                                             *archive,
+                                             suffix=_data_suffixes('rtk')):
+            yield from data_points
+        return
+    if folder_path.endswith(NMEA_SUFFIXES) and os.path.isfile(folder_path):
+        yield from iter_nmea_data(folder_path)
+        return
+    for file_path in _rtk_files(folder_path, time_range):
+        yield from _iter_rtk_path(file_path)
+
+
+def _data_suffixes(kind):
+    return ('.json', ) + NMEA_SUFFIXES if kind == 'rtk' else ('.json', )
+
+
+def _rtk_files(folder_path, time_range=None):
+    if time_range is not None:
+        yield from indexed_files(folder_path, 'rtk', time_range)
+        return
+    for filename in os.listdir(folder_path):
+        file_path = os.path.join(folder_path, filename)
+        if os.path.isfile(file_path) and filename.endswith(
+                _data_suffixes('rtk')):
+            yield file_path
+
+
+def _file_time_range(file_path, kind):
+    '''
+    The first and last timeStamp in a pose or RTK file, (inf, -inf) for an
+    RTK file without data so that it never matches a time range.
+    '''
+    if kind == 'pose':
+        time_stamp = read_pose(file_path)['timeStamp']
+        return time_stamp, time_stamp
+    start, end = float('inf'), float('-inf')
+    for data_point in _iter_rtk_path(file_path):
+        start = min(start, data_point['timeStamp'])
+        end = max(end, data_point['timeStamp'])
+    return start, end
+
+
+def _load_time_index(index_path, kind):
+    '''
+    Reads a sidecar index into a dictionary of file name to (mtime_ns, size,
+    start, end), empty when it is missing, unreadable or of another kind.
+    '''
+    try:
+        with np.load(index_path) as stored:
+            if str(stored['kind']) != kind:
+                return {}
+            return {
+                str(name): (int(mtime), int(size), float(start), float(end))
+                for name, mtime, size, start, end in zip(
+                    stored['name'], stored['mtime'], stored['size'],
+                    stored['start'], stored['end'])
+            }
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def time_index(folder_path, kind):
+    '''
+    Returns the time index of a capture folder: the first and last timeStamp
+    of every JSON file (and NMEA log of an RTK folder), sorted by the first
+    one.
+
+    The index is kept in a sidecar file (TIME_INDEX_FILENAME) inside the
+    folder. It is built on first use and then updated incrementally: only
+    the files that are not in the index yet or whose mtime or size changed
+    (e.g. a live log that grew) are parsed, and files that are gone are
+    dropped. Every call therefore stats every data file of the folder, one
+    system call per file, which is cheap next to parsing them but grows with
+    the folder; the directory mtime cannot replace it, since it does not
+    change when a live log grows in place. Callers querying a folder
+    repeatedly should keep the returned index. The sidecar is replaced
+    atomically through a unique temporary file, so concurrent processes can
+    index the same folder. When the folder is not writable the index is
+    built in memory only.
+
+    Parameters:
+    - folder_path: str, the path to the folder containing the JSON files.
+    - kind: str, 'pose' for a pose folder or 'rtk' for an RTK folder.
+
+    Returns:
+    - A dictionary with the file names ('name') and their first ('start')
+    and last ('end') timeStamp, arrays sorted by start.
+    '''
+    if kind not in TIME_INDEX_KINDS:
+        raise ValueError("Unknown kind {!r}, expected one of {}".format(
+            kind, TIME_INDEX_KINDS))
+    index_path = os.path.join(folder_path, TIME_INDEX_FILENAME)
+    known = _load_time_index(index_path, kind)
+    entries = {}
+    changed = False
+    suffixes = _data_suffixes(kind)
+    with os.scandir(folder_path) as folder_entries:
+        for entry in folder_entries:
+            if not entry.name.endswith(suffixes):
+                continue
+            indexed = known.get(entry.name)
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if indexed is not None and indexed[:2] == signature:
+                entries[entry.name] = indexed
+                continue
+            entries[entry.name] = signature + _file_time_range(
+                entry.path, kind)
+            changed = True
+    changed = changed or len(entries) != len(known)
+    names = sorted(entries, key=lambda name: (entries[name][2], name))
+    columns = list(zip(*[entries[name] for name in names])) or [()] * 4
+    index = {
+        'name': np.array(names, dtype=str),
+        'mtime': np.array(columns[0], dtype=np.int64),
+        'size': np.array(columns[1], dtype=np.int64),
+        'start': np.array(columns[2], dtype=float),
+        'end': np.array(columns[3], dtype=float),
+    }
+    if changed:
+        try:
+            handle, temporary_path = tempfile.mkstemp(
+                suffix='.tmp.npz', prefix=TIME_INDEX_FILENAME, dir=folder_path)
+        except OSError:
+            # Read-only capture, keep the index in memory
+            handle = None
+        if handle is not None:
+            replaced = False
+            try:
+                with os.fdopen(handle, 'wb') as index_file:
+                    np.savez(index_file, kind=kind, **index)
+                os.replace(temporary_path, index_path)
+                replaced = True
+            except OSError:
+                # Full or read-only disk, keep the index in memory
+                pass
+            finally:
+                # Also on any other exception, no temporary file is left
+                if not replaced:
+                    try:
+                        os.unlink(temporary_path)
+                    except OSError:
+                        pass
+    return {key: index[key] for key in ('name', 'start', 'end')}
+
+
+def indexed_files(folder_path, kind, time_range):
+    '''
+    Selects the files of a capture folder that hold data within a time
+    range, with a binary search in the time index of the folder.
+
+    Parameters:
+    - folder_path: str, the path to the folder containing the JSON files.
+    - kind: str, 'pose' or 'rtk', see time_index.
+    - time_range: [t0, t1], inclusive time range.
+
+    Returns:
+    - A list of file paths, ordered by their first timeStamp.
+    '''
+    start_time, end_time = time_range
+    index = time_index(folder_path, kind)
+    # Files starting after end_time can not overlap the range
+    stop = np.searchsorted(index['start'], end_time, side='right')
+    overlaps = index['end'][:stop] >= start_time
+    return [
+        os.path.join(folder_path, name)
+        for name in index['name'][:stop][overlaps]
+    ]
+
+
+def read_all_rtk_data(folder_path, time_range=None):
     '''
     Reads all RTK data JSON files in the specified folder, 
-    aggregates them into a list,
-    and sorts the list by their timeStamp.
+    aggregates every entry of their rtkData arrays into a list,
+    and sorts the list by their timeStamp. NMEA logs (NMEA_SUFFIXES) in the
+    folder are read as well, see iter_nmea_data.
     
     Parameters:
-    - folder_path: str, the path to the folder containing RTK JSON files.
+    - folder_path: str, the path to the folder containing RTK JSON files,
+    or to a folder inside a zip or tar archive, see read_all_pose, or the
+    path of a single NMEA log.
+    - time_range: [t0, t1], only read the RTK data within this time range,
+    the files are selected with the time index of the folder.
     
     Returns:
     - A sorted list of dictionaries, each containing properties 
@@ -180,17 +694,53 @@ def read_all_rtk_data(folder_path):
     '''
     rtk_data_list = []
 
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
-        if os.path.isfile(file_path) and filename.endswith('.json'):
-            rtk_data = read_rtk_data(file_path)
-            rtk_data_list.append(rtk_data)
+    rtk_data_list.extend(_iter_rtk_folder(folder_path, time_range))
+    if time_range is not None:
+        rtk_data_list = [
+            data_point for data_point in rtk_data_list
+            if time_range[0] <= data_point['timeStamp'] <= time_range[1]
+        ]
 
     rtk_data_sorted = sorted(rtk_data_list, key=lambda x: x['timeStamp'])
 
     return rtk_data_sorted
 
 
+def read_rtk_track(folder_path, time_range=None):
+    '''
+    Reads every RTK data entry of all RTK JSON files in the specified folder
+    straight into a columnar track sorted by timeStamp. Both one fix per file
+    and many fixes per file layouts are supported, as well as NMEA logs, see
+    iter_nmea_data.
+
+    Parameters:
+    - folder_path: str, the path to the folder containing RTK JSON files,
+    or to a folder inside a zip or tar archive, see read_all_pose, or the
+    path of a single NMEA log.
+    - time_range: [t0, t1], only read the RTK data within this time range,
+    the files are selected with the time index of the folder.
+
+    Returns:
+    - A dictionary of arrays, see rtk_data_to_track.
+    '''
+    columns = {key: [] for key in RTK_KEYS}
+    for data_point in _iter_rtk_folder(folder_path, time_range):
+        for key in RTK_KEYS:
+            columns[key].append(data_point[key])
+    track = sort_track(_columns_to_track(columns))
+    if time_range is not None:
+        track = slice_track(track, *time_range)
+    return track
+
+
+def sort_track(track, key='timeStamp'):
+    '''
+    Stable sorts all columns of a track by the given key.
+    '''
+    order = np.argsort(track[key], kind='stable')
+    return {name: column[order] for name, column in track.items()}
+
+
 def rtk_data_to_local(rtk_data, origin):
     '''
     Transfers a single RTK data point to the local coordinate system.
@@ -207,14 +757,9 @@ def rtk_data_to_local(rtk_data, origin):
     local_y = CartesianPosition[1]
     local_z = rtk_data['height']
     time_stamp = rtk_data['timeStamp']
-    variance_map = {
-        '单点解': 10.0,  # single
-        '码差分': 5.0,  # single_2
-        '固定解': 0.01,  # fixed
-        '浮点解': 1.0,  # float
-    }
     variance = variance_map.get(rtk_data['diffStatus'], 100.0)
-    is_bad_data = rtk_data['diffStatus'] not in ('固定解')
+    # Only fixed solutions are kept, an empty diffStatus is not one
+    is_bad_data = rtk_data['diffStatus'] != '固定解'
     rtk_local_data = {
         'timeStamp': time_stamp,
         'x': local_x,
@@ -228,6 +773,132 @@ def rtk_data_to_local(rtk_data, origin):
     return rtk_local_data
 
 
+def encode_diff_status(diff_statuses):
+    '''
+    Encodes diffStatus strings into categorical codes.
+
+    Parameters:
+    - diff_statuses: sequence of diffStatus strings.
+
+    Returns:
+    - A uint8 numpy array of codes, the index in DIFF_STATUSES or
+    DIFF_STATUS_UNKNOWN.
+    '''
+    if len(diff_statuses) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    # Only the few distinct strings are looked up, not every record
+    unique_statuses, inverse = np.unique(np.asarray(diff_statuses, dtype=str),
+                                         return_inverse=True)
+    unique_codes = np.array([
+        DIFF_STATUSES.index(status)
+        if status in DIFF_STATUSES else DIFF_STATUS_UNKNOWN
+        for status in unique_statuses
+    ],
+                            dtype=np.uint8)
+    return unique_codes[inverse.reshape(-1)]
+
+
+def decode_diff_status(codes):
+    '''
+    Decodes categorical diffStatus codes back into strings, unknown codes
+    are decoded as an empty string.
+    '''
+    names = np.array(list(DIFF_STATUSES) + [''])
+    return names[np.asarray(codes, dtype=np.intp)]
+
+
+def rtk_data_to_track(rtk_data):
+    '''
+    Converts a list of RTK data dictionaries into a columnar track.
+
+    Parameters:
+    - rtk_data: list of dictionaries as returned by read_rtk_data, or an
+    already columnar track which is returned unchanged.
+
+    Returns:
+    - A dictionary with one numpy array per RTK_KEYS entry, diffStatus is
+    stored as uint8 categorical codes.
+    '''
+    if isinstance(rtk_data, dict):
+        return rtk_data
+    return _columns_to_track(
+        {key: [datum[key] for datum in rtk_data]
+         for key in RTK_KEYS})
+
+
+def _columns_to_track(columns):
+    track = {
+        key: np.array(values, dtype=float)
+        for key, values in columns.items() if key != 'diffStatus'
+    }
+    track['fixStatus'] = track['fixStatus'].astype(np.int64)
+    track['diffStatus'] = encode_diff_status(columns['diffStatus'])
+    return track
+
+
+def track_to_records(track, keys=None):
+    '''
+    Converts a columnar track back into a list of dictionaries with Python
+    scalar values, the inverse of rtk_data_to_track.
+    '''
+    keys = list(track.keys()) if keys is None else keys
+    columns = [track[key].tolist() for key in keys]
+    return [dict(zip(keys, values)) for values in zip(*columns)]
+
+
+def transfer_rtk_track_to_local(rtk_track, origin):
+    '''
+    Transfers a columnar RTK track to the local coordinate system, keeping
+    only the fixed solutions. Records with an empty or unknown diffStatus,
+    such as NMEA fixes of unknown quality, are rejected as 'unknown'.
+
+    Parameters:
+    - rtk_track: dictionary of arrays, see rtk_data_to_track.
+    - origin: list of two floats, the WGS84 coordinates of the origin point.
+
+    Returns:
+    - A dictionary of arrays with the local coordinates (x, y, z), timeStamp,
+    variance, accuracies and diffStatus codes of the kept RTK data.
+    - A dictionary of diagnostics: the total, kept and rejected counts and the
+    rejected counts per diffStatus.
+    '''
+    codes = np.asarray(rtk_track['diffStatus'], dtype=np.uint8)
+    is_bad_data = codes != DIFF_STATUS_FIXED
+    keep = ~is_bad_data
+    latitude = np.asarray(rtk_track['latitude'], dtype=float)[keep]
+    longitude = np.asarray(rtk_track['longitude'], dtype=float)[keep]
+    if len(latitude):
+        east, north = wgs84_to_cartesian(origin, [latitude, longitude])
+    else:
+        east, north = np.zeros(0), np.zeros(0)
+    local_track = {
+        'timeStamp': np.asarray(rtk_track['timeStamp'], dtype=float)[keep],
+        'x': np.asarray(east, dtype=float).reshape(-1),
+        'y': np.asarray(north, dtype=float).reshape(-1),
+        'z': np.asarray(rtk_track['height'], dtype=float)[keep],
+        'variance': DIFF_STATUS_VARIANCES[codes[keep]],
+        'horizontalAccuracy': np.asarray(rtk_track['horizontalAccuracy'],
+                                         dtype=float)[keep],
+        'verticalAccuracy': np.asarray(rtk_track['verticalAccuracy'],
+                                       dtype=float)[keep],
+        'diffStatus': codes[keep],
+    }
+    counts = np.bincount(codes[is_bad_data], minlength=DIFF_STATUS_UNKNOWN + 1)
+    rejected_by_status = {
+        status: int(counts[code])
+        for code, status in enumerate(DIFF_STATUSES) if counts[code]
+    }
+    if counts[DIFF_STATUS_UNKNOWN]:
+        rejected_by_status['unknown'] = int(counts[DIFF_STATUS_UNKNOWN])
+    diagnostics = {
+        'total': int(len(codes)),
+        'kept': int(keep.sum()),
+        'rejected': int(is_bad_data.sum()),
+        'rejected_by_status': rejected_by_status,
+    }
+    return local_track, diagnostics
+
+
 def transfer_all_rtk_data_to_local(rtk_data, origin):
     '''
     Transfers all RTK data to the local coordinate system.
@@ -241,17 +912,14 @@ def transfer_all_rtk_data_to_local(rtk_data, origin):
     - A list of dictionaries, each containing the local RTK data coordinates
     and timestamp.
     '''
-    local_rtk_data = []
-
-    # Iterate through each RTK data point in the list
-    for data_point in rtk_data:
-        # Convert the RTK data to the local coordinate system
-        local_data_point = rtk_data_to_local(data_point, origin)
-        if local_data_point['is_bad_data']:
-            continue
-        # Append the local RTK data to the list
-        local_rtk_data.append(local_data_point)
-
+    local_track, _ = transfer_rtk_track_to_local(rtk_data_to_track(rtk_data),
+                                                 origin)
+    local_rtk_data = track_to_records(local_track, [
+        'timeStamp', 'x', 'y', 'z', 'variance', 'horizontalAccuracy',
+        'verticalAccuracy'
+    ])
+    for local_data_point in local_rtk_data:
+        local_data_point['is_bad_data'] = False
     return local_rtk_data
 
 
@@ -262,43 +930,210 @@ def find_rtk_data_origin(rtk_data):
 
     Parameters:
     - rtk_data: list of dictionaries, each dictionary contains 
-    properties of an RTK data point.
+    properties of an RTK data point, or a columnar track.
 
     Returns:
     - A list of two floats, the WGS84 coordinates of the origin point.
     '''
     #NOTICE the origin does not contain the height information, what is the height coordinate  ?
     # coordinate is WGS84 height or the height from the ground?
-    lowest_accuracy = float('inf')
-    origin = [0, 0]
-    for data_datum in rtk_data:
-        if data_datum['diffStatus'] == '固定解':
-            return [data_datum['latitude'], data_datum['longitude']]
-        current_accuracy = max(data_datum['horizontalAccuracy'],
-                               data_datum['verticalAccuracy'])
-        if current_accuracy < lowest_accuracy:
-            origin = [data_datum['latitude'], data_datum['longitude']]
-            lowest_accuracy = current_accuracy
-    return origin
+    rtk_track = rtk_data_to_track(rtk_data)
+    codes = np.asarray(rtk_track['diffStatus'])
+    if len(codes) == 0:
+        return [0, 0]
+    is_fixed = codes == DIFF_STATUS_FIXED
+    if is_fixed.any():
+        index = int(np.argmax(is_fixed))
+    else:
+        accuracy = np.maximum(rtk_track['horizontalAccuracy'],
+                              rtk_track['verticalAccuracy'])
+        if not (accuracy < float('inf')).any():
+            return [0, 0]
+        index = int(np.argmin(accuracy))
+    return [
+        float(rtk_track['latitude'][index]),
+        float(rtk_track['longitude'][index])
+    ]
+
+
+def compact_track(track):
+    '''
+    Converts a local pose or RTK track to the compact layout: local positions
+    and accuracies as float32, timeStamp as float64 and diffStatus as uint8
+    codes. Local positions stay within a few kilometers of the origin, where
+    float32 keeps sub-millimeter resolution; the aligners convert the columns
+    back to float64 before accumulating. Not meant for raw tracks, whose
+    latitude and longitude need float64.
 
+    The loaders convert the track once it is loaded, so the compact layout
+    shrinks the resident size of the loaded tracks (and of their shared
+    memory), not the peak memory of parsing the files.
 
-def load_rtk_data(rtk_data_folder):
+    Parameters:
+    - track: dictionary of arrays of a local track.
+
+    Returns:
+    - A dictionary of arrays, columns other than COMPACT_KEYS are unchanged.
+    '''
+    compact = {}
+    for key, column in track.items():
+        if key in COMPACT_KEYS:
+            column = np.asarray(column, dtype=np.float32)
+        elif key == 'timeStamp':
+            column = np.asarray(column, dtype=np.float64)
+        elif key == 'diffStatus':
+            column = np.asarray(column, dtype=np.uint8)
+        compact[key] = column
+    return compact
+
+
+def load_rtk_track(rtk_data_folder, compact=False, time_range=None):
+    '''
+    Loading all rtk data from the rtk data folder into a columnar track in
+    the local coordinate system.
+
+    Parameters:
+    - rtk_data_folder: path of the folder containing the RTK data, JSON
+    files or NMEA logs, or of a single NMEA log, see read_rtk_track.
+    - compact: store the track in the compact float32 layout, see
+    compact_track. The files are still parsed in float64.
+    - time_range: [t0, t1], only load the RTK data within this time range,
+    see read_rtk_track. The origin is then selected within the range.
+
+    Returns:
+    - The local RTK track, see transfer_rtk_track_to_local.
+    - The origin, a list of two floats.
+    - The diagnostics of the rejected RTK data.
+    '''
+    rtk_track = read_rtk_track(rtk_data_folder, time_range)
+    origin = find_rtk_data_origin(rtk_track)
+    local_track, diagnostics = transfer_rtk_track_to_local(rtk_track, origin)
+    if compact:
+        local_track = compact_track(local_track)
+    return local_track, origin, diagnostics
+
+
+def load_rtk_data(rtk_data_folder, time_range=None):
     '''
     Loading all rtk data from the rtk data folder, and transfer them
-    to the local coordinate system.
+    to the local coordinate system. With a time_range only the RTK data
+    within [t0, t1] are loaded, see read_all_rtk_data. The folder may hold
+    NMEA logs, or be a single NMEA log.
 
     '''
-    rtk_data = read_all_rtk_data(rtk_data_folder)
+    rtk_data = read_all_rtk_data(rtk_data_folder, time_range)
     origin = find_rtk_data_origin(rtk_data)
     local_rtk_data = transfer_all_rtk_data_to_local(rtk_data, origin)
     return local_rtk_data, origin
 
 
-def load_poses(pose_folder):
+def load_poses(pose_folder, time_range=None):
     '''
     Loading all poses from the pose folder, and transfer them
-    to the local coordinate system.
+    to the local coordinate system. With a time_range only the poses within
+    [t0, t1] are loaded, see read_all_pose.
     '''
-    poses = read_all_pose(pose_folder)
+    poses = read_all_pose(pose_folder, time_range)
     local_poses = transfer_all_pose_to_local(poses)
     return local_poses
+
+
+def load_capture_archive(archive_path,
+                         rtk_name='rtk',
+                         pose_name='cameras',
+                         workers=None):
+    '''
+    Loading the poses and the rtk data of a capture archive, like load_poses
+    and load_rtk_data on the extracted folders. Tar archives are read once,
+    the folders are located and their members parsed in the same pass, see
+    map_archive_folders.
+
+    Parameters:
+    - archive_path: path of the zip or tar file.
+    - rtk_name: name of the RTK folder, the shallowest one is used.
+    - pose_name: name of the pose folder, the shallowest one is used.
+    - workers: number of worker processes parsing zip archives, see
+    map_archive_files.
+
+    Returns:
+    - The local poses, see load_poses.
+    - The local RTK data and the origin, see load_rtk_data.
+    '''
+    results = map_archive_folders(
+        archive_path, {
+            pose_name: (_read_pose_member, '.json'),
+            rtk_name: (_read_rtk_member, _data_suffixes('rtk'))
+        }, workers)
+    poses = sorted(results[pose_name], key=lambda x: x['timeStamp'])
+    rtk_data = sorted(
+        (data_point for data_points in results[rtk_name]
+         for data_point in data_points),
+        key=lambda x: x['timeStamp'])
+    origin = find_rtk_data_origin(rtk_data)
+    return (transfer_all_pose_to_local(poses),
+            transfer_all_rtk_data_to_local(rtk_data, origin), origin)
+
+
+def pose_quaternions(poses):
+    '''
+    Converts the rotation part of the homogeneous matrices of the poses into
+    unit quaternions, all at once.
+
+    Parameters:
+    - poses: list of dictionaries, see read_pose.
+
+    Returns:
+    - An (N, 4) array of quaternions in scalar-last (x, y, z, w) order, the
+    order of scipy and of to_geoJson.
+    '''
+    if not poses:
+        return np.zeros((0, 4))
+    matrices = np.stack([pose['matrix'][:3, :3] for pose in poses])
+    return Rotation.from_matrix(matrices).as_quat()
+
+
+def load_pose_track(pose_folder,
+                    compact=False,
+                    orientation=False,
+                    time_range=None):
+    '''
+    Loading all poses from the pose folder into a columnar track in the
+    local coordinate system.
+
+    Parameters:
+    - pose_folder: path of the folder containing the pose data.
+    - compact: store the track in the compact float32 layout, see
+    compact_track. The positions are copied out of the parsed poses as
+    float32 directly.
+    - orientation: also store the camera orientations as an (N, 4)
+    quaternion column, see pose_quaternions.
+    - time_range: [t0, t1], only load the poses within this time range, see
+    read_all_pose.
+
+    Returns:
+    - A dictionary with the timeStamp, x, y and z arrays, sorted by timeStamp,
+    and the quaternion array if requested.
+    '''
+    poses = read_all_pose(pose_folder, time_range)
+    local_poses = transfer_all_pose_to_local(poses)
+    track = {
+        key: np.array([pose[key] for pose in local_poses],
+                      dtype=np.float32
+                      if compact and key in COMPACT_KEYS else float)
+        for key in ('timeStamp', 'x', 'y', 'z')
+    }
+    if orientation:
+        # Both lists are stably sorted by timeStamp, the rows correspond
+        track['quaternion'] = pose_quaternions(poses)
+    return compact_track(track) if compact else track
+
+
+def slice_track(track, start_time, end_time):
+    '''
+    Selects the rows of a track sorted by timeStamp within
+    [start_time, end_time] with a binary search, the columns are views.
+    '''
+    time_stamps = track['timeStamp']
+    start = np.searchsorted(time_stamps, start_time, side='left')
+    end = np.searchsorted(time_stamps, end_time, side='right')
+    return {key: column[start:end] for key, column in track.items()}
@@ -0,0 +1,249 @@
+import hashlib
+import math
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .align import Y_UP_TO_Z_UP, _track_array, _check_mode
+from .align import aligner_SVD_3D, aligner_yaw_3D, associate_shifts
+from .align import residual_diagnostics, estimate_time_shift
+from .align import feasible_time_shift_interval
+
+ICP_INITS = ('yaw', 'time')
+# KD-trees of the most recently used RTK tracks
+TREE_CACHE_SIZE = 4
+# Candidates of the 'yaw' initialization: yaw angles times RTK positions
+SEED_YAWS = 12
+SEED_POSITIONS = 16
+SEED_POINTS = 200
+SEED_ITERATIONS = 8
+
+_tree_cache = OrderedDict()
+
+
+def rtk_tree(rtk_data):
+    '''
+    Returns the KD-tree over the local RTK positions. The tree is built once
+    per RTK track and kept in a small cache keyed by a hash of the positions,
+    so ICP iterations and sessions sharing the same RTK data reuse it.
+
+    Args:
+        rtk_data (list or dict): RTK data in the local coordinate system.
+
+    Returns:
+        SimpleNamespace: The cKDTree (tree), the (M, 3) positions and the
+        (M, 3) variances of the RTK data.
+    '''
+    positions = _track_array(rtk_data, ['x', 'y', 'z'])
+    key = hashlib.blake2b(positions.tobytes(), digest_size=16).digest()
+    cached = _tree_cache.get(key)
+    if cached is None:
+        cached = SimpleNamespace(
+            tree=cKDTree(positions),
+            positions=positions,
+            variances=_track_array(
+                rtk_data,
+                ['variance', 'verticalAccuracy', 'horizontalAccuracy']))
+        _tree_cache[key] = cached
+        while len(_tree_cache) > TREE_CACHE_SIZE:
+            _tree_cache.popitem(last=False)
+    else:
+        _tree_cache.move_to_end(key)
+    return cached
+
+
+def _subsample(points, max_points):
+    if len(points) <= max_points:
+        return points
+    return points[np.linspace(0, len(points) - 1, max_points).astype(int)]
+
+
+def _yaw_matrices(yaw):
+    R = np.zeros(np.shape(yaw) + (3, 3))
+    R[..., 0, 0] = R[..., 1, 1] = np.cos(yaw)
+    R[..., 1, 0] = np.sin(yaw)
+    R[..., 0, 1] = -R[..., 1, 0]
+    R[..., 2, 2] = 1.0
+    return R
+
+
+def _yaw_batch(sources, targets, weights):
+    '''
+    Closed-form yaw plus translation alignment of C candidates at once.
+
+    Args:
+        sources (numpy.ndarray): (C, n, 3) points.
+        targets (numpy.ndarray): (C, n, 3) matched points.
+        weights (numpy.ndarray): (C, n) 0/1 weights of the kept matches.
+
+    Returns:
+        tuple: (C, 3, 3) rotation matrices and (C, 3) translation vectors.
+    '''
+    count = np.maximum(weights.sum(axis=1), 1.0)[:, None]
+    source_mean = np.einsum('cn,cnk->ck', weights, sources) / count
+    target_mean = np.einsum('cn,cnk->ck', weights, targets) / count
+    p = sources - source_mean[:, None]
+    q = targets - target_mean[:, None]
+    Sigma = np.einsum('cn,cni,cnj->cij', weights, q, p)
+    yaw = np.arctan2(Sigma[:, 1, 0] - Sigma[:, 0, 1],
+                     Sigma[:, 0, 0] + Sigma[:, 1, 1])
+    R = _yaw_matrices(yaw)
+    t = target_mean - np.einsum('cij,cj->ci', R, source_mean)
+    return R, t
+
+
+def _match(rtk, sources, R, t, trim):
+    '''
+    Matches the transformed sources with their nearest RTK positions in one
+    vectorized query and keeps the trim fraction of closest matches.
+
+    Returns:
+        tuple: The distances, the RTK indices and the boolean mask of the
+        kept matches, shaped like the sources without the last axis.
+    '''
+    moved = np.einsum('...ij,...nj->...ni', R, sources) + t[..., None, :]
+    distances, indices = rtk.tree.query(moved)
+    limit = np.quantile(distances, trim, axis=-1, keepdims=True)
+    return distances, indices, distances <= limit
+
+
+def _yaw_seeds(rtk, sources, trim):
+    '''
+    Tries every yaw in SEED_YAWS steps with the pose centroid placed on the
+    RTK centroid and on SEED_POSITIONS RTK positions, runs a few ICP
+    iterations of all candidates at once and returns the best (R, t).
+    '''
+    sources = _subsample(sources, SEED_POINTS)
+    centers = np.vstack([
+        rtk.positions.mean(axis=0),
+        _subsample(rtk.positions, SEED_POSITIONS)
+    ])
+    yaw = np.arange(SEED_YAWS) * 2 * np.pi / SEED_YAWS
+    R = np.repeat(_yaw_matrices(yaw), len(centers), axis=0)
+    t = np.tile(centers, (SEED_YAWS, 1)) - R @ sources.mean(axis=0)
+    candidates = np.broadcast_to(sources, (len(R), ) + sources.shape)
+    for _ in range(SEED_ITERATIONS):
+        _, indices, keep = _match(rtk, candidates, R, t, trim)
+        R, t = _yaw_batch(candidates, rtk.positions[indices],
+                          keep.astype(float))
+    distances, _, keep = _match(rtk, candidates, R, t, trim)
+    costs = np.sqrt(np.sum(np.where(keep, distances**2, 0.0), axis=1) /
+                    keep.sum(axis=1))
+    best = int(np.argmin(costs))
+    return R[best], t[best]
+
+
+def _time_seed(pose_data, rtk_data):
+    '''
+    Aligns yaw and translation at the time shift of the speed correlation,
+    which only relies on the relative timing of both tracks.
+    '''
+    interval = feasible_time_shift_interval(pose_data, rtk_data)
+    if interval is None:
+        return None
+    time_shift = estimate_time_shift(pose_data, rtk_data, interval)
+    if time_shift is None:
+        return None
+    poses, rtk_datas, mask, _ = associate_shifts(pose_data, rtk_data,
+                                                 [time_shift])
+    if mask[0].sum() < 2:
+        return None
+    R, t, _ = aligner_yaw_3D(poses[0][mask[0]], rtk_datas[mask[0]])
+    return R, t
+
+
+def icp_align(pose_data,
+              rtk_data,
+              mode='yaw',
+              init='yaw',
+              max_iterations=50,
+              tolerance=1e-6,
+              max_points=1000,
+              trim=0.8,
+              return_diagnostics=False):
+    '''
+    Aligns the poses with the RTK data by spatial registration, without using
+    the timestamps to pair them (point-to-point ICP).
+
+    Every iteration matches the subsampled poses with their nearest RTK
+    positions in one vectorized KD-tree query (see `rtk_tree`), keeps the
+    trim fraction of closest matches and solves the rigid transform in closed
+    form. Captures that are nearly straight lines leave the transform poorly
+    determined along the line.
+
+    Args:
+        pose_data (list or dict): Pose data.
+        rtk_data (list or dict): RTK data in the local coordinate system.
+        mode (str, optional): Aligner mode, 'yaw' (gravity-aligned AR poses)
+            or '3d'. Defaults to 'yaw'.
+        init (str or tuple, optional): Initial transform, 'yaw' to search
+            yaw angles and positions along the RTK track, 'time' to align at
+            the time shift of `estimate_time_shift` (falls back to 'yaw'), or
+            an (R, t) tuple. Defaults to 'yaw'.
+        max_iterations (int, optional): Maximum number of ICP iterations.
+        tolerance (float, optional): Stop once the RMS distance improves by
+            less than this, in meters. An iteration that makes it worse is
+            undone and also stops the ICP, without converging.
+        max_points (int, optional): Number of poses the ICP is run on.
+        trim (float, optional): Fraction of the closest matches kept in every
+            iteration, rejects the poses outside the RTK track.
+        return_diagnostics (bool, optional): Also return the diagnostics, the
+            residuals of the kept matches (see `residual_diagnostics`), the
+            number of solved iterations and whether the ICP converged.
+
+    Returns:
+        tuple: A tuple containing the rotation matrix (R), translation vector (t), and alignment error
+        (mean distance of the kept matches), followed by the diagnostics if
+        requested. R, t and error are None when there are fewer than 3 poses
+        or RTK data points.
+    '''
+    _check_mode(mode)
+    sources = _track_array(pose_data, ['x', 'y', 'z']) @ Y_UP_TO_Z_UP.T
+    if len(sources) < 3 or len(_track_array(rtk_data, ['timeStamp'])) < 3:
+        return (None, None, None) + ((None, ) if return_diagnostics else ())
+    rtk = rtk_tree(rtk_data)
+    if isinstance(init, str):
+        if init not in ICP_INITS:
+            raise ValueError("Unknown init {!r}, expected one of {}".format(
+                init, ICP_INITS))
+        seed = _time_seed(pose_data, rtk_data) if init == 'time' else None
+        if seed is None:
+            seed = _yaw_seeds(rtk, sources, trim)
+    else:
+        seed = init
+    R, t = (np.asarray(value, dtype=float) for value in seed)
+    solve = aligner_yaw_3D if mode == 'yaw' else aligner_SVD_3D
+
+    sources = _subsample(sources, max_points)
+    distances, indices, keep = _match(rtk, sources, R, t, trim)
+    rmse = math.sqrt(np.mean(distances[keep]**2))
+    converged = False
+    iteration = 0
+    while iteration < max_iterations:
+        iteration += 1
+        next_R, next_t, _ = solve(sources[keep], rtk.positions[indices[keep]])
+        if next_R is None:
+            # Too few kept matches to solve, e.g. with a small trim
+            break
+        match = _match(rtk, sources, next_R, next_t, trim)
+        next_rmse = math.sqrt(np.mean(match[0][match[2]]**2))
+        if next_rmse > rmse:
+            # The matches got worse, the last improving transform is kept
+            break
+        improvement = rmse - next_rmse
+        R, t, rmse = next_R, next_t, next_rmse
+        distances, indices, keep = match
+        if improvement < tolerance:
+            converged = True
+            break
+    residuals = rtk.positions[indices[keep]] - (sources[keep] @ R.T + t)
+    error = np.mean(np.linalg.norm(residuals, axis=1))
+    if return_diagnostics:
+        diagnostics = residual_diagnostics(residuals,
+                                           rtk.variances[indices[keep]])
+        diagnostics.iterations = iteration
+        diagnostics.converged = converged
+        return R, t, error, diagnostics
+    return R, t, error
@@ -0,0 +1,337 @@
+import os
+import time
+
+import numpy as np
+
+from .align import coarse_to_fine_align
+from .data_preprocessing import read_pose, pose_to_local, iter_rtk_data
+from .data_preprocessing import rtk_data_to_track, find_rtk_data_origin
+from .data_preprocessing import transfer_rtk_track_to_local, sort_track
+from .data_preprocessing import COMPACT_KEYS
+
+POSE_KEYS = ('timeStamp', 'x', 'y', 'z')
+LOCAL_RTK_KEYS = ('timeStamp', 'x', 'y', 'z', 'variance', 'horizontalAccuracy',
+                  'verticalAccuracy', 'diffStatus')
+
+
+class TrackBuffer:
+    '''
+    A growable columnar track kept sorted by timeStamp.
+
+    Rows are stored in preallocated arrays whose capacity doubles when full,
+    so appending samples that are later than everything already stored costs
+    amortized O(new). Samples that arrive out of order only re-sort the tail
+    of the track they overlap with, rows of many files should therefore be
+    merged in one call.
+    '''
+
+    def __init__(self, dtypes, initial_capacity=1024):
+        '''
+        Args:
+            dtypes (dict): numpy dtype per column, must contain 'timeStamp'.
+            initial_capacity (int, optional): Number of preallocated rows.
+        '''
+        self._dtypes = dict(dtypes)
+        self._dtypes['source'] = np.int64
+        self._columns = {
+            key: np.empty(initial_capacity, dtype=dtype)
+            for key, dtype in self._dtypes.items()
+        }
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, size):
+        capacity = len(self._columns['timeStamp'])
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for key, column in self._columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            self._columns[key] = grown
+
+    def extend(self, columns, source):
+        '''
+        Merges new rows into the track.
+
+        Args:
+            columns (dict): Equally long arrays for every column.
+            source (int or numpy.ndarray): Identifier of the file the rows come
+                from, used by `remove_source`, or one identifier per row.
+        '''
+        time_stamps = np.asarray(columns['timeStamp'], dtype=float)
+        n_new = len(time_stamps)
+        if n_new == 0:
+            return
+        order = np.argsort(time_stamps, kind='stable')
+        new_columns = {
+            key: np.asarray(columns[key])[order]
+            for key in self._dtypes if key != 'source'
+        }
+        new_columns['source'] = np.broadcast_to(
+            np.asarray(source, dtype=np.int64), (n_new, ))[order]
+        self._reserve(self._size + n_new)
+        current = self._columns['timeStamp'][:self._size]
+        # Rows from the insertion point on have to be merged with the new ones
+        start = int(np.searchsorted(current, new_columns['timeStamp'][0],
+                                    side='right'))
+        tail_order = np.argsort(np.concatenate(
+            [current[start:], new_columns['timeStamp']]),
+                                kind='stable')
+        end = self._size + n_new
+        for key, column in self._columns.items():
+            tail = np.concatenate([column[start:self._size], new_columns[key]])
+            column[start:end] = tail[tail_order]
+        self._size = end
+
+    def remove_source(self, source):
+        '''
+        Removes all rows that came from the given source, or from any of a
+        list of sources.
+        '''
+        keep = ~np.isin(self._columns['source'][:self._size], source)
+        n_keep = int(keep.sum())
+        for key, column in self._columns.items():
+            column[:n_keep] = column[:self._size][keep]
+        self._size = n_keep
+
+    def to_track(self):
+        '''
+        Returns:
+            dict: Copies of the filled part of every column, without the
+            internal 'source' column. Later merges and removals reorder the
+            internal arrays in place, so they are never handed out.
+        '''
+        return {
+            key: column[:self._size].copy()
+            for key, column in self._columns.items() if key != 'source'
+        }
+
+
+def _read_pose_columns(file_path):
+    local_pose = pose_to_local(read_pose(file_path))
+    return {key: [local_pose[key]] for key in POSE_KEYS}
+
+
+def _read_rtk_columns(file_path):
+    return rtk_data_to_track(list(iter_rtk_data(file_path)))
+
+
+class CaptureIngestor:
+    '''
+    Incremental ingestion of an append-only capture, a camera pose folder and
+    an RTK folder that keep growing while the capture is running.
+
+    Every `refresh` scans both folders with os.scandir and parses only the
+    files it has not parsed before, then merges their samples into sorted
+    columnar tracks. Files that can not be parsed yet (e.g. still being
+    written) are retried on the next refresh.
+
+    Listing a folder is a cheap name lookup per file; only new files are
+    stat-ed and parsed, so a refresh costs time proportional to the delta.
+
+    The RTK origin is selected like `load_rtk_data` from the first refresh
+    that finds RTK data and then kept, so local coordinates stay stable
+    across refreshes.
+    '''
+
+    def __init__(self,
+                 pose_folder,
+                 rtk_folder,
+                 check_modified=False,
+                 compact=False):
+        '''
+        Args:
+            pose_folder (str): The path to the folder containing the pose data.
+            rtk_folder (str): The path to the folder containing the RTK data.
+            check_modified (bool, optional): Also stat files that were already
+                parsed and re-parse them when their mtime or size changed.
+                Costs one stat per known file on every refresh. Defaults to False.
+            compact (bool, optional): Store positions and accuracies as
+                float32, see `compact_track`. Defaults to False.
+        '''
+        self.pose_folder = pose_folder
+        self.rtk_folder = rtk_folder
+        self.check_modified = check_modified
+        self.origin = None
+        self._pose_files = {}
+        self._rtk_files = {}
+        self._sources = {}
+        position_dtype = np.float32 if compact else np.float64
+        self._poses = TrackBuffer({
+            key: position_dtype if key in COMPACT_KEYS else np.float64
+            for key in POSE_KEYS
+        })
+        rtk_dtypes = {
+            key: position_dtype if key in COMPACT_KEYS else np.float64
+            for key in LOCAL_RTK_KEYS
+        }
+        rtk_dtypes['diffStatus'] = np.uint8
+        self._rtk = TrackBuffer(rtk_dtypes)
+        # Rejection diagnostics of every parsed RTK file
+        self._rtk_diagnostics = {}
+        self.diagnostics = {
+            'total': 0,
+            'kept': 0,
+            'rejected': 0,
+            'rejected_by_status': {}
+        }
+
+    def _source(self, file_path):
+        return self._sources.setdefault(file_path, len(self._sources))
+
+    def _scan(self, folder, known_files):
+        '''
+        Returns the (path, signature) of the JSON files that are new or, with
+        check_modified, changed since they were parsed.
+        '''
+        changed = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                known = entry.path in known_files
+                if known and not self.check_modified:
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if known_files.get(entry.path) != signature:
+                    changed.append((entry.path, signature))
+        return changed
+
+    def _parse(self, folder, known_files, read_columns):
+        '''
+        Parses the new or changed files of a folder.
+
+        Returns:
+            list: (path, signature, columns) of every parsed file.
+        '''
+        parsed = []
+        for file_path, signature in self._scan(folder, known_files):
+            try:
+                columns = read_columns(file_path)
+            except (ValueError, KeyError, OSError):
+                # Incomplete file, retry on the next refresh
+                continue
+            parsed.append((file_path, signature, columns))
+        return parsed
+
+    def _commit(self, parsed, known_files, buffer):
+        if not parsed:
+            return 0
+        replaced = [
+            self._source(file_path) for file_path, _, _ in parsed
+            if file_path in known_files
+        ]
+        if replaced:
+            buffer.remove_source(replaced)
+        # The files of a refresh come in directory order, merging them one by
+        # one would re-sort the buffer tail for every file
+        sources = np.concatenate([
+            np.full(len(columns['timeStamp']), self._source(file_path),
+                    dtype=np.int64) for file_path, _, columns in parsed
+        ])
+        buffer.extend(
+            {
+                key: np.concatenate(
+                    [np.asarray(columns[key]) for _, _, columns in parsed])
+                for key in parsed[0][2]
+            }, sources)
+        for file_path, signature, _ in parsed:
+            known_files[file_path] = signature
+        return len(sources)
+
+    def _rtk_to_local(self, parsed):
+        if self.origin is None and parsed:
+            # Select the origin like load_rtk_data over the first batch
+            first_batch = {
+                key: np.concatenate([columns[key] for _, _, columns in parsed])
+                for key in parsed[0][2]
+            }
+            if len(first_batch['timeStamp']):
+                self.origin = find_rtk_data_origin(sort_track(first_batch))
+        local_parsed = []
+        for file_path, signature, rtk_track in parsed:
+            local_track, diagnostics = transfer_rtk_track_to_local(
+                rtk_track, self.origin)
+            # A re-parsed file replaces its previous contribution
+            previous = self._rtk_diagnostics.get(file_path)
+            if previous is not None:
+                self._add_diagnostics(previous, -1)
+            self._add_diagnostics(diagnostics, 1)
+            self._rtk_diagnostics[file_path] = diagnostics
+            local_parsed.append((file_path, signature, local_track))
+        return local_parsed
+
+    def _add_diagnostics(self, diagnostics, sign):
+        for key in ('total', 'kept', 'rejected'):
+            self.diagnostics[key] += sign * diagnostics[key]
+        rejected_by_status = self.diagnostics['rejected_by_status']
+        for status, count in diagnostics['rejected_by_status'].items():
+            rejected_by_status[status] = rejected_by_status.get(
+                status, 0) + sign * count
+            if rejected_by_status[status] == 0:
+                del rejected_by_status[status]
+
+    def refresh(self):
+        '''
+        Parses the files added since the last refresh.
+
+        Returns:
+            dict: Number of new samples under 'poses' and 'rtk'.
+        '''
+        parsed_poses = self._parse(self.pose_folder, self._pose_files,
+                                   _read_pose_columns)
+        parsed_rtk = self._parse(self.rtk_folder, self._rtk_files,
+                                 _read_rtk_columns)
+        return {
+            'poses': self._commit(parsed_poses, self._pose_files, self._poses),
+            'rtk': self._commit(self._rtk_to_local(parsed_rtk),
+                                self._rtk_files, self._rtk),
+        }
+
+    def poll(self, timeout=None, interval=0.5):
+        '''
+        Refreshes until new samples arrive or the timeout expires, a simple
+        portable stand-in for inotify style notifications.
+
+        Args:
+            timeout (float, optional): Maximum waiting time in seconds, None
+                to wait forever.
+            interval (float, optional): Seconds between two refreshes.
+
+        Returns:
+            dict: Number of new samples, see `refresh`.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            counts = self.refresh()
+            if counts['poses'] or counts['rtk']:
+                return counts
+            if deadline is not None and time.monotonic() >= deadline:
+                return counts
+            time.sleep(interval)
+
+    @property
+    def poses(self):
+        '''The local pose track ingested so far, a dictionary of arrays.'''
+        return self._poses.to_track()
+
+    @property
+    def rtk_data(self):
+        '''The local RTK track ingested so far, a dictionary of arrays.'''
+        return self._rtk.to_track()
+
+    def align(self, **kwargs):
+        '''
+        Aligns the samples ingested so far, keyword arguments are passed to
+        `coarse_to_fine_align`.
+
+        Returns:
+            tuple: A tuple containing the rotation matrix (R), translation vector (t), and alignment error.
+        '''
+        return coarse_to_fine_align(self.poses, self.rtk_data, **kwargs)
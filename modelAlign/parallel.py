@@ -0,0 +1,176 @@
+import sys
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Column offsets inside a shared block are aligned for every dtype
+_ALIGNMENT = 64
+
+
+class SharedTracks:
+    '''
+    Places columnar tracks (dictionaries of numpy arrays) in shared memory.
+
+    Used as a context manager, it copies every track once into its own
+    shared memory block and exposes a small picklable `handle`. Workers call
+    `attach_tracks(handle)` to get numpy views of the same memory without any
+    copy or unpickling. The blocks are unlinked when the context exits, also
+    when it exits with an exception.
+    '''
+
+    def __init__(self, tracks):
+        '''
+        Args:
+            tracks (dict): Track name to track, a dictionary of numpy arrays.
+        '''
+        self.tracks = tracks
+        self.handle = None
+        self._blocks = []
+
+    def __enter__(self):
+        try:
+            self.handle = {
+                name: self._share(track)
+                for name, track in self.tracks.items()
+            }
+        except BaseException:
+            self.close()
+            raise
+        return self.handle
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _share(self, track):
+        columns = []
+        offset = 0
+        for key, column in track.items():
+            column = np.ascontiguousarray(column)
+            columns.append((key, column.dtype.str, column.shape, offset))
+            offset += -(-column.nbytes // _ALIGNMENT) * _ALIGNMENT
+        block = SharedMemory(create=True, size=max(offset, 1))
+        self._blocks.append(block)
+        tracker = _tracker_pid()
+        for key, dtype, shape, column_offset in columns:
+            view = np.ndarray(shape,
+                              dtype=dtype,
+                              buffer=block.buf,
+                              offset=column_offset)
+            view[...] = track[key]
+            del view
+        return {'name': block.name, 'columns': columns, 'tracker': tracker}
+
+    def close(self):
+        '''Releases and unlinks all shared memory blocks.'''
+        while self._blocks:
+            block = self._blocks.pop()
+            try:
+                block.close()
+            finally:
+                block.unlink()
+
+
+def _tracker_pid():
+    return getattr(resource_tracker._resource_tracker, '_pid', None)
+
+
+def _open_shared_memory(shared):
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=shared['name'], track=False)
+    block = SharedMemory(name=shared['name'])
+    # Attaching registers the block with the resource tracker. Workers forked
+    # before the creating process started its tracker run their own, which
+    # would unlink the block when the worker exits; the creating process owns
+    # it. The tracker shared with the creator must keep its registration.
+    if _tracker_pid() != shared['tracker']:
+        resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+@contextmanager
+def attach_tracks(handle):
+    '''
+    Attaches to the tracks of a `SharedTracks` handle without copying.
+
+    Args:
+        handle (dict): The handle of a `SharedTracks` context.
+
+    Yields:
+        dict: Track name to track, the arrays are read-only views of the
+        shared memory and must not be used after the context exits.
+    '''
+    blocks = []
+    tracks = {}
+    try:
+        for name, shared in handle.items():
+            block = _open_shared_memory(shared)
+            blocks.append(block)
+            track = {}
+            for key, dtype, shape, offset in shared['columns']:
+                column = np.ndarray(shape,
+                                    dtype=dtype,
+                                    buffer=block.buf,
+                                    offset=offset)
+                column.flags.writeable = False
+                track[key] = column
+            tracks[name] = track
+        yield tracks
+    finally:
+        tracks.clear()
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                # A view is still referenced, the mapping is released with it
+                pass
+
+
+def _call_attached(function, handle, args):
+    with attach_tracks(handle) as tracks:
+        return function(tracks, *args)
+
+
+def map_shared(function, tracks, args_list, workers=None, executor=None):
+    '''
+    Runs function(tracks, *args) for every args in a process pool, the tracks
+    are passed to the workers through shared memory instead of being pickled.
+    The pool is created for the call, unless one is supplied.
+
+    Args:
+        function (callable): Picklable function, its results must not keep
+            references to the track arrays.
+        tracks (dict): Track name to track, see `SharedTracks`.
+        args_list (list): Extra arguments of every call.
+        workers (int, optional): Number of worker processes of the created
+            pool, None for the number of CPUs.
+        executor (concurrent.futures.Executor, optional): Pool of worker
+            processes to run the calls in, e.g. one kept by the caller across
+            calls. It is not shut down.
+
+    Returns:
+        list: The results in the order of args_list.
+    '''
+    with SharedTracks(tracks) as handle:
+        if executor is not None:
+            return _run_attached(executor, function, handle, args_list)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return _run_attached(executor, function, handle, args_list)
+
+
+def _run_attached(executor, function, handle, args_list):
+    futures = [
+        executor.submit(_call_attached, function, handle, tuple(args))
+        for args in args_list
+    ]
+    try:
+        return [future.result() for future in futures]
+    except BaseException:
+        # The blocks are unlinked next, no call may still be reading them
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        raise
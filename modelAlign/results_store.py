@@ -0,0 +1,267 @@
+import json
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from .sqlite_store import SQLiteStore
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS alignments (
+    id INTEGER PRIMARY KEY,
+    capture TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    mode TEXT,
+    error REAL,
+    time_shift REAL,
+    qx REAL, qy REAL, qz REAL, qw REAL,
+    tx REAL, ty REAL, tz REAL,
+    latitude REAL, longitude REAL,
+    fingerprint TEXT,
+    diagnostics TEXT
+);
+CREATE INDEX IF NOT EXISTS alignments_capture
+    ON alignments (capture, created_at);
+CREATE INDEX IF NOT EXISTS alignments_created_at ON alignments (created_at);
+CREATE INDEX IF NOT EXISTS alignments_error ON alignments (error);
+CREATE INDEX IF NOT EXISTS alignments_fingerprint ON alignments (fingerprint);
+'''
+
+_COLUMNS = ('capture', 'created_at', 'mode', 'error', 'time_shift', 'qx', 'qy',
+            'qz', 'qw', 'tx', 'ty', 'tz', 'latitude', 'longitude',
+            'fingerprint', 'diagnostics')
+
+
+def diagnostics_summary(diagnostics):
+    '''
+    Keeps the scalar fields of alignment diagnostics (counts, error
+    statistics, percentiles, time shift, per status breakdown) and drops the
+    per-pair arrays, so that they can be stored as compact JSON.
+
+    Args:
+        diagnostics (SimpleNamespace or dict): Diagnostics, e.g. of
+            `coarse_to_fine_align`.
+
+    Returns:
+        dict: JSON serializable summary.
+    '''
+    if isinstance(diagnostics, SimpleNamespace):
+        diagnostics = vars(diagnostics)
+    summary = {}
+    for key, value in diagnostics.items():
+        if isinstance(value, (SimpleNamespace, dict)):
+            value = diagnostics_summary(value)
+            if not value:
+                continue
+        elif isinstance(value, np.generic):
+            value = value.item()
+        elif not isinstance(value, (bool, int, float, str, type(None))):
+            continue
+        summary[str(key)] = value
+    return summary
+
+
+def alignment_record(capture,
+                     geo_json,
+                     error=None,
+                     time_shift=None,
+                     mode=None,
+                     diagnostics=None,
+                     fingerprint=None,
+                     created_at=None):
+    '''
+    Builds the record of one alignment for `ResultsStore.insert_many`.
+
+    Args:
+        capture (str): Identifier of the capture, e.g. its pose folder.
+        geo_json (dict): The transform, see `to_geoJson`.
+        error (float, optional): Alignment error, defaults to the mean error
+            of the diagnostics.
+        time_shift (float, optional): Time shift, defaults to the one of the
+            diagnostics.
+        mode (str, optional): Aligner mode.
+        diagnostics (SimpleNamespace or dict, optional): Diagnostics, only
+            their `diagnostics_summary` is stored.
+        fingerprint (bytes or str, optional): Fingerprint of the input tracks,
+            e.g. `track_fingerprint`.
+        created_at (float, optional): Unix time of the alignment, now by default.
+
+    Returns:
+        dict: The record.
+    '''
+    summary = None if diagnostics is None else diagnostics_summary(diagnostics)
+    if summary is not None:
+        if error is None:
+            error = summary.get('mean_error')
+        if time_shift is None:
+            time_shift = summary.get('time_shift')
+    if isinstance(fingerprint, bytes):
+        fingerprint = fingerprint.hex()
+    qx, qy, qz, qw = (float(value) for value in geo_json['quaternion'])
+    tx, ty, tz = (float(value) for value in geo_json['translation'])
+    latitude, longitude = (float(value) for value in geo_json['origin'])
+    return {
+        'capture': str(capture),
+        'created_at': time.time() if created_at is None else float(created_at),
+        'mode': mode,
+        'error': None if error is None else float(error),
+        'time_shift': None if time_shift is None else float(time_shift),
+        'qx': qx,
+        'qy': qy,
+        'qz': qz,
+        'qw': qw,
+        'tx': tx,
+        'ty': ty,
+        'tz': tz,
+        'latitude': latitude,
+        'longitude': longitude,
+        'fingerprint': fingerprint,
+        'diagnostics': None if summary is None else json.dumps(summary),
+    }
+
+
+def record_to_geoJson(record):
+    '''
+    Converts a stored record back into the `to_geoJson` schema.
+    '''
+    return {
+        "type": "LocaltoWGS84",
+        "CoordinateSystem": "WGS84",
+        "quaternion": [record['qx'], record['qy'], record['qz'], record['qw']],
+        "translation": [record['tx'], record['ty'], record['tz']],
+        "origin": [record['latitude'], record['longitude']]
+    }
+
+
+class ResultsStore(SQLiteStore):
+    '''
+    Indexed store of alignment results in a local SQLite database.
+
+    Every alignment is one row with its capture, time, mode, error, time
+    shift, transform, origin, input fingerprint and a JSON summary of its
+    diagnostics. Indexes on capture and time, time, error and fingerprint
+    keep the queries of `query` and `latest` from scanning the table.
+
+    Worker processes can insert while others read, see `SQLiteStore`.
+    '''
+
+    schema = _SCHEMA
+    row_factory = sqlite3.Row
+
+    def insert_many(self, records):
+        '''
+        Inserts records in one transaction.
+
+        Args:
+            records (iterable): Records, see `alignment_record`.
+
+        Returns:
+            int: Number of inserted records.
+        '''
+        rows = [tuple(record.get(key) for key in _COLUMNS) for record in records]
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                'INSERT INTO alignments ({}) VALUES ({})'.format(
+                    ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))), rows)
+        return len(rows)
+
+    def insert(self, capture, geo_json, **kwargs):
+        '''
+        Inserts one alignment, keyword arguments are passed to
+        `alignment_record`.
+        '''
+        return self.insert_many([alignment_record(capture, geo_json, **kwargs)])
+
+    def query(self,
+              capture=None,
+              since=None,
+              until=None,
+              min_error=None,
+              max_error=None,
+              mode=None,
+              fingerprint=None,
+              latest=False,
+              limit=None):
+        '''
+        Selects stored alignments, all filters are optional and combined.
+
+        Args:
+            capture (str, optional): Only this capture.
+            since (float, optional): Only alignments at or after this Unix time.
+            until (float, optional): Only alignments before this Unix time.
+            min_error (float, optional): Only errors above this value, e.g.
+                the sessions with error > 0.3 m.
+            max_error (float, optional): Only errors at or below this value.
+            mode (str, optional): Only this aligner mode.
+            fingerprint (bytes or str, optional): Only this input fingerprint.
+            latest (bool, optional): Only the latest matching alignment of
+                every capture.
+            limit (int, optional): Maximum number of records.
+
+        Returns:
+            list: Records ordered by time, dictionaries with the columns of
+            `alignment_record` plus the id, diagnostics decoded.
+        '''
+        if isinstance(fingerprint, bytes):
+            fingerprint = fingerprint.hex()
+        conditions = []
+        parameters = []
+        for clause, value in (('capture = ?', capture),
+                              ('created_at >= ?', since),
+                              ('created_at < ?', until),
+                              ('error > ?', min_error),
+                              ('error <= ?', max_error), ('mode = ?', mode),
+                              ('fingerprint = ?', fingerprint)):
+            if value is not None:
+                conditions.append(clause)
+                parameters.append(value)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        sql = 'SELECT * FROM alignments' + where
+        if latest:
+            # The row with the largest (created_at, id) of every capture
+            sql = ('SELECT * FROM ({sql}) AS matches WHERE NOT EXISTS ('
+                   'SELECT 1 FROM alignments AS later WHERE '
+                   'later.capture = matches.capture AND ('
+                   'later.created_at > matches.created_at OR ('
+                   'later.created_at = matches.created_at AND '
+                   'later.id > matches.id)){condition})').format(
+                       sql=sql,
+                       condition=''.join(
+                           ' AND later.' + clause for clause in conditions))
+            parameters = parameters * 2
+        sql += ' ORDER BY created_at, id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(int(limit))
+        rows = self._connect().execute(sql, parameters).fetchall()
+        records = []
+        for row in rows:
+            record = dict(row)
+            if record['diagnostics'] is not None:
+                record['diagnostics'] = json.loads(record['diagnostics'])
+            records.append(record)
+        return records
+
+    def latest(self, capture):
+        '''
+        Returns:
+            dict: The latest record of a capture, None if it has none.
+        '''
+        records = self.query(capture=capture, latest=True)
+        return records[0] if records else None
+
+    def export_geojson(self, **filters):
+        '''
+        Exports the latest matching transform of every capture in the
+        `to_geoJson` schema, filters as in `query`.
+
+        Returns:
+            dict: Capture to GeoJSON transform.
+        '''
+        filters['latest'] = True
+        return {
+            record['capture']: record_to_geoJson(record)
+            for record in self.query(**filters)
+        }
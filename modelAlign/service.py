@@ -0,0 +1,445 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from .align import _check_mode
+from .app import alignment, archive_alignment
+
+HTTP_REASONS = {
+    200: 'OK',
+    202: 'Accepted',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    503: 'Service Unavailable',
+}
+# Finished jobs kept for polling, and for how long in seconds
+MAX_FINISHED_JOBS = 1024
+FINISHED_JOB_TTL = 3600.0
+# Latencies of the most recent jobs the metrics are computed over
+LATENCY_WINDOW = 1024
+
+
+def run_alignment_job(spec):
+    '''
+    Runs one alignment job, executed in a worker process.
+
+    Args:
+        spec (dict): Either 'rtk_folder' and 'pose_folder', or 'archive' the
+            path of a zip/tar file containing the 'rtk_name' and 'pose_name'
+            folders, which are read without extracting the archive. 'mode'
+            selects the aligner.
+
+    Returns:
+        dict: The GeoJSON transform, see `to_geoJson`.
+    '''
+    mode = spec.get('mode', '3d')
+    if 'archive' not in spec:
+        return alignment(spec['rtk_folder'], spec['pose_folder'], mode=mode)
+    # Already in a pool worker, the archive is parsed in this process
+    return archive_alignment(spec['archive'],
+                             spec.get('rtk_name', 'rtk'),
+                             spec.get('pose_name', 'cameras'),
+                             mode=mode,
+                             workers=1)
+
+
+def _to_json(value):
+    '''Converts numpy values of a result into JSON serializable values.'''
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class QueueFullError(Exception):
+    '''Raised when the job queue is full, the client should retry later.'''
+
+
+class AlignmentService:
+    '''
+    Asynchronous alignment job service.
+
+    Jobs are queued in a bounded asyncio queue and executed in a process pool,
+    so a slow capture never blocks the event loop or the jobs behind it beyond
+    the number of workers. Submitting a capture that is already queued or
+    running returns the existing job instead of computing it twice.
+    '''
+
+    def __init__(self,
+                 workers=2,
+                 max_queue=16,
+                 executor=None,
+                 runner=run_alignment_job,
+                 max_body=1 << 30,
+                 max_finished_jobs=MAX_FINISHED_JOBS,
+                 finished_job_ttl=FINISHED_JOB_TTL):
+        '''
+        Args:
+            workers (int, optional): Number of jobs running concurrently.
+            max_queue (int, optional): Number of waiting jobs before new
+                submissions are rejected.
+            executor (concurrent.futures.Executor, optional): Executor running
+                the jobs, defaults to a ProcessPoolExecutor with `workers`
+                processes.
+            runner (callable, optional): Picklable function running a job
+                spec, defaults to `run_alignment_job`.
+            max_body (int, optional): Maximum size of an uploaded archive in bytes.
+            max_finished_jobs (int, optional): Number of finished jobs kept
+                for polling, the oldest are dropped first.
+            finished_job_ttl (float, optional): Seconds a finished job is kept
+                for polling.
+        '''
+        self.workers = workers
+        self.max_queue = max_queue
+        self.runner = runner
+        self.max_body = max_body
+        self.max_finished_jobs = max_finished_jobs
+        self.finished_job_ttl = finished_job_ttl
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._queue = None
+        self._tasks = []
+        self.jobs = {}
+        self._inflight = {}
+        # Ids of the finished jobs, oldest first
+        self._finished = deque()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._started_at = None
+        self.counters = {
+            'submitted': 0,
+            'deduplicated': 0,
+            'rejected': 0,
+            'completed': 0,
+            'failed': 0,
+        }
+
+    async def start(self):
+        if self._executor is None:
+            # Forked workers would inherit the open client sockets and keep
+            # connections from closing, start them from a clean forkserver
+            mp_context = None
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context('forkserver')
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=mp_context)
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [
+            asyncio.ensure_future(self._worker()) for _ in range(self.workers)
+        ]
+        self._started_at = time.monotonic()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    @staticmethod
+    def job_key(spec):
+        '''
+        Identifies the capture of a job spec, jobs with the same key are
+        collapsed into one computation.
+        '''
+        mode = spec.get('mode', '3d')
+        if 'archive_sha256' in spec:
+            return ('archive', spec['archive_sha256'], spec.get('rtk_name'),
+                    spec.get('pose_name'), mode)
+        return ('folder', os.path.realpath(spec['rtk_folder']),
+                os.path.realpath(spec['pose_folder']), mode)
+
+    def submit(self, spec):
+        '''
+        Queues an alignment job.
+
+        Args:
+            spec (dict): Job spec, see `run_alignment_job`.
+
+        Returns:
+            dict: The job, a new one or the in-flight job for the same capture.
+
+        Raises:
+            ValueError: If the aligner mode is unknown.
+            QueueFullError: If the queue is full.
+        '''
+        _check_mode(spec.get('mode', '3d'))
+        key = self.job_key(spec)
+        if key in self._inflight:
+            self.counters['deduplicated'] += 1
+            return self._inflight[key]
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'result': None,
+            'error': None,
+            'submitted_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+        }
+        try:
+            self._queue.put_nowait((job, spec, key))
+        except asyncio.QueueFull:
+            self.counters['rejected'] += 1
+            raise QueueFullError('Job queue is full')
+        self.counters['submitted'] += 1
+        self.jobs[job['id']] = job
+        self._inflight[key] = job
+        return job
+
+    def _evict_jobs(self):
+        '''
+        Drops the finished jobs beyond max_finished_jobs or older than
+        finished_job_ttl, queued and running jobs are always kept.
+        '''
+        now = time.time()
+        while self._finished:
+            job = self.jobs.get(self._finished[0])
+            if (job is not None
+                    and len(self._finished) <= self.max_finished_jobs
+                    and now - job['finished_at'] <= self.finished_job_ttl):
+                break
+            self._finished.popleft()
+            if job is not None:
+                del self.jobs[job['id']]
+
+    async def wait(self, job_id, poll_interval=0.05):
+        '''Waits until a job is finished and returns it.'''
+        job = self.jobs[job_id]
+        while job['status'] in ('queued', 'running'):
+            await asyncio.sleep(poll_interval)
+        return job
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job, spec, key = await self._queue.get()
+            job['status'] = 'running'
+            job['started_at'] = time.time()
+            try:
+                result = await loop.run_in_executor(self._executor,
+                                                    self.runner, spec)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                job['status'] = 'failed'
+                job['error'] = '{}: {}'.format(type(error).__name__, error)
+                self.counters['failed'] += 1
+            else:
+                job['status'] = 'done'
+                job['result'] = _to_json(result)
+                self.counters['completed'] += 1
+            finally:
+                job['finished_at'] = time.time()
+                self._inflight.pop(key, None)
+                if 'archive' in spec:
+                    try:
+                        os.remove(spec['archive'])
+                    except OSError:
+                        pass
+                self._queue.task_done()
+            self._latencies.append(
+                (job['started_at'] - job['submitted_at'],
+                 job['finished_at'] - job['started_at']))
+            self._finished.append(job['id'])
+            self._evict_jobs()
+
+    def metrics(self):
+        '''
+        Returns:
+            dict: Job counters, queue depth, running jobs, latency percentiles
+            (seconds) over the last LATENCY_WINDOW jobs and throughput
+            (finished jobs per second).
+        '''
+        metrics = dict(self.counters)
+        metrics['queued'] = self._queue.qsize() if self._queue else 0
+        metrics['running'] = len(self._inflight) - metrics['queued']
+        if self._latencies:
+            latencies = np.array(self._latencies)
+            for name, column in (('queue_wait', latencies[:, 0]),
+                                 ('run_time', latencies[:, 1]),
+                                 ('latency', latencies.sum(axis=1))):
+                metrics[name] = {
+                    'mean': float(np.mean(column)),
+                    'p50': float(np.percentile(column, 50)),
+                    'p95': float(np.percentile(column, 95)),
+                    'max': float(np.max(column)),
+                }
+        uptime = time.monotonic() - self._started_at if self._started_at else 0
+        metrics['uptime'] = uptime
+        finished = self.counters['completed'] + self.counters['failed']
+        metrics['throughput'] = finished / uptime if uptime > 0 else 0.0
+        return metrics
+
+    @staticmethod
+    def _hash_archive(body):
+        return hashlib.sha256(body).hexdigest()
+
+    @staticmethod
+    def _save_archive(body):
+        handle, path = tempfile.mkstemp(prefix='modelAlign-', suffix='.archive')
+        with os.fdopen(handle, 'wb') as file:
+            file.write(body)
+        return path
+
+    async def handle(self, method, target, body):
+        '''
+        Routes one HTTP request. Hashing and saving uploaded archives run in
+        the default thread pool, so large uploads do not stall the event loop
+        and the other connections.
+
+        Returns:
+            tuple: HTTP status code and JSON serializable response.
+        '''
+        loop = asyncio.get_running_loop()
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        if parts == ['metrics'] and method == 'GET':
+            return 200, self.metrics()
+        if parts == ['jobs'] and method == 'POST':
+            try:
+                spec = json.loads(body or b'{}')
+                spec = {
+                    'rtk_folder': str(spec['rtk_folder']),
+                    'pose_folder': str(spec['pose_folder']),
+                    'mode': str(spec.get('mode', '3d')),
+                }
+                _check_mode(spec['mode'])
+            except (ValueError, KeyError, TypeError) as error:
+                return 400, {'error': 'Invalid job: {}'.format(error)}
+            return self._submit_response(spec)
+        if parts == ['jobs', 'archive'] and method == 'POST':
+            if not body:
+                return 400, {'error': 'Empty archive'}
+            try:
+                _check_mode(query.get('mode', '3d'))
+            except ValueError as error:
+                return 400, {'error': 'Invalid job: {}'.format(error)}
+            spec = {
+                'archive_sha256': await loop.run_in_executor(
+                    None, self._hash_archive, body),
+                'rtk_name': query.get('rtk', 'rtk'),
+                'pose_name': query.get('cameras', 'cameras'),
+                'mode': query.get('mode', '3d'),
+            }
+            if self.job_key(spec) in self._inflight:
+                return self._submit_response(spec)
+            spec['archive'] = await loop.run_in_executor(
+                None, self._save_archive, body)
+            # Concurrent uploads of the same archive all get here, only the
+            # first one is queued, the others join its job
+            deduplicated = self.job_key(spec) in self._inflight
+            status, response = self._submit_response(spec)
+            if status != 202 or deduplicated:
+                os.remove(spec['archive'])
+            return status, response
+        if len(parts) == 2 and parts[0] == 'jobs' and method == 'GET':
+            job = self.jobs.get(parts[1])
+            if job is None:
+                return 404, {'error': 'Unknown job'}
+            return 200, job
+        if parts in (['metrics'], ['jobs'], ['jobs', 'archive']):
+            return 405, {'error': 'Method not allowed'}
+        return 404, {'error': 'Not found'}
+
+    def _submit_response(self, spec):
+        try:
+            job = self.submit(spec)
+        except QueueFullError as error:
+            return 503, {'error': str(error)}
+        return 202, {'id': job['id'], 'status': job['status']}
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        '''
+        Starts the job workers and the HTTP server.
+
+        Returns:
+            asyncio.base_events.Server: The listening server.
+        '''
+        if self._queue is None:
+            await self.start()
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if length > self.max_body:
+                status, response = 413, {'error': 'Request body too large'}
+            else:
+                body = await reader.readexactly(length) if length else b''
+                status, response = await self.handle(method, target, body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, response = 400, {'error': 'Malformed request'}
+        payload = json.dumps(response).encode('utf-8')
+        head = ('HTTP/1.1 {} {}\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: {}\r\n'
+                'Connection: close\r\n\r\n').format(status,
+                                                    HTTP_REASONS[status],
+                                                    len(payload))
+        if status == 503:
+            head = head[:-2] + 'Retry-After: 1\r\n\r\n'
+        writer.write(head.encode('latin-1') + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+async def _serve_forever(args):
+    service = AlignmentService(workers=args.workers, max_queue=args.max_queue)
+    server = await service.serve(args.host, args.port)
+    print('Alignment service listening on http://{}:{}'.format(
+        args.host, args.port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='HTTP/JSON service running trajectory alignment jobs.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--max-queue', type=int, default=16)
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(_serve_forever(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
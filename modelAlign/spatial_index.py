@@ -0,0 +1,224 @@
+import json
+
+import numpy as np
+from geoToolbox import wgs84_to_cartesian, cartesian_to_wgs84
+
+from .align import _track_array
+from .sqlite_store import SQLiteStore
+from .transform import AlignmentTransform
+
+# Mean radius of the earth in meters, bounds the angular size of a radius
+EARTH_RADIUS = 6371008.8
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    capture TEXT NOT NULL UNIQUE,
+    south REAL NOT NULL,
+    north REAL NOT NULL,
+    west REAL NOT NULL,
+    east REAL NOT NULL,
+    geo_json TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS session_bounds USING rtree (
+    id, south, north, west, east
+);
+'''
+
+
+def session_footprint(pose_data, geo_json):
+    '''
+    Computes the WGS84 bounding box of an aligned session, all poses are
+    transformed and converted at once.
+
+    Args:
+        pose_data (list or dict): Pose data of the session.
+        geo_json (dict): The transform of the session, see `to_geoJson`.
+
+    Returns:
+        dict: The south, north, west and east bounds in degrees.
+    '''
+    positions = _track_array(pose_data, ['x', 'y', 'z'])
+    if len(positions) == 0:
+        raise ValueError('No poses to compute the footprint from')
+    wgs84 = AlignmentTransform.from_geo_json(geo_json).local_to_wgs84(
+        positions)
+    latitude, longitude = wgs84[:, 0], wgs84[:, 1]
+    return {
+        'south': float(latitude.min()),
+        'north': float(latitude.max()),
+        'west': float(longitude.min()),
+        'east': float(longitude.max())
+    }
+
+
+class SessionIndex(SQLiteStore):
+    '''
+    Spatial index of geo-registered sessions, persisted in a SQLite database.
+
+    The WGS84 bounding box of every session (see `session_footprint`) is kept
+    in an SQLite R*Tree next to its transform, so bounding box and radius
+    queries only visit the sessions near the query area. Sessions can be
+    inserted incrementally as alignments complete; inserting a capture again
+    replaces its entry. Bounding boxes crossing the antimeridian are not
+    supported.
+
+    Like `ResultsStore`, the index only holds its path when pickled, every
+    process opens its own connection, see `SQLiteStore`.
+    '''
+
+    schema = _SCHEMA
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def insert_many(self, sessions):
+        '''
+        Inserts or replaces sessions in one transaction.
+
+        Args:
+            sessions (iterable): (capture, geo_json, footprint) tuples, see
+                `session_footprint`.
+
+        Returns:
+            int: Number of inserted sessions.
+        '''
+        connection = self._connect()
+        count = 0
+        with connection:
+            for capture, geo_json, footprint in sessions:
+                row = connection.execute(
+                    'SELECT id FROM sessions WHERE capture = ?',
+                    (str(capture), )).fetchone()
+                if row is not None:
+                    connection.execute('DELETE FROM sessions WHERE id = ?', row)
+                    connection.execute(
+                        'DELETE FROM session_bounds WHERE id = ?', row)
+                bounds = tuple(
+                    float(footprint[key])
+                    for key in ('south', 'north', 'west', 'east'))
+                cursor = connection.execute(
+                    'INSERT INTO sessions (capture, south, north, west, east, '
+                    'geo_json) VALUES (?, ?, ?, ?, ?, ?)',
+                    (str(capture), ) + bounds + (json.dumps(geo_json), ))
+                connection.execute(
+                    'INSERT INTO session_bounds VALUES (?, ?, ?, ?, ?)',
+                    (cursor.lastrowid, ) + bounds)
+                count += 1
+        return count
+
+    def insert(self, capture, pose_data, geo_json):
+        '''
+        Inserts or replaces one aligned session.
+
+        Args:
+            capture (str): Identifier of the capture, e.g. its pose folder.
+            pose_data (list or dict): Pose data of the session.
+            geo_json (dict): The transform of the session, see `to_geoJson`.
+        '''
+        return self.insert_many([(capture, geo_json,
+                                  session_footprint(pose_data, geo_json))])
+
+    def remove(self, capture):
+        '''Removes a session, returns whether it was indexed.'''
+        connection = self._connect()
+        with connection:
+            row = connection.execute('SELECT id FROM sessions WHERE capture = ?',
+                                     (str(capture), )).fetchone()
+            if row is None:
+                return False
+            connection.execute('DELETE FROM sessions WHERE id = ?', row)
+            connection.execute('DELETE FROM session_bounds WHERE id = ?', row)
+        return True
+
+    def _bounded(self, south, west, north, east):
+        # The R*Tree stores single precision bounds rounded outwards, the
+        # candidates are checked again against the exact bounds
+        return self._connect().execute(
+            'SELECT sessions.capture, sessions.south, sessions.north, '
+            'sessions.west, sessions.east FROM session_bounds AS bounds '
+            'JOIN sessions ON sessions.id = bounds.id '
+            'WHERE bounds.north >= :south AND bounds.south <= :north '
+            'AND bounds.east >= :west AND bounds.west <= :east '
+            'AND sessions.north >= :south AND sessions.south <= :north '
+            'AND sessions.east >= :west AND sessions.west <= :east '
+            'ORDER BY sessions.capture', {
+                'south': south,
+                'north': north,
+                'west': west,
+                'east': east
+            }).fetchall()
+
+    def bbox(self, south, west, north, east):
+        '''
+        Finds the sessions whose bounding box intersects a WGS84 box.
+
+        Returns:
+            list: The captures, sorted.
+        '''
+        return [row[0] for row in self._bounded(south, west, north, east)]
+
+    def radius(self, latitude, longitude, radius):
+        '''
+        Finds the sessions whose bounding box comes within a distance of a
+        WGS84 point.
+
+        The R*Tree is queried with the box around the circle, whose
+        longitude span is taken on the poleward edge of the circle, then the
+        distance to the closest point of every candidate box is computed in
+        one vectorized conversion to the local frame of the point.
+
+        Args:
+            latitude (float): Latitude of the center in degrees.
+            longitude (float): Longitude of the center in degrees.
+            radius (float): Radius in meters.
+
+        Returns:
+            list: (capture, distance in meters) tuples sorted by distance,
+            0 for sessions containing the point.
+        '''
+        center = [latitude, longitude]
+        # A slightly larger box, the tangent plane bends away from the globe
+        reach = radius * 1.01
+        latitudes, _ = cartesian_to_wgs84(
+            center, [np.zeros(2), np.array([-reach, reach])])
+        south, north = float(np.min(latitudes)), float(np.max(latitudes))
+        if abs(latitude) + np.degrees(reach / EARTH_RADIUS) >= 90:
+            # The circle reaches the pole
+            south, north = max(south, -90.0), min(north, 90.0)
+            if latitude > 0:
+                north = 90.0
+            else:
+                south = -90.0
+            west, east = -180.0, 180.0
+        else:
+            # The meridians converge towards the pole, the circle spans the
+            # most longitude on its poleward edge
+            widest = max(south, north, key=abs)
+            _, longitudes = cartesian_to_wgs84(
+                [widest, longitude], [np.array([-reach, reach]),
+                                      np.zeros(2)])
+            west, east = float(np.min(longitudes)), float(np.max(longitudes))
+        rows = self._bounded(south, west, north, east)
+        if not rows:
+            return []
+        bounds = np.array([row[1:] for row in rows], dtype=float)
+        closest_latitude = np.clip(latitude, bounds[:, 0], bounds[:, 1])
+        closest_longitude = np.clip(longitude, bounds[:, 2], bounds[:, 3])
+        east, north = wgs84_to_cartesian(center,
+                                         [closest_latitude, closest_longitude])
+        distances = np.hypot(east, north)
+        order = np.argsort(distances, kind='stable')
+        return [(rows[k][0], float(distances[k])) for k in order
+                if distances[k] <= radius]
+
+    def geo_json(self, capture):
+        '''
+        Returns:
+            dict: The transform of an indexed session, None if not indexed.
+        '''
+        row = self._connect().execute(
+            'SELECT geo_json FROM sessions WHERE capture = ?',
+            (str(capture), )).fetchone()
+        return None if row is None else json.loads(row[0])
@@ -0,0 +1,70 @@
+import os
+import sqlite3
+
+# Seconds a writer waits for the lock held by another process
+BUSY_TIMEOUT = 30.0
+
+
+class SQLiteStore:
+    '''
+    Base of the stores kept in a local SQLite database.
+
+    The database runs in WAL mode so that worker processes can write while
+    others read. The store itself only holds its path: it can be passed to
+    process pool workers, and every process opens its own connection on first
+    use. Subclasses set the schema, created when the user_version of the
+    database is not the schema version, and the row factory.
+    '''
+
+    schema = ''
+    schema_version = 1
+    row_factory = None
+
+    def __init__(self, path):
+        '''
+        Args:
+            path (str): Path of the SQLite database, created if missing.
+        '''
+        self.path = os.fspath(path)
+        self._connection = None
+        self._pid = None
+        self._connect()
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._connection = None
+        self._pid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _connect(self):
+        if self._connection is not None and self._pid == os.getpid():
+            return self._connection
+        connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+        if self.row_factory is not None:
+            connection.row_factory = self.row_factory
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.schema_version:
+            with connection:
+                connection.executescript(self.schema)
+                connection.execute('PRAGMA user_version = {}'.format(
+                    self.schema_version))
+        self._connection = connection
+        self._pid = os.getpid()
+        return connection
+
+    def close(self):
+        '''Closes the connection of this process.'''
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
@@ -0,0 +1,175 @@
+import numpy as np
+from scipy.spatial.transform import Rotation
+from geoToolbox import wgs84_to_cartesian, cartesian_to_wgs84
+
+from .align import Y_UP_TO_Z_UP
+
+# Rotation matrix, translation and origin as float64, see `to_bytes`
+_SERIALIZED_SIZE = 14 * 8
+
+
+def _read_only(array):
+    array = np.array(array, dtype=float)
+    array.setflags(write=False)
+    return array
+
+
+class AlignmentTransform:
+    '''
+    Precomputed transform between the local frame of a model (the y-up pose
+    frame) and WGS84.
+
+    A local point p maps to x = east, y = north, z = height relative to the
+    origin with `R @ Y_UP_TO_Z_UP @ p + t`, as in `data_association`. The
+    combined matrix and its inverse, the quaternion and the GeoJSON are
+    computed once, every mapping is vectorized over (N, 3) arrays; east and
+    north are converted with geoToolbox like the RTK data, the height is
+    kept as is.
+
+    The transform is immutable. It serializes to 112 bytes with `to_bytes`,
+    which is also what it pickles to.
+    '''
+
+    def __init__(self, R, t, origin):
+        '''
+        Args:
+            R (numpy.ndarray): (3, 3) rotation matrix of the alignment.
+            t (numpy.ndarray): Translation vector of the alignment.
+            origin (list): WGS84 latitude and longitude of the local origin.
+        '''
+        self.R = _read_only(R).reshape(3, 3)
+        self.t = _read_only(t).reshape(3)
+        self.origin = _read_only(origin).reshape(2)
+        # Local model point to east, north and height, orthogonal
+        self.matrix = _read_only(self.R @ Y_UP_TO_Z_UP)
+        self._origin = [float(self.origin[0]), float(self.origin[1])]
+        self._quaternion = None
+
+    @classmethod
+    def from_result(cls, result, origin):
+        '''
+        Builds the transform of an aligner result.
+
+        Args:
+            result (tuple): The return value of `coarse_to_fine_align` or
+                `icp_align`, starting with R and t.
+            origin (list): The RTK origin, e.g. of `load_rtk_data`.
+        '''
+        return cls(result[0], result[1], origin)
+
+    @classmethod
+    def from_geo_json(cls, geo_json):
+        '''
+        Builds the transform of a `to_geoJson` dictionary.
+        '''
+        R = Rotation.from_quat(geo_json['quaternion']).as_matrix()
+        return cls(R, geo_json['translation'], geo_json['origin'])
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''
+        Restores a transform serialized with `to_bytes`.
+        '''
+        if len(data) != _SERIALIZED_SIZE:
+            raise ValueError('Expected {} bytes, got {}'.format(
+                _SERIALIZED_SIZE, len(data)))
+        values = np.frombuffer(data, dtype='<f8')
+        return cls(values[:9], values[9:12], values[12:])
+
+    def to_bytes(self):
+        '''
+        Returns:
+            bytes: R, t and the origin as little endian float64.
+        '''
+        return np.concatenate([self.R.ravel(), self.t,
+                               self.origin]).astype('<f8').tobytes()
+
+    def __reduce__(self):
+        return (AlignmentTransform.from_bytes, (self.to_bytes(), ))
+
+    def __eq__(self, other):
+        if not isinstance(other, AlignmentTransform):
+            return NotImplemented
+        return self.to_bytes() == other.to_bytes()
+
+    def __hash__(self):
+        return hash(self.to_bytes())
+
+    def __repr__(self):
+        return 'AlignmentTransform(origin={}, t={})'.format(
+            self._origin, self.t.tolist())
+
+    @property
+    def quaternion(self):
+        '''
+        The rotation as an (x, y, z, w) quaternion, the order of `to_geoJson`.
+        '''
+        if self._quaternion is None:
+            self._quaternion = _read_only(
+                Rotation.from_matrix(self.R).as_quat())
+        return self._quaternion
+
+    def to_geo_json(self):
+        '''
+        Returns:
+            dict: The transform in the schema of `to_geoJson`.
+        '''
+        return {
+            "type": "LocaltoWGS84",
+            "CoordinateSystem": "WGS84",
+            "quaternion": self.quaternion.tolist(),
+            "translation": self.t.tolist(),
+            "origin": list(self._origin)
+        }
+
+    def local_to_enu(self, points):
+        '''
+        Maps (N, 3) local model points to east, north and height relative to
+        the origin.
+        '''
+        points = np.asarray(points, dtype=float)
+        return points @ self.matrix.T + self.t
+
+    def enu_to_local(self, points):
+        '''
+        Maps (N, 3) east, north and height relative to the origin back to
+        local model points.
+        '''
+        points = np.asarray(points, dtype=float)
+        return (points - self.t) @ self.matrix
+
+    def local_to_wgs84(self, points):
+        '''
+        Maps local model points to WGS84.
+
+        Args:
+            points (array-like): (N, 3) points, or a single (3,) point.
+
+        Returns:
+            numpy.ndarray: Latitude, longitude and height, in the shape of
+            the points.
+        '''
+        enu = self.local_to_enu(points)
+        flat = enu.reshape(-1, 3)
+        latitude, longitude = cartesian_to_wgs84(self._origin,
+                                                 [flat[:, 0], flat[:, 1]])
+        wgs84 = np.column_stack([latitude, longitude, flat[:, 2]])
+        return wgs84.reshape(enu.shape)
+
+    def wgs84_to_local(self, points):
+        '''
+        Maps WGS84 points to local model points.
+
+        Args:
+            points (array-like): (N, 3) latitude, longitude and height, or a
+                single (3,) point.
+
+        Returns:
+            numpy.ndarray: Local model points, in the shape of the points.
+        '''
+        points = np.asarray(points, dtype=float)
+        flat = points.reshape(-1, 3)
+        east, north = wgs84_to_cartesian(self._origin,
+                                         [flat[:, 0], flat[:, 1]])
+        enu = np.column_stack([east, north, flat[:, 2]])
+        return self.enu_to_local(enu).reshape(points.shape)
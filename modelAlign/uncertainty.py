@@ -0,0 +1,261 @@
+import math
+import os
+from types import SimpleNamespace
+
+import numpy as np
+from scipy.stats import norm
+
+from .align import coarse_to_fine_align, associate_shifts, _check_mode
+from .parallel import map_shared
+
+PARAMETER_NAMES = ('yaw', 'tx', 'ty', 'tz', 'time_shift')
+
+
+def replica_weights(n_pairs, n_replicas=200, method='bootstrap', rng=None):
+    '''
+    Draws the resampling weights of every replica at once.
+
+    Args:
+        n_pairs (int): Number of RTK data points that can be paired.
+        n_replicas (int, optional): Number of replicas. The jackknife leaves
+            out one of min(n_replicas, n_pairs) contiguous groups of data
+            per replica (delete-a-group jackknife).
+        method (str, optional): 'bootstrap' or 'jackknife'.
+        rng (numpy.random.Generator, optional): Random generator.
+
+    Returns:
+        numpy.ndarray: (B, n_pairs) weights, the number of times each datum
+        is drawn in each replica.
+    '''
+    if method == 'jackknife':
+        n_groups = min(n_replicas, n_pairs)
+        groups = np.arange(n_pairs) * n_groups // n_pairs
+        return (groups[None, :] != np.arange(n_groups)[:, None]).astype(float)
+    if method != 'bootstrap':
+        raise ValueError("Unknown method {!r}, expected 'bootstrap' or "
+                         "'jackknife'".format(method))
+    rng = np.random.default_rng() if rng is None else rng
+    draws = rng.integers(0, n_pairs, size=(n_replicas, n_pairs))
+    # Count the draws of each replica with a single bincount
+    flat = (draws + n_pairs * np.arange(n_replicas)[:, None]).ravel()
+    counts = np.bincount(flat, minlength=n_replicas * n_pairs)
+    return counts.reshape(n_replicas, n_pairs).astype(float)
+
+
+def solve_replicas(poses, rtk_datas, mask, weights, mode='3d'):
+    '''
+    Solves the weighted alignment of every replica for one association, using
+    the weighted sufficient statistics and one stacked SVD.
+
+    Args:
+        poses (numpy.ndarray): (M, 3) associated poses, NaN where not associated.
+        rtk_datas (numpy.ndarray): (M, 3) RTK positions.
+        mask (numpy.ndarray): (M,) boolean array of valid pairs.
+        weights (numpy.ndarray): (B, M) replica weights.
+        mode (str, optional): Aligner mode, '3d' or 'yaw'.
+
+    Returns:
+        tuple: A tuple containing the (B, 3, 3) rotation matrices (R), (B, 3)
+        translation vectors (t) and the (B,) weighted root mean square errors,
+        inf where a replica has fewer than 2 pairs.
+    '''
+    weights = weights * mask
+    poses = np.where(mask[:, None], poses, 0.0)
+    # Center on the pair means to keep the raw sums well conditioned
+    center_pose = poses[mask].mean(axis=0) if mask.any() else np.zeros(3)
+    center_rtk = rtk_datas[mask].mean(axis=0) if mask.any() else np.zeros(3)
+    p = np.where(mask[:, None], poses - center_pose, 0.0)
+    q = np.where(mask[:, None], rtk_datas - center_rtk, 0.0)
+    N = weights.sum(axis=1)
+    safe_N = np.maximum(N, 1.0)
+    poses_mean = weights @ p / safe_N[:, None]
+    rtk_data_mean = weights @ q / safe_N[:, None]
+    cross = (weights @ (q[:, :, None] * p[:, None, :]).reshape(-1, 9)).reshape(
+        -1, 3, 3)
+    Sigma = cross - N[:, None, None] * (rtk_data_mean[:, :, None] *
+                                        poses_mean[:, None, :])
+    pose_ss = weights @ np.sum(p * p, axis=1) - N * np.sum(poses_mean**2,
+                                                           axis=1)
+    rtk_ss = weights @ np.sum(q * q, axis=1) - N * np.sum(rtk_data_mean**2,
+                                                          axis=1)
+    if mode == 'yaw':
+        yaw = np.arctan2(Sigma[:, 1, 0] - Sigma[:, 0, 1],
+                         Sigma[:, 0, 0] + Sigma[:, 1, 1])
+        R = np.zeros((len(yaw), 3, 3))
+        R[:, 0, 0] = R[:, 1, 1] = np.cos(yaw)
+        R[:, 1, 0] = np.sin(yaw)
+        R[:, 0, 1] = -R[:, 1, 0]
+        R[:, 2, 2] = 1.0
+    else:
+        U, _, Vt = np.linalg.svd(Sigma / safe_N[:, None, None])
+        W = np.broadcast_to(np.identity(3), Sigma.shape).copy()
+        W[:, 2, 2] = np.sign(np.linalg.det(U) * np.linalg.det(Vt))
+        W[W[:, 2, 2] == 0, 2, 2] = 1.0
+        R = U @ W @ Vt
+    t = (rtk_data_mean + center_rtk) - np.einsum('bij,bj->bi', R,
+                                                 poses_mean + center_pose)
+    squared_error = rtk_ss + pose_ss - 2 * np.sum(R * Sigma, axis=(1, 2))
+    error = np.sqrt(np.maximum(squared_error, 0.0) / safe_N)
+    error[N < 2] = np.inf
+    return R, t, error
+
+
+def _solve_shifts(poses, rtk_datas, mask, weights, mode):
+    '''
+    Solves every replica for each of the S associations, returns (S, B, ...)
+    arrays.
+    '''
+    solutions = [
+        solve_replicas(poses[k], rtk_datas, mask[k], weights, mode)
+        for k in range(len(mask))
+    ]
+    return tuple(np.stack(values) for values in zip(*solutions))
+
+
+def _solve_shifts_shared(tracks, start, stop, mode):
+    pairs = tracks['pairs']
+    return _solve_shifts(pairs['poses'][start:stop], pairs['rtk_datas'],
+                         pairs['mask'][start:stop], pairs['weights'], mode)
+
+
+def _yaw(R):
+    return np.arctan2(R[..., 1, 0], R[..., 0, 0])
+
+
+def bootstrap_alignment(pose_data,
+                        rtk_data,
+                        n_replicas=200,
+                        method='bootstrap',
+                        mode='3d',
+                        time_shift_interval=[-1, 1],
+                        coarse_step=0.1,
+                        fine_step=0.01,
+                        search_shift=True,
+                        workers=None,
+                        executor=None,
+                        confidence=0.95,
+                        seed=None):
+    '''
+    Estimates the uncertainty of the alignment by resampling the associated
+    pairs.
+
+    The point estimate comes from `coarse_to_fine_align`. All replicas are
+    then drawn at once as weights over the RTK data and solved together from
+    the weighted sufficient statistics with one stacked SVD per time shift.
+    With search_shift every replica re-selects its time shift on the fine grid
+    around the point estimate (by weighted RMSE), so the time shift
+    uncertainty is included; the shifts can be spread over worker processes.
+
+    Args:
+        pose_data (list or dict): Pose data.
+        rtk_data (list or dict): RTK data.
+        n_replicas (int, optional): Number of bootstrap replicas. Defaults to 200.
+        method (str, optional): 'bootstrap' or 'jackknife'. Defaults to 'bootstrap'.
+        mode (str, optional): Aligner mode, '3d' or 'yaw'. Defaults to '3d'.
+        time_shift_interval (list, optional): Time shift interval for coarse alignment.
+        coarse_step (float, optional): Coarse alignment step size.
+        fine_step (float, optional): Fine alignment step size.
+        search_shift (bool, optional): Re-search the time shift per replica.
+            Defaults to True.
+        workers (int, optional): Number of worker processes for the time
+            shift re-search, None to solve in this process.
+        executor (concurrent.futures.ProcessPoolExecutor, optional): Worker
+            processes for the time shift re-search instead of a pool created
+            for the call, see `map_shared`.
+        confidence (float, optional): Confidence level of the intervals.
+        seed (int, optional): Seed of the replica draws.
+
+    Returns:
+        SimpleNamespace: The point estimate (R, t, error, time_shift), the
+        replica samples of PARAMETER_NAMES (yaw in radians, translation,
+        time shift), their covariance, standard deviations and confidence
+        intervals (dict of (low, high) per parameter).
+    '''
+    _check_mode(mode)
+    R, t, error, diagnostics = coarse_to_fine_align(pose_data,
+                                                    rtk_data,
+                                                    time_shift_interval,
+                                                    coarse_step,
+                                                    fine_step,
+                                                    mode=mode,
+                                                    return_diagnostics=True)
+    if R is None:
+        raise ValueError('Not enough associated data to align')
+    time_shift = float(diagnostics.time_shift)
+    if search_shift:
+        max_iter = math.ceil(coarse_step / fine_step) * 2
+        time_shifts = np.arange(time_shift - max_iter / 2 * fine_step,
+                                time_shift + max_iter / 2 * fine_step,
+                                fine_step)
+    else:
+        time_shifts = np.array([time_shift])
+    poses, rtk_datas, mask, _ = associate_shifts(pose_data, rtk_data,
+                                                 time_shifts)
+    # Only RTK data paired at one of the shifts take part in the resampling
+    paired = mask.any(axis=0)
+    poses, rtk_datas, mask = poses[:, paired], rtk_datas[paired], mask[:,
+                                                                       paired]
+    rng = np.random.default_rng(seed)
+    weights = replica_weights(int(paired.sum()), n_replicas, method, rng)
+
+    if (workers or executor is not None) and len(time_shifts) > 1:
+        chunks = np.array_split(
+            np.arange(len(time_shifts)),
+            min(workers or os.cpu_count(), len(time_shifts)))
+        pairs = {
+            'poses': poses,
+            'rtk_datas': rtk_datas,
+            'mask': mask,
+            'weights': weights
+        }
+        results = map_shared(_solve_shifts_shared, {'pairs': pairs},
+                             [(chunk[0], chunk[-1] + 1, mode)
+                              for chunk in chunks],
+                             workers,
+                             executor=executor)
+        all_R, all_t, all_error = (np.concatenate(values, axis=0)
+                                   for values in zip(*results))
+    else:
+        all_R, all_t, all_error = _solve_shifts(poses, rtk_datas, mask,
+                                                weights, mode)
+    # Every replica keeps its best shift
+    best = np.argmin(all_error, axis=0)
+    replicas = np.arange(weights.shape[0])
+    replica_R = all_R[best, replicas]
+    replica_t = all_t[best, replicas]
+    yaw = _yaw(R)
+    # Unwrap the replica yaws around the point estimate
+    replica_yaw = yaw + np.angle(np.exp(1j * (_yaw(replica_R) - yaw)))
+    samples = np.column_stack(
+        [replica_yaw, replica_t, time_shifts[best]])
+    estimate = np.concatenate([[yaw], t, [time_shift]])
+
+    alpha = (1.0 - confidence) / 2
+    if method == 'jackknife':
+        n = len(samples)
+        deviations = samples - samples.mean(axis=0)
+        covariance = (n - 1) / n * deviations.T @ deviations
+        std = np.sqrt(np.diag(covariance))
+        z = norm.ppf(1 - alpha)
+        low, high = estimate - z * std, estimate + z * std
+    else:
+        covariance = np.cov(samples, rowvar=False)
+        std = np.sqrt(np.diag(covariance))
+        low, high = np.percentile(samples, [100 * alpha, 100 * (1 - alpha)],
+                                  axis=0)
+    return SimpleNamespace(
+        R=R,
+        t=t,
+        error=error,
+        time_shift=time_shift,
+        method=method,
+        parameter_names=PARAMETER_NAMES,
+        estimate=estimate,
+        samples=samples,
+        covariance=covariance,
+        std=dict(zip(PARAMETER_NAMES, std.tolist())),
+        confidence=confidence,
+        confidence_intervals={
+            name: (float(lo), float(hi))
+            for name, lo, hi in zip(PARAMETER_NAMES, low, high)
+        })
@@ -1,11 +1,22 @@
 import numpy as np
+import pytest
 from pathlib import Path
 from modelAlign.data_preprocessing import load_poses, load_rtk_data
 from modelAlign.align import data_association, aligner_SVD_2D, aligner_SVD_3D
 from modelAlign.align import coarse_aligner_3D
 from modelAlign.align import fine_aligner_3D
 from modelAlign.align import coarse_to_fine_align
+from modelAlign.align import associate_shifts, aligner_yaw_3D
+from modelAlign.align import residual_diagnostics
+from modelAlign.align import estimate_time_shift, SearchStopped
+from modelAlign.align import shift_overlap, feasible_time_shift_interval
+from modelAlign.align import slerp, world_orientations, aligned_orientations
+from modelAlign.align import Y_UP_TO_Z_UP, shift_cache, SEARCH_BLOCK
+from modelAlign.align import ShiftCache, track_fingerprint, _min_pairs
+from modelAlign.data_preprocessing import load_pose_track
+from scipy.spatial.transform import Rotation, Slerp
 
+import threading
 from unittest.mock import patch
 
 
@@ -126,3 +137,466 @@ def test_coarse_to_fine_align():
                                                     20)
     assert error <= coarse_error, "Final error not less than coarse error."
     assert error <= fine_error, "Final error not less than fine error."
+
+
+def test_associate_shifts():
+    base_path = Path(__file__).parent
+    pose_folder = base_path / 'rtk_test_data_2/cameras'
+    poses = load_poses(str(pose_folder))
+    rtk_data_folder = base_path / 'rtk_test_data_2/rtk'
+    rtk_data, _ = load_rtk_data(str(rtk_data_folder))
+    time_shifts = np.arange(-1, 1.1, 0.1)
+    all_poses, all_rtk, mask, all_variances = associate_shifts(
+        poses, rtk_data, time_shifts)
+    assert all_poses.shape == (len(time_shifts), len(rtk_data), 3)
+    # Same pairs as the per shift data association
+    for k, time_shift in enumerate(time_shifts):
+        shifted_poses, shifted_rtk, variances = data_association(
+            poses, rtk_data, time_shift)
+        assert mask[k].sum() == len(shifted_poses), "Length not match."
+        np.testing.assert_allclose(all_poses[k][mask[k]], shifted_poses)
+        np.testing.assert_allclose(all_rtk[mask[k]], shifted_rtk)
+        np.testing.assert_allclose(all_variances[mask[k]], variances)
+
+
+def test_slerp():
+    rotations = Rotation.random(6, random_state=1)
+    fractions = np.linspace(0, 1, 5)
+    interpolated = slerp(rotations[:-1].as_quat()[:, None],
+                         rotations[1:].as_quat()[:, None], fractions[None, :])
+    assert interpolated.shape == (5, 5, 4)
+    for k in range(5):
+        expected = Slerp([0, 1], rotations[k:k + 2])(fractions)
+        angle = (Rotation.from_quat(interpolated[k]) *
+                 expected.inv()).magnitude()
+        np.testing.assert_allclose(angle, 0, atol=1e-9)
+    # Equal quaternions, and the same rotation with the opposite sign
+    q = rotations[0].as_quat()
+    np.testing.assert_allclose(slerp(q, q, 0.3), q)
+    np.testing.assert_allclose(np.abs(slerp(q, -q, 0.3) @ q), 1.0)
+
+
+def test_associate_shifts_orientations():
+    base_path = Path(__file__).parent
+    poses = load_pose_track(str(base_path / 'rtk_test_data_2/cameras'),
+                            orientation=True)
+    rtk_data, _ = load_rtk_data(str(base_path / 'rtk_test_data_2/rtk'))
+    time_shifts = np.arange(-1, 1.1, 0.1)
+    all_poses, _, mask, _, quaternions = associate_shifts(
+        poses, rtk_data, time_shifts, orientations=True)
+    expected_poses, _, expected_mask, _ = associate_shifts(
+        poses, rtk_data, time_shifts)
+    np.testing.assert_array_equal(mask, expected_mask)
+    np.testing.assert_array_equal(all_poses, expected_poses)
+    assert quaternions.shape == (len(time_shifts), len(rtk_data), 4)
+    assert np.isnan(quaternions[~mask]).all(), "Unpaired orientation."
+    np.testing.assert_allclose(np.linalg.norm(quaternions[mask], axis=1), 1)
+    # Matches scipy's Slerp between the bracketing poses
+    times = np.array([datum['timeStamp'] for datum in rtk_data]) - 0.2
+    k = int(np.argmin(np.abs(time_shifts - 0.2)))
+    expected = Slerp(poses['timeStamp'], Rotation.from_quat(
+        poses['quaternion']))(times[mask[k]])
+    angle = (Rotation.from_quat(quaternions[k][mask[k]]) *
+             expected.inv()).magnitude()
+    np.testing.assert_allclose(angle, 0, atol=1e-9)
+    with pytest.raises(ValueError):
+        associate_shifts(load_poses(str(base_path / 'rtk_test_data_2/cameras')),
+                         rtk_data, time_shifts, orientations=True)
+
+
+def test_aligned_orientations():
+    base_path = Path(__file__).parent
+    poses = load_pose_track(str(base_path / 'rtk_test_data_2/cameras'),
+                            orientation=True)
+    rtk_data, _ = load_rtk_data(str(base_path / 'rtk_test_data_2/rtk'))
+    R, t, error, diagnostics = coarse_to_fine_align(poses,
+                                                    rtk_data,
+                                                    mode='yaw',
+                                                    return_diagnostics=True)
+    world, mask = aligned_orientations(poses, rtk_data, R,
+                                       diagnostics.time_shift)
+    assert world.shape == (len(rtk_data), 4)
+    assert mask.sum() > 0, "No orientation associated."
+    _, _, _, _, quaternions = associate_shifts(poses,
+                                               rtk_data,
+                                               [diagnostics.time_shift],
+                                               orientations=True)
+    # Camera axes map through the same change of basis as the positions
+    cameras = Rotation.from_quat(quaternions[0][mask]).as_matrix()
+    direction = np.array([0.0, 0.0, -1.0])
+    expected = np.einsum('ij,njk,k->ni', R @ Y_UP_TO_Z_UP, cameras, direction)
+    actual = Rotation.from_quat(world[mask]).apply(Y_UP_TO_Z_UP @ direction)
+    np.testing.assert_allclose(actual, expected, atol=1e-9)
+    assert np.isnan(world[~mask]).all(), "Unpaired orientation."
+    np.testing.assert_allclose(world_orientations(quaternions[0][mask],
+                                                  np.identity(3)),
+                               world_orientations(quaternions[0],
+                                                  np.identity(3))[mask])
+
+
+def test_aligner_yaw_3D():
+    base_path = Path(__file__).parent
+    pose_folder = base_path / 'rtk_test_data_2/cameras'
+    poses = load_poses(str(pose_folder))
+    rtk_data_folder = base_path / 'rtk_test_data_2/rtk'
+    rtk_data, _ = load_rtk_data(str(rtk_data_folder))
+    shifted_poses, shifted_rtk, variances = data_association(
+        poses, rtk_data, 0)
+    R, t, error = aligner_yaw_3D(shifted_poses, shifted_rtk)
+    assert R.shape == (3, 3), "Size not match."
+    assert np.isclose(np.linalg.det(R), 1.0), "R is not a rotation matrix."
+    assert np.allclose(R[2], [0, 0, 1]), "R is not a yaw rotation."
+    assert t.shape == (3, ), "Size not match."
+    assert 0 < error < 0.5, "Error not correct."
+    # A known yaw and translation is recovered exactly
+    yaw = 0.3
+    R_true = np.array([[np.cos(yaw), -np.sin(yaw), 0],
+                       [np.sin(yaw), np.cos(yaw), 0], [0, 0, 1]])
+    t_true = np.array([1.0, -2.0, 3.0])
+    rtk_true = np.array(shifted_poses) @ R_true.T + t_true
+    R, t, error = aligner_yaw_3D(shifted_poses, rtk_true)
+    np.testing.assert_allclose(R, R_true, atol=1e-9)
+    np.testing.assert_allclose(t, t_true, atol=1e-9)
+    assert error < 1e-9, "Error not correct."
+    assert aligner_yaw_3D(shifted_poses[:1], shifted_rtk[:1]) == (None, None,
+                                                                  None)
+
+
+def test_coarse_to_fine_align_yaw():
+    base_path = Path(__file__).parent
+    pose_folder = base_path / 'rtk_test_data_2/cameras'
+    poses = load_poses(str(pose_folder))
+    rtk_data_folder = base_path / 'rtk_test_data_2/rtk'
+    rtk_data, _ = load_rtk_data(str(rtk_data_folder))
+    R, t, error = coarse_to_fine_align(poses, rtk_data, mode='yaw')
+    assert R.shape == (3, 3), "Size not match."
+    assert np.isclose(np.linalg.det(R), 1.0), "R is not a rotation matrix."
+    assert t.shape == (3, ), "Size not match."
+    assert 0 <= error < 0.5, "Error not correct."
+    coarse_R, coarse_t, coarse_error, _ = coarse_aligner_3D(poses,
+                                                            rtk_data, [-1, 1],
+                                                            0.1,
+                                                            mode='yaw')
+    assert error <= coarse_error, "Final error not less than coarse error."
+    with pytest.raises(ValueError):
+        coarse_to_fine_align(poses, rtk_data, mode='4d')
+
+
+def test_residual_diagnostics():
+    residuals = np.array([[3.0, 4.0, 0.0], [0.0, 0.0, 1.0], [0.0, 2.0, 0.0],
+                          [1.0, 0.0, 0.0]])
+    variances = np.array([[0.01, 0, 0], [0.01, 0, 0], [1.0, 0, 0],
+                          [0.5, 0, 0]])
+    diagnostics = residual_diagnostics(residuals, variances)
+    np.testing.assert_allclose(diagnostics.errors, [5.0, 1.0, 2.0, 1.0])
+    assert diagnostics.mean_error == 2.25, "Mean error wrong."
+    assert np.isclose(diagnostics.rmse, np.sqrt(31 / 4)), "RMSE wrong."
+    assert diagnostics.median_error == 1.5, "Median error wrong."
+    assert diagnostics.max_error == 5.0, "Max error wrong."
+    assert set(diagnostics.percentiles) == {50, 90, 95, 99}
+    assert diagnostics.by_status['固定解'].count == 2, "Fixed count wrong."
+    assert diagnostics.by_status['固定解'].mean_error == 3.0
+    assert diagnostics.by_status['浮点解'].rmse == 2.0, "Float rmse wrong."
+    assert diagnostics.by_status['0.5'].count == 1, "Unknown status wrong."
+
+
+def test_aligner_diagnostics():
+    base_path = Path(__file__).parent
+    pose_folder = base_path / 'rtk_test_data_2/cameras'
+    poses = load_poses(str(pose_folder))
+    rtk_data_folder = base_path / 'rtk_test_data_2/rtk'
+    rtk_data, _ = load_rtk_data(str(rtk_data_folder))
+    shifted_poses, shifted_rtk, variances = data_association(
+        poses, rtk_data, 0)
+    R, t, error, diagnostics = aligner_SVD_3D(shifted_poses,
+                                              shifted_rtk,
+                                              variances,
+                                              return_diagnostics=True)
+    assert diagnostics.residuals.shape == (len(shifted_poses), 3)
+    assert np.isclose(diagnostics.mean_error, error), "Error not match."
+    assert diagnostics.by_status['固定解'].count == len(shifted_poses)
+    R, t, error, diagnostics = aligner_SVD_2D(shifted_poses,
+                                              shifted_rtk,
+                                              return_diagnostics=True)
+    assert diagnostics.residuals.shape == (len(shifted_poses), 2)
+    assert np.isclose(diagnostics.mean_error, error), "Error not match."
+
+
+def test_coarse_to_fine_align_diagnostics():
+    base_path = Path(__file__).parent
+    pose_folder = base_path / 'rtk_test_data_2/cameras'
+    poses = load_poses(str(pose_folder))
+    rtk_data_folder = base_path / 'rtk_test_data_2/rtk'
+    rtk_data, _ = load_rtk_data(str(rtk_data_folder))
+    for mode in ['3d', 'yaw']:
+        R, t, error, diagnostics = coarse_to_fine_align(
+            poses, rtk_data, mode=mode, return_diagnostics=True)
+        assert np.isclose(diagnostics.mean_error, error), "Error not match."
+        assert diagnostics.rmse >= diagnostics.mean_error, "RMSE wrong."
+        shifted_poses, shifted_rtk, _ = data_association(
+            poses, rtk_data, diagnostics.time_shift)
+        assert diagnostics.count == len(shifted_poses), "Count not match."
+        np.testing.assert_allclose(
+            diagnostics.residuals,
+            np.array(shifted_rtk) - (np.array(shifted_poses) @ R.T + t),
+            atol=1e-9)
+        curve = diagnostics.coarse_cost_curve
+        assert len(curve.errors) == len(curve.time_shifts) == 21
+        assert curve.errors[curve.best_index] == curve.errors.min()
+        assert diagnostics.cost_curve.pair_counts.min() > 0
+
+
+def test_estimate_time_shift():
+    base_path = Path(__file__).parent
+    poses = load_poses(str(base_path / 'test_datas/cameras'))
+    rtk_data, _ = load_rtk_data(str(base_path / 'test_datas/rtk'))
+    R, t, error, diagnostics = coarse_to_fine_align(poses,
+                                                    rtk_data,
+                                                    mode='yaw',
+                                                    return_diagnostics=True)
+    time_shift = estimate_time_shift(poses, rtk_data)
+    assert abs(time_shift - diagnostics.time_shift) <= 0.2, "Seed too far."
+    assert estimate_time_shift(poses[:1], rtk_data) is None
+
+
+def test_coarse_to_fine_align_budget():
+    base_path = Path(__file__).parent
+    poses = load_poses(str(base_path / 'rtk_test_data_2/cameras'))
+    rtk_data, _ = load_rtk_data(str(base_path / 'rtk_test_data_2/rtk'))
+    R, t, error = coarse_to_fine_align(poses, rtk_data, mode='yaw')
+    calls = []
+    anytime_R, anytime_t, anytime_error, diagnostics = coarse_to_fine_align(
+        poses,
+        rtk_data,
+        mode='yaw',
+        progress=lambda *args: calls.append(args),
+        anytime=True,
+        return_diagnostics=True)
+    # An unlimited budget converges to the full sweep result
+    assert diagnostics.converged, "Search not converged."
+    assert anytime_error == pytest.approx(error), "Error not match."
+    np.testing.assert_allclose(anytime_R, R)
+    assert calls[-1][:3] == ('fine', 20, 20), "Progress not complete."
+    assert [call[1] for call in calls if call[0] == 'coarse'][-1] == 21
+
+    # The evaluation budget stops in the coarse sweep, which starts at the prior
+    budget_R, _, budget_error, diagnostics = coarse_to_fine_align(
+        poses,
+        rtk_data,
+        mode='yaw',
+        max_evaluations=5,
+        prior_time_shift=0.0,
+        anytime=True,
+        return_diagnostics=True)
+    assert not diagnostics.converged, "Search converged."
+    assert budget_R is not None, "No transform found."
+    curve = diagnostics.cost_curve
+    assert curve.evaluated.sum() == 5, "Not 5 evaluations."
+    assert np.abs(curve.time_shifts[curve.evaluated]).max() <= 0.2 + 1e-9
+    assert np.all(np.isinf(curve.errors[~curve.evaluated]))
+    assert budget_error <= 1.1 * error, "Early result too poor."
+    with pytest.raises(SearchStopped):
+        coarse_to_fine_align(poses, rtk_data, mode='yaw', max_evaluations=5)
+
+    cancel = threading.Event()
+    cancel.set()
+    cancelled = coarse_to_fine_align(poses,
+                                     rtk_data,
+                                     mode='yaw',
+                                     cancel=cancel,
+                                     anytime=True,
+                                     return_diagnostics=True)
+    assert cancelled[0] is None and cancelled[3].converged is False
+    # A truncated result must be told apart from a converged one
+    with pytest.raises(ValueError):
+        coarse_to_fine_align(poses,
+                             rtk_data,
+                             mode='yaw',
+                             cancel=cancel,
+                             anytime=True)
+
+
+def test_shift_overlap():
+    base_path = Path(__file__).parent
+    poses = load_poses(str(base_path / 'test_datas/cameras'))
+    rtk_data, _ = load_rtk_data(str(base_path / 'test_datas/rtk'))
+    time_shifts = np.arange(-60, 60, 0.5)
+    _, _, mask, _ = associate_shifts(poses, rtk_data, time_shifts)
+    np.testing.assert_array_equal(
+        shift_overlap(poses, rtk_data, time_shifts), mask.sum(axis=1))
+    left_edge, right_edge = feasible_time_shift_interval(poses, rtk_data)
+    assert left_edge < -1 and right_edge > 1, "Interval too small."
+    counts = shift_overlap(poses, rtk_data, [left_edge, 0, right_edge])
+    assert counts[0] >= counts[1] / 2 and counts[2] >= counts[1] / 2
+
+
+def test_coarse_aligner_feasible_shifts():
+    base_path = Path(__file__).parent
+    poses = load_poses(str(base_path / 'test_datas/cameras'))
+    rtk_data, _ = load_rtk_data(str(base_path / 'test_datas/rtk'))
+    # A short capture against a wide interval, most shifts pair nothing
+    R, t, error, time_shift, diagnostics = coarse_aligner_3D(
+        poses[:6], rtk_data, [-30, 30], return_diagnostics=True)
+    curve = diagnostics.cost_curve
+    assert R is not None, "No transform found."
+    assert not curve.evaluated[curve.pair_counts < 3].any()
+    assert np.all(np.isinf(curve.errors[~curve.evaluated]))
+    # Early stopping is opt-in and skips the rising part of the cost curve
+    for mode in ['3d', 'yaw']:
+        full = coarse_to_fine_align(poses, rtk_data, mode=mode)
+        assert coarse_to_fine_align(poses, rtk_data, mode=mode,
+                                    early_stop=True)[2] == full[2]
+    *_, diagnostics = coarse_aligner_3D(poses,
+                                        rtk_data,
+                                        return_diagnostics=True)
+    assert diagnostics.cost_curve.evaluated.sum() == 21, "Stopped early."
+    R, t, error, time_shift, diagnostics = coarse_aligner_3D(
+        poses, rtk_data, return_diagnostics=True, early_stop=True)
+    assert diagnostics.cost_curve.evaluated.sum() < 21, "Not stopped early."
+    # The derived interval finds the same time shift
+    _, _, _, auto_time_shift = coarse_aligner_3D(poses,
+                                                 rtk_data,
+                                                 None,
+                                                 mode='yaw')
+    assert abs(auto_time_shift - time_shift) <= 0.1 + 1e-9
+
+
+def test_shift_cache():
+    base_path = Path(__file__).parent
+    poses = load_poses(str(base_path / 'rtk_test_data_2/cameras'))
+    rtk_data, _ = load_rtk_data(str(base_path / 'rtk_test_data_2/rtk'))
+    shift_cache.clear()
+    R, t, error, diagnostics = coarse_to_fine_align(poses,
+                                                    rtk_data,
+                                                    early_stop=False,
+                                                    return_diagnostics=True)
+    evaluated = (diagnostics.cost_curve.evaluated.sum() +
+                 diagnostics.coarse_cost_curve.evaluated.sum())
+    # The fine grid shares its first point with the coarse grid
+    assert shift_cache.misses > 0, "Nothing evaluated."
+    assert shift_cache.hits >= 1, "Coarse shift evaluated again."
+    assert shift_cache.hits + shift_cache.misses == evaluated
+    misses = shift_cache.misses
+    cached = coarse_to_fine_align(poses,
+                                  rtk_data,
+                                  early_stop=False,
+                                  return_diagnostics=True)
+    assert shift_cache.misses == misses, "Cached shift evaluated again."
+    np.testing.assert_array_equal(cached[0], R)
+    np.testing.assert_array_equal(cached[1], t)
+    assert cached[2] == error, "Error not match."
+    np.testing.assert_allclose(cached[3].residuals, diagnostics.residuals)
+    np.testing.assert_array_equal(cached[3].cost_curve.errors,
+                                  diagnostics.cost_curve.errors)
+    # The yaw mode has its own entries
+    coarse_to_fine_align(poses, rtk_data, mode='yaw')
+    assert shift_cache.misses > misses, "Mode not part of the key."
+    max_size, shift_cache.max_size = shift_cache.max_size, 0
+    try:
+        shift_cache.clear()
+        coarse_to_fine_align(poses, rtk_data)
+        assert len(shift_cache) == 0 and shift_cache.hits == 0
+    finally:
+        shift_cache.max_size = max_size
+
+
+def test_shift_cache_injected():
+    base_path = Path(__file__).parent
+    poses = load_pose_track(str(base_path / 'rtk_test_data_2/cameras'))
+    rtk_data, _ = load_rtk_data(str(base_path / 'rtk_test_data_2/rtk'))
+    shift_cache.clear()
+    cache = ShiftCache()
+    calls = []
+
+    def counting_fingerprint(pose_data, rtk_data):
+        calls.append(1)
+        return track_fingerprint(pose_data, rtk_data)
+
+    with patch('modelAlign.align.track_fingerprint', counting_fingerprint):
+        # The ordered search evaluates many blocks in both stages
+        expected = coarse_to_fine_align(poses,
+                                        rtk_data,
+                                        mode='yaw',
+                                        prior_time_shift=0.0,
+                                        cache=cache)
+    assert len(calls) == 1, "Tracks fingerprinted more than once."
+    assert cache.misses > 0 and len(shift_cache) == 0, "Cache not injected."
+    # Threads share the cache, the counters stay consistent
+    misses = cache.misses
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            coarse_to_fine_align(poses, rtk_data, mode='yaw', cache=cache)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4 and all(
+        result[2] == expected[2] for result in results)
+    assert cache.misses == misses, "Cached shift evaluated again."
+
+
+def test_align_shifts_blocks():
+    base_path = Path(__file__).parent
+    poses = load_pose_track(str(base_path / 'rtk_test_data_2/cameras'))
+    rtk_data, _ = load_rtk_data(str(base_path / 'rtk_test_data_2/rtk'))
+    shift_cache.clear()
+    sizes = []
+
+    def recording_associate_shifts(pose_data, rtk_data, time_shifts, **kwargs):
+        sizes.append(len(time_shifts))
+        return associate_shifts(pose_data, rtk_data, time_shifts, **kwargs)
+
+    for mode in ('3d', 'yaw'):
+        expected = coarse_aligner_3D(poses, rtk_data, [-2, 2], mode=mode)
+        shift_cache.clear()
+        with patch('modelAlign.align.associate_shifts',
+                   recording_associate_shifts):
+            result = coarse_aligner_3D(poses, rtk_data, [-2, 2], mode=mode)
+        assert max(sizes) <= SEARCH_BLOCK, "Shifts not associated in blocks."
+        assert result[2] == expected[2] and result[3] == expected[3]
+    # The derived interval spans the whole overlap of the tracks
+    sizes.clear()
+    shift_cache.clear()
+    with patch('modelAlign.align.associate_shifts',
+               recording_associate_shifts):
+        *_, diagnostics = coarse_aligner_3D(poses,
+                                            rtk_data,
+                                            None,
+                                            return_diagnostics=True)
+    assert diagnostics.cost_curve.evaluated.sum() > SEARCH_BLOCK
+    assert max(sizes) <= SEARCH_BLOCK, "Shifts not associated in blocks."
+
+
+def test_ordered_search_feasibility_once():
+    base_path = Path(__file__).parent
+    poses = load_pose_track(str(base_path / 'rtk_test_data_2/cameras'))
+    rtk_data, _ = load_rtk_data(str(base_path / 'rtk_test_data_2/rtk'))
+    expected = coarse_aligner_3D(poses, rtk_data, mode='yaw')
+    shift_cache.clear()
+    min_pairs = []
+    sizes = []
+
+    def counting_min_pairs(*args):
+        min_pairs.append(1)
+        return _min_pairs(*args)
+
+    def recording_associate_shifts(pose_data, rtk_data, time_shifts, **kwargs):
+        sizes.append(len(time_shifts))
+        return associate_shifts(pose_data, rtk_data, time_shifts, **kwargs)
+
+    with patch('modelAlign.align._min_pairs', counting_min_pairs), \
+            patch('modelAlign.align.associate_shifts',
+                  recording_associate_shifts):
+        *result, diagnostics = coarse_aligner_3D(poses,
+                                                 rtk_data,
+                                                 mode='yaw',
+                                                 prior_time_shift=0.0,
+                                                 return_diagnostics=True)
+    assert result[2] == pytest.approx(expected[2]), "Error not match."
+    assert len(min_pairs) == 1, "Feasibility computed per block."
+    # One association per block, and one for the residuals of the best shift
+    n_blocks = -(-int(diagnostics.cost_curve.evaluated.sum()) // SEARCH_BLOCK)
+    assert len(sizes) == n_blocks + 1 and sizes[-1] == 1
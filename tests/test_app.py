@@ -1,9 +1,13 @@
+import shutil
 import numpy as np
 
 from pathlib import Path
 
 from modelAlign.app import to_geoJson
 from modelAlign.app import alignment
+from modelAlign.app import multi_session_alignment
+from modelAlign import app
+from modelAlign.data_preprocessing import load_rtk_track
 
 
 def test_to_geoJson():
@@ -41,3 +45,74 @@ def test_alignment():
     json = alignment(str(rtk_data_folder), str(pose_folder))
     assert json is not None, "No JSON returned."
     print(json)
+
+
+def test_alignment_yaw():
+    base_path = Path(__file__).parent
+    pose_folder = base_path / 'rtk_test_data_2/cameras'
+    rtk_data_folder = base_path / 'rtk_test_data_2/rtk'
+    json = alignment(str(rtk_data_folder), str(pose_folder), mode='yaw')
+    q = json["quaternion"]
+    # Yaw only rotation is around the z axis
+    assert np.isclose(q[0], 0.0) and np.isclose(q[1], 0.0), "Not yaw only."
+
+
+def test_multi_session_alignment(tmp_path):
+    base_path = Path(__file__).parent
+    # One RTK log covering two AR sessions
+    rtk_data_folder = tmp_path / 'rtk'
+    rtk_data_folder.mkdir()
+    for session in ['rtk_test_data', 'rtk_test_data_2']:
+        for path in (base_path / session / 'rtk').iterdir():
+            shutil.copy(path, rtk_data_folder / path.name)
+    pose_folders = [
+        str(base_path / 'rtk_test_data/cameras'),
+        str(base_path / 'rtk_test_data_2/cameras'),
+        str(base_path / 'test_datas/cameras')
+    ]
+    results = multi_session_alignment(str(rtk_data_folder),
+                                      pose_folders,
+                                      mode='yaw')
+    assert results[2] is None, "Session without RTK overlap aligned."
+    for pose_folder, json in zip(pose_folders[:2], results[:2]):
+        assert json['origin'] == results[0]['origin'], "Origin not shared."
+        expected = alignment(str(rtk_data_folder), pose_folder, mode='yaw')
+        np.testing.assert_allclose(json['quaternion'], expected['quaternion'])
+        np.testing.assert_allclose(json['translation'],
+                                   expected['translation'])
+    parallel = multi_session_alignment(str(rtk_data_folder),
+                                       pose_folders,
+                                       workers=2,
+                                       mode='yaw')
+    assert parallel == results, "Parallel results not match."
+    diagnosed = multi_session_alignment(str(rtk_data_folder),
+                                        pose_folders,
+                                        workers=2,
+                                        mode='yaw',
+                                        return_diagnostics=True)
+    assert diagnosed[2] is None, "Session without RTK overlap aligned."
+    for json, (diagnosed_json, diagnostics) in zip(results[:2],
+                                                   diagnosed[:2]):
+        assert diagnosed_json == json, "Results not match."
+        assert diagnostics.cost_curve is not None, "No diagnostics."
+
+
+def test_multi_session_rtk_slice(monkeypatch):
+    base_path = Path(__file__).parent / 'rtk_test_data_2'
+    sliced = []
+
+    def recording_align(poses, rtk_track, **kwargs):
+        sliced.append((poses['timeStamp'][[0, -1]], rtk_track['timeStamp']))
+        return None, None, None
+
+    monkeypatch.setattr(app, 'coarse_to_fine_align', recording_align)
+    multi_session_alignment(str(base_path / 'rtk'),
+                            [str(base_path / 'cameras')],
+                            time_shift_interval=[-0.5, 0.5],
+                            coarse_step=0.1,
+                            fine_step=0.02)
+    (start, end), rtk_times = sliced[0]
+    full = load_rtk_track(str(base_path / 'rtk'))[0]['timeStamp']
+    # The fine search reaches one coarse step beyond the interval
+    inside = (full >= start - 0.6) & (full <= end + 0.6)
+    np.testing.assert_array_equal(rtk_times, full[inside])
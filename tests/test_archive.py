@@ -0,0 +1,95 @@
+import tarfile
+import zipfile
+import numpy as np
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+from modelAlign import archive
+from modelAlign.archive import split_archive_path, find_archive_folder
+from modelAlign.archive import map_archive_files
+from modelAlign.data_preprocessing import load_pose_track, load_rtk_track
+from modelAlign.data_preprocessing import read_all_rtk_data
+from modelAlign.data_preprocessing import _read_pose_member
+from modelAlign.app import alignment, archive_alignment
+
+
+def _write_archives(tmp_path):
+    base_path = Path(__file__).parent / 'rtk_test_data_2'
+    zip_path = tmp_path / 'capture.zip'
+    with zipfile.ZipFile(zip_path, 'w') as capture:
+        for path in sorted(base_path.rglob('*.json')):
+            capture.write(path, 'capture/' + str(path.relative_to(base_path)))
+    tar_path = tmp_path / 'capture.tar.gz'
+    with tarfile.open(tar_path, 'w:gz') as capture:
+        capture.add(base_path, arcname='.')
+    return base_path, zip_path, tar_path
+
+
+def test_split_archive_path(tmp_path):
+    _, zip_path, _ = _write_archives(tmp_path)
+    assert split_archive_path(str(zip_path / 'capture' / 'cameras')) == (
+        str(zip_path), 'capture/cameras')
+    assert split_archive_path(str(zip_path)) == (str(zip_path), '')
+    assert split_archive_path(str(tmp_path)) is None
+    assert split_archive_path(str(tmp_path / 'missing' / 'cameras')) is None
+    assert find_archive_folder(str(zip_path), 'cameras') == 'capture/cameras'
+    with pytest.raises(ValueError):
+        find_archive_folder(str(zip_path), 'lidar')
+
+
+@pytest.mark.parametrize('kind', ['zip', 'tar'])
+def test_load_tracks_from_archive(tmp_path, kind):
+    base_path, zip_path, tar_path = _write_archives(tmp_path)
+    if kind == 'zip':
+        rtk_folder = str(zip_path / 'capture' / 'rtk')
+        pose_folder = str(zip_path / 'capture' / 'cameras')
+    else:
+        rtk_folder = str(tar_path / 'rtk')
+        pose_folder = str(tar_path / 'cameras')
+    poses = load_pose_track(pose_folder, orientation=True)
+    expected_poses = load_pose_track(str(base_path / 'cameras'),
+                                     orientation=True)
+    for key, column in expected_poses.items():
+        np.testing.assert_array_equal(poses[key], column)
+    rtk_track, origin, _ = load_rtk_track(rtk_folder)
+    expected_rtk, expected_origin, _ = load_rtk_track(str(base_path / 'rtk'))
+    assert origin == expected_origin, "Origin not match."
+    for key, column in expected_rtk.items():
+        np.testing.assert_array_equal(rtk_track[key], column)
+    start, end = expected_rtk['timeStamp'][[10, 20]]
+    assert len(read_all_rtk_data(rtk_folder, time_range=[start, end])) == 11
+    assert alignment(rtk_folder, pose_folder) == alignment(
+        str(base_path / 'rtk'), str(base_path / 'cameras'))
+
+
+def test_map_archive_files_parallel(tmp_path, monkeypatch):
+    _, zip_path, _ = _write_archives(tmp_path)
+    sequential = map_archive_files(_read_pose_member, str(zip_path),
+                                   'capture/cameras')
+    parallel = map_archive_files(_read_pose_member,
+                                 str(zip_path),
+                                 'capture/cameras',
+                                 workers=3)
+    assert len(parallel) == len(sequential) > 0
+    for pose, expected in zip(parallel, sequential):
+        assert pose['timeStamp'] == expected['timeStamp']
+        np.testing.assert_array_equal(pose['matrix'], expected['matrix'])
+    # Large archives are parsed in parallel by default
+    monkeypatch.setattr(archive, 'PARALLEL_MIN_MEMBERS', 10)
+    monkeypatch.setattr(archive, 'ARCHIVE_WORKERS', 2)
+    poses = load_pose_track(str(zip_path / 'capture' / 'cameras'))
+    assert poses['timeStamp'].tolist() == sorted(
+        pose['timeStamp'] for pose in sequential)
+
+
+def test_archive_alignment(tmp_path):
+    base_path, zip_path, tar_path = _write_archives(tmp_path)
+    expected = alignment(str(base_path / 'rtk'), str(base_path / 'cameras'))
+    assert archive_alignment(str(zip_path), workers=1) == expected
+    # The tar archive is decompressed in one pass for both folders
+    with patch('tarfile.open', wraps=tarfile.open) as opener:
+        assert archive_alignment(str(tar_path)) == expected
+    assert [call.kwargs.get('mode') for call in opener.call_args_list
+            ].count('r|*') == 1, "Archive read more than once."
+    with pytest.raises(ValueError):
+        archive_alignment(str(tar_path), pose_name='lidar')
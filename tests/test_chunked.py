@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+from modelAlign.chunked import track_chunks, iter_pose_chunks
+from modelAlign.chunked import chunked_coarse_to_fine_align, chunked_alignment
+from modelAlign.chunked import _associated_chunks
+from modelAlign.align import coarse_to_fine_align, associate_shifts
+from modelAlign.data_preprocessing import load_pose_track, load_rtk_track
+from modelAlign.app import alignment
+
+DATA_FOLDERS = ['rtk_test_data', 'rtk_test_data_2', 'test_datas']
+
+
+def _tracks(folder):
+    base_path = Path(__file__).parent / folder
+    poses = load_pose_track(str(base_path / 'cameras'))
+    rtk_track, origin, _ = load_rtk_track(str(base_path / 'rtk'))
+    return poses, rtk_track, origin
+
+
+@pytest.mark.parametrize('folder', DATA_FOLDERS)
+@pytest.mark.parametrize('mode', ['3d', 'yaw'])
+def test_chunked_coarse_to_fine_align(folder, mode):
+    poses, rtk_track, _ = _tracks(folder)
+    R, t, error = coarse_to_fine_align(poses,
+                                       rtk_track,
+                                       mode=mode,
+                                       early_stop=False)
+    # Odd chunk sizes put chunk boundaries everywhere
+    chunked = chunked_coarse_to_fine_align(
+        lambda: track_chunks(poses, 7), lambda: track_chunks(rtk_track, 5),
+        mode=mode)
+    np.testing.assert_allclose(chunked[0], R, atol=1e-9)
+    np.testing.assert_allclose(chunked[1], t, atol=1e-8)
+    assert chunked[2] == pytest.approx(error, abs=1e-9), "Error not match."
+
+
+def test_chunked_pose_window():
+    poses, rtk_track, _ = _tracks('rtk_test_data_2')
+    R, t, error = coarse_to_fine_align(poses, rtk_track, [-3, 3])
+    sizes = []
+
+    def recording_associate_shifts(pose_data, rtk_data, time_shifts, **kwargs):
+        sizes.append(len(pose_data['timeStamp']))
+        return associate_shifts(pose_data, rtk_data, time_shifts, **kwargs)
+
+    with patch('modelAlign.chunked.associate_shifts',
+               recording_associate_shifts):
+        chunked = chunked_coarse_to_fine_align(
+            lambda: track_chunks(poses, 7),
+            lambda: track_chunks(rtk_track, 50), [-3, 3],
+            chunk_size=40)
+    # The RTK chunks and the coarse shifts are split to bound the window
+    assert max(sizes) < 2 * 40, "Pose window not bounded."
+    np.testing.assert_allclose(chunked[0], R, atol=1e-9)
+    np.testing.assert_allclose(chunked[1], t, atol=1e-8)
+    assert chunked[2] == pytest.approx(error, abs=1e-9), "Error not match."
+
+
+def test_associated_chunks():
+    poses, rtk_track, _ = _tracks('rtk_test_data_2')
+    time_shifts = np.arange(-1, 1.1, 0.1)
+    expected_poses, expected_rtk, expected_mask, _ = associate_shifts(
+        poses, rtk_track, time_shifts)
+    chunks = list(
+        _associated_chunks(track_chunks(poses, 3), track_chunks(rtk_track, 4),
+                           time_shifts))
+    np.testing.assert_array_equal(
+        np.concatenate([chunk[2] for chunk in chunks], axis=1), expected_mask)
+    np.testing.assert_array_equal(
+        np.concatenate([chunk[1] for chunk in chunks]), expected_rtk)
+    np.testing.assert_allclose(np.concatenate([chunk[0] for chunk in chunks],
+                                              axis=1),
+                               expected_poses,
+                               equal_nan=True)
+
+
+def test_chunked_alignment():
+    base_path = Path(__file__).parent / 'rtk_test_data'
+    expected = alignment(str(base_path / 'rtk'), str(base_path / 'cameras'))
+    result = chunked_alignment(str(base_path / 'rtk'),
+                               str(base_path / 'cameras'),
+                               chunk_size=4)
+    assert result['origin'] == expected['origin'], "Origin not match."
+    np.testing.assert_allclose(result['quaternion'],
+                               expected['quaternion'],
+                               atol=1e-9)
+    np.testing.assert_allclose(result['translation'],
+                               expected['translation'],
+                               atol=1e-8)
+
+
+def test_iter_pose_chunks_order(tmp_path):
+    base_path = Path(__file__).parent / 'rtk_test_data_2' / 'cameras'
+    poses = load_pose_track(str(base_path))
+    chunks = list(iter_pose_chunks(str(base_path), 4))
+    np.testing.assert_array_equal(
+        np.concatenate([chunk['timeStamp'] for chunk in chunks]),
+        poses['timeStamp'])
+    # A file named out of order overlaps the previous chunk
+    files = sorted(base_path.glob('*.json'), key=lambda path: float(path.stem))
+    for index, path in enumerate(files):
+        name = path.name if index else '9' * 20 + '.json'
+        (tmp_path / name).write_bytes(path.read_bytes())
+    with pytest.raises(ValueError):
+        list(iter_pose_chunks(str(tmp_path), 4))
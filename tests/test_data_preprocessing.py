@@ -1,4 +1,6 @@
+import datetime
 import json
+import shutil
 import numpy as np
 import pytest
 from pathlib import Path
@@ -6,6 +8,19 @@ from modelAlign.data_preprocessing import read_pose, pose_to_local, read_rtk_dat
 from modelAlign.data_preprocessing import rtk_data_to_local, read_all_rtk_data
 from modelAlign.data_preprocessing import find_rtk_data_origin, load_rtk_data
 from modelAlign.data_preprocessing import load_poses
+from modelAlign.data_preprocessing import encode_diff_status, rtk_data_to_track
+from modelAlign.data_preprocessing import transfer_rtk_track_to_local
+from modelAlign.data_preprocessing import transfer_all_rtk_data_to_local
+from modelAlign.data_preprocessing import load_rtk_track
+from modelAlign.data_preprocessing import iter_rtk_data, read_rtk_track
+from modelAlign.data_preprocessing import load_pose_track, slice_track
+from modelAlign.data_preprocessing import compact_track, read_all_pose
+from modelAlign.data_preprocessing import time_index, indexed_files
+from modelAlign.data_preprocessing import TIME_INDEX_FILENAME
+from modelAlign.data_preprocessing import iter_nmea_data, decode_diff_status
+from modelAlign.app import alignment
+from scipy.spatial.transform import Rotation
+from modelAlign.align import coarse_to_fine_align
 
 from unittest.mock import patch
 
@@ -203,3 +218,362 @@ def test_load_poses():
         timestamps), "Poses data is not sorted by timeStamp."
     # assert length
     assert len(all_poses) == 258, "Data length not match."
+
+
+def test_encode_diff_status():
+    codes = encode_diff_status(['固定解', '浮点解', '码差分', '单点解', 'other'])
+    assert codes.dtype == np.uint8, "Codes dtype wrong."
+    assert codes.tolist() == [0, 1, 2, 3, 4], "Codes not match."
+    assert len(encode_diff_status([])) == 0, "Empty codes wrong."
+
+
+def test_transfer_rtk_track_to_local():
+    base_path = Path(__file__).parent
+    rtk_data_folder = base_path / 'rtk_test_data_2/rtk'
+    rtk_data = read_all_rtk_data(str(rtk_data_folder))
+    rtk_data[1]['diffStatus'] = '浮点解'
+    rtk_data[2]['diffStatus'] = '单点解'
+    rtk_data[3]['diffStatus'] = 'other'
+    # An empty status is not a fixed solution either
+    rtk_data[4]['diffStatus'] = ''
+    origin = find_rtk_data_origin(rtk_data)
+    rtk_track = rtk_data_to_track(rtk_data)
+    assert find_rtk_data_origin(rtk_track) == origin, "Origin not match."
+    local_track, diagnostics = transfer_rtk_track_to_local(rtk_track, origin)
+    # Same records as the per datum conversion
+    expected = [rtk_data_to_local(datum, origin) for datum in rtk_data]
+    expected = [datum for datum in expected if not datum['is_bad_data']]
+    assert len(local_track['x']) == len(expected), "Data length not match."
+    for key in ['timeStamp', 'x', 'y', 'z', 'variance']:
+        np.testing.assert_array_equal(local_track[key],
+                                      [datum[key] for datum in expected])
+    assert transfer_all_rtk_data_to_local(rtk_data, origin) == expected
+    # Rejected counts
+    assert diagnostics['total'] == len(rtk_data), "Total count wrong."
+    assert diagnostics['kept'] == len(expected), "Kept count wrong."
+    assert diagnostics['rejected_by_status'] == {
+        '浮点解': 1,
+        '单点解': 1,
+        'unknown': 2
+    }, "Rejected counts wrong."
+
+
+def test_find_rtk_data_origin_without_fixed():
+    rtk_track = {
+        'latitude': np.array([1.0, 2.0, 3.0]),
+        'longitude': np.array([4.0, 5.0, 6.0]),
+        'horizontalAccuracy': np.array([0.5, 0.2, 0.2]),
+        'verticalAccuracy': np.array([0.1, 0.3, 0.3]),
+        'diffStatus': encode_diff_status(['浮点解', '单点解', '浮点解'])
+    }
+    # First datum with the lowest max(horizontal, vertical) accuracy
+    assert find_rtk_data_origin(rtk_track) == [2.0, 5.0], "Origin wrong."
+
+
+def test_load_rtk_track():
+    base_path = Path(__file__).parent
+    rtk_data_folder = base_path / 'test_datas/rtk'
+    local_track, origin, diagnostics = load_rtk_track(str(rtk_data_folder))
+    all_rtk_data, expected_origin = load_rtk_data(str(rtk_data_folder))
+    assert origin == expected_origin, "Origin not match."
+    assert len(local_track['x']) == len(all_rtk_data), "Data length not match."
+    assert diagnostics['kept'] == len(all_rtk_data), "Kept count wrong."
+
+
+def _write_multi_record_rtk(folder, file_stamps):
+    """Write one RTK file per list of timeStamps, with the fix order reversed."""
+    folder.mkdir()
+    for i, stamps in enumerate(file_stamps):
+        entries = [{
+            'timeStamp': stamp,
+            'createTime': stamp,
+            'fixStatus': 0,
+            'latitude': '31.2271',
+            'verticalAccuracy': '0.012',
+            'height': 5.0 + i,
+            'diffStatus': '固定解',
+            'horizontalAccuracy': '0.014',
+            'longitude': '121.5454'
+        } for stamp in reversed(stamps)]
+        with open(folder / '{}.json'.format(i), 'w', encoding='utf-8') as f:
+            json.dump({'rtkData': entries}, f, ensure_ascii=False, indent=2)
+
+
+def test_iter_rtk_data(tmp_path, expected_rtk_data):
+    base_path = Path(__file__).parent
+    rtk_path = base_path / 'test_datas/rtk/1709732809.035717010498047.json'
+    # Tiny chunks split keys and entries between reads
+    assert list(iter_rtk_data(str(rtk_path),
+                              chunk_size=3)) == [expected_rtk_data]
+    _write_multi_record_rtk(tmp_path / 'rtk', [[1.0, 2.0, 3.0]])
+    for chunk_size in [1, 7, 1 << 16]:
+        stamps = [
+            data['timeStamp'] for data in iter_rtk_data(
+                str(tmp_path / 'rtk' / '0.json'), chunk_size=chunk_size)
+        ]
+        assert stamps == [3.0, 2.0, 1.0], "Not all entries read."
+
+
+def test_read_rtk_track(tmp_path):
+    _write_multi_record_rtk(tmp_path / 'rtk', [[1.0, 4.0], [3.0], [2.0, 5.0]])
+    track = read_rtk_track(str(tmp_path / 'rtk'))
+    assert track['timeStamp'].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert track['height'].tolist() == [5.0, 7.0, 6.0, 5.0, 7.0]
+    assert len(read_all_rtk_data(str(tmp_path / 'rtk'))) == 5
+    # One fix per file layout
+    base_path = Path(__file__).parent
+    rtk_data_folder = base_path / 'test_datas/rtk'
+    track = read_rtk_track(str(rtk_data_folder))
+    rtk_data = read_all_rtk_data(str(rtk_data_folder))
+    assert track['timeStamp'].tolist() == [
+        data['timeStamp'] for data in rtk_data
+    ], "Track not sorted by timeStamp."
+
+
+def test_load_pose_track():
+    base_path = Path(__file__).parent
+    pose_folder = base_path / 'test_datas/cameras'
+    track = load_pose_track(str(pose_folder))
+    all_poses = load_poses(str(pose_folder))
+    for key in ['timeStamp', 'x', 'y', 'z']:
+        assert track[key].tolist() == [pose[key] for pose in all_poses]
+    start, end = track['timeStamp'][10], track['timeStamp'][20]
+    window = slice_track(track, start, end)
+    assert window['timeStamp'].tolist() == track['timeStamp'][10:21].tolist()
+
+
+def test_load_pose_track_orientation():
+    base_path = Path(__file__).parent
+    pose_folder = base_path / 'rtk_test_data_2/cameras'
+    track = load_pose_track(str(pose_folder), orientation=True)
+    poses = read_all_pose(str(pose_folder))
+    assert track['quaternion'].shape == (len(poses), 4)
+    matrices = Rotation.from_quat(track['quaternion']).as_matrix()
+    for matrix, pose in zip(matrices, poses):
+        np.testing.assert_allclose(matrix, pose['matrix'][:3, :3], atol=1e-5)
+    assert 'quaternion' not in load_pose_track(str(pose_folder))
+
+
+def test_time_index(tmp_path):
+    base_path = Path(__file__).parent
+    pose_folder = tmp_path / 'cameras'
+    shutil.copytree(base_path / 'test_datas/cameras', pose_folder)
+    track = load_pose_track(str(pose_folder))
+    start, end = track['timeStamp'][10], track['timeStamp'][20]
+    window = load_pose_track(str(pose_folder), time_range=[start, end])
+    expected = slice_track(track, start, end)
+    for key in ['timeStamp', 'x', 'y', 'z']:
+        np.testing.assert_array_equal(window[key], expected[key])
+    assert (pose_folder / TIME_INDEX_FILENAME).exists(), "Index not saved."
+    # Only the files in the window are read once the index exists
+    with patch('modelAlign.data_preprocessing.read_pose',
+               wraps=read_pose) as reader:
+        load_poses(str(pose_folder), time_range=[start, end])
+    assert reader.call_count == 11, "Files outside the window read."
+    # New files are indexed incrementally, removed ones dropped
+    files = sorted(pose_folder.glob('*.json'), key=lambda path: path.stem)
+    files[0].rename(tmp_path / files[0].name)
+    pose = json.loads((tmp_path / files[0].name).read_text())
+    pose['globaltimestamp'] = track['timeStamp'][-1] + 1
+    (pose_folder / 'late.json').write_text(json.dumps(pose))
+    with patch('modelAlign.data_preprocessing.read_pose',
+               wraps=read_pose) as reader:
+        index = time_index(str(pose_folder), 'pose')
+    assert reader.call_count == 1, "Indexed files parsed again."
+    assert len(index['name']) == len(track['timeStamp'])
+    assert index['name'][-1] == 'late.json'
+    assert files[0].name not in index['name'].tolist()
+    assert np.all(np.diff(index['start']) >= 0), "Index not sorted."
+    with pytest.raises(ValueError):
+        time_index(str(pose_folder), 'camera')
+
+
+def test_time_index_rtk(tmp_path):
+    _write_multi_record_rtk(tmp_path / 'rtk', [[1.0, 4.0], [3.0], [2.0, 5.0],
+                                               [7.0, 8.0]])
+    folder = str(tmp_path / 'rtk')
+    paths = indexed_files(folder, 'rtk', [4.5, 6.0])
+    assert [Path(path).name for path in paths] == ['2.json']
+    track = read_rtk_track(folder, time_range=[2.0, 4.0])
+    assert track['timeStamp'].tolist() == [2.0, 3.0, 4.0]
+    rtk_data = read_all_rtk_data(folder, time_range=[2.0, 4.0])
+    assert [data['timeStamp'] for data in rtk_data] == [2.0, 3.0, 4.0]
+    # A log that grew after it was indexed is parsed again
+    grown = tmp_path / 'rtk' / '3.json'
+    content = json.loads(grown.read_text(encoding='utf-8'))
+    content['rtkData'].append(dict(content['rtkData'][0], timeStamp=9.0))
+    grown.write_text(json.dumps(content, ensure_ascii=False), encoding='utf-8')
+    track = read_rtk_track(folder, time_range=[8.5, 9.5])
+    assert track['timeStamp'].tolist() == [9.0], "Stale index used."
+    # The temporary index files are replaced or removed
+    assert sorted(path.name for path in (tmp_path / 'rtk').glob('.*')) == [
+        TIME_INDEX_FILENAME
+    ]
+    # Also when writing the index fails with any other exception
+    grown.touch()
+    with patch('modelAlign.data_preprocessing.np.savez',
+               side_effect=KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            time_index(folder, 'rtk')
+    assert sorted(path.name for path in (tmp_path / 'rtk').glob('.*')) == [
+        TIME_INDEX_FILENAME
+    ]
+    base_path = Path(__file__).parent
+    rtk_folder = tmp_path / 'full'
+    shutil.copytree(base_path / 'test_datas/rtk', rtk_folder)
+    full, _, _ = load_rtk_track(str(rtk_folder))
+    start, end = full['timeStamp'][5], full['timeStamp'][50]
+    window, _, _ = load_rtk_track(str(rtk_folder), time_range=[start, end])
+    np.testing.assert_array_equal(
+        window['timeStamp'],
+        slice_track(full, start, end)['timeStamp'])
+
+
+def test_compact_track():
+    """
+    The compact layout stores local positions as float32, which rounds them
+    by at most 2**-24 of their magnitude, 0.3 mm at 5 km from the origin.
+    The alignment accumulates in float64, so the transform moves by the same
+    order: well below a millimeter for RTK data within 5 km of the origin.
+    """
+    base_path = Path(__file__).parent
+    poses = load_pose_track(str(base_path / 'rtk_test_data_2/cameras'))
+    rtk_track, _, _ = load_rtk_track(str(base_path / 'rtk_test_data_2/rtk'))
+    compact_poses = load_pose_track(str(base_path / 'rtk_test_data_2/cameras'),
+                                    compact=True)
+    compact_rtk, _, _ = load_rtk_track(str(base_path / 'rtk_test_data_2/rtk'),
+                                       compact=True)
+    assert compact_rtk['x'].dtype == np.float32
+    assert compact_rtk['timeStamp'].dtype == np.float64
+    assert compact_rtk['diffStatus'].dtype == np.uint8
+    assert compact_poses['y'].dtype == np.float32
+    assert sum(column.nbytes for column in compact_rtk.values()) < 0.6 * sum(
+        column.nbytes for column in rtk_track.values())
+    # The RTK data moved 5 km away from the origin
+    far_rtk = dict(rtk_track,
+                   x=rtk_track['x'] + 3000.0,
+                   y=rtk_track['y'] - 4000.0)
+    for rtk_data, compact_rtk_data in [(rtk_track, compact_rtk),
+                                       (far_rtk, compact_track(far_rtk))]:
+        for mode in ['3d', 'yaw']:
+            R, t, error, diagnostics = coarse_to_fine_align(
+                poses, rtk_data, mode=mode, return_diagnostics=True)
+            compact_R, compact_t, compact_error, compact_diagnostics = \
+                coarse_to_fine_align(compact_poses,
+                                     compact_rtk_data,
+                                     mode=mode,
+                                     return_diagnostics=True)
+            assert compact_diagnostics.time_shift == diagnostics.time_shift
+            np.testing.assert_allclose(compact_R, R, atol=1e-6)
+            np.testing.assert_allclose(compact_t, t, atol=1e-3)
+            assert abs(compact_error - error) < 1e-3, "Error moved."
+
+
+def _nmea_sentence(body):
+    checksum = 0
+    for character in body:
+        checksum ^= ord(character)
+    return '${}*{:02X}\n'.format(body, checksum)
+
+
+def _nmea_coordinate(degrees, width, hemispheres):
+    hemisphere = hemispheres[0] if degrees >= 0 else hemispheres[1]
+    degrees = abs(degrees)
+    minutes = (degrees - int(degrees)) * 60
+    return '{:0{}d}{:012.9f},{}'.format(int(degrees), width, minutes,
+                                        hemisphere)
+
+
+def _nmea_epoch(time_stamp, latitude, longitude, height, quality, gst=True,
+                rmc=True):
+    moment = datetime.datetime.fromtimestamp(time_stamp,
+                                             datetime.timezone.utc)
+    time_string = '{:%H%M%S}.{:06d}'.format(moment, moment.microsecond)
+    lines = [
+        _nmea_sentence('GNGGA,{},{},{},{},12,0.6,{:.3f},M,10.2,M,1.0,0000'.format(
+            time_string, _nmea_coordinate(latitude, 2, 'NS'),
+            _nmea_coordinate(longitude, 3, 'EW'), quality, height))
+    ]
+    if rmc:
+        lines.append(
+            _nmea_sentence('GNRMC,{},A,{},{},0.0,0.0,{:%d%m%y},,,D'.format(
+                time_string, _nmea_coordinate(latitude, 2, 'NS'),
+                _nmea_coordinate(longitude, 3, 'EW'), moment)))
+    if gst:
+        lines.append(
+            _nmea_sentence('GPGST,{},0.02,0.01,0.01,0.0,0.006,0.008,0.015'.format(
+                time_string)))
+    return lines
+
+
+def test_iter_nmea_data(tmp_path):
+    midnight = datetime.datetime(2024, 3, 14,
+                                 tzinfo=datetime.timezone.utc).timestamp()
+    lines = []
+    # Fixes before the first RMC and across midnight
+    lines += _nmea_epoch(midnight - 2, 31.2, 121.5, 5.0, 4, rmc=False)
+    lines += _nmea_epoch(midnight - 1, 31.2, 121.5, 5.0, 5, gst=False)
+    lines += _nmea_epoch(midnight + 0.5, -31.2, -121.5, 5.0, 1, rmc=False)
+    lines += _nmea_epoch(midnight + 1, 31.2, 121.5, 5.0, 0)
+    lines += _nmea_epoch(midnight + 2, 31.2, 121.5, 5.0, 2)
+    lines.append('$GNGGA,000003.00,3112.0,N,12130.0,E,4,12,0.6,5.0,M,,M,,*00\n')
+    lines.append('garbage\n')
+    nmea_path = tmp_path / 'rtk.nmea'
+    nmea_path.write_text(''.join(lines))
+    data_points = list(iter_nmea_data(str(nmea_path)))
+    assert [point['timeStamp'] for point in data_points] == pytest.approx(
+        [midnight - 2, midnight - 1, midnight + 0.5, midnight + 2])
+    assert [point['diffStatus'] for point in data_points
+            ] == ['固定解', '浮点解', '单点解', '码差分']
+    assert [point['fixStatus'] for point in data_points] == [4, 5, 1, 2]
+    assert data_points[0]['latitude'] == pytest.approx(31.2)
+    assert data_points[2]['longitude'] == pytest.approx(-121.5)
+    assert data_points[0]['horizontalAccuracy'] == pytest.approx(0.01)
+    assert data_points[0]['verticalAccuracy'] == pytest.approx(0.015)
+    assert data_points[1]['horizontalAccuracy'] == float('inf')
+    assert data_points[0]['createTime'] == data_points[0]['timeStamp']
+    (tmp_path / 'undated.nmea').write_text(''.join(
+        _nmea_epoch(midnight, 31.2, 121.5, 5.0, 4, rmc=False)))
+    with pytest.raises(ValueError):
+        list(iter_nmea_data(str(tmp_path / 'undated.nmea')))
+
+
+def test_load_rtk_track_nmea(tmp_path):
+    base_path = Path(__file__).parent / 'rtk_test_data_2'
+    rtk_track = read_rtk_track(str(base_path / 'rtk'))
+    lines = []
+    for k in range(len(rtk_track['timeStamp'])):
+        status = decode_diff_status(rtk_track['diffStatus'][k:k + 1])[0]
+        quality = {'固定解': 4, '浮点解': 5, '码差分': 2, '单点解': 1}[status]
+        lines += _nmea_epoch(rtk_track['timeStamp'][k],
+                             rtk_track['latitude'][k],
+                             rtk_track['longitude'][k],
+                             rtk_track['height'][k], quality)
+    nmea_folder = tmp_path / 'rtk'
+    nmea_folder.mkdir()
+    # Two logs, split in the middle of the capture
+    middle = len(lines) // 2 - len(lines) // 2 % 3
+    (nmea_folder / 'first.nmea').write_text(''.join(lines[:middle]))
+    (nmea_folder / 'second.log').write_text(''.join(lines[middle:]))
+    nmea_track = read_rtk_track(str(nmea_folder))
+    np.testing.assert_allclose(nmea_track['timeStamp'], rtk_track['timeStamp'],
+                               atol=1e-5)
+    for key in ('latitude', 'longitude', 'height'):
+        np.testing.assert_allclose(nmea_track[key], rtk_track[key], atol=1e-9)
+    np.testing.assert_array_equal(nmea_track['diffStatus'],
+                                  rtk_track['diffStatus'])
+    local_track, origin, _ = load_rtk_track(str(nmea_folder))
+    expected_track, expected_origin, _ = load_rtk_track(str(base_path / 'rtk'))
+    assert origin == pytest.approx(expected_origin)
+    np.testing.assert_allclose(local_track['x'], expected_track['x'], atol=1e-4)
+    start, end = rtk_track['timeStamp'][[10, 20]]
+    assert len(read_all_rtk_data(str(nmea_folder), [start - 1e-6, end + 1e-6
+                                                    ])) == 11
+    assert (nmea_folder / TIME_INDEX_FILENAME).exists()
+    local_rtk_data, _ = load_rtk_data(str(nmea_folder / 'first.nmea'))
+    assert len(local_rtk_data) > 0
+    geo_json = alignment(str(nmea_folder), str(base_path / 'cameras'))
+    expected = alignment(str(base_path / 'rtk'), str(base_path / 'cameras'))
+    np.testing.assert_allclose(geo_json['translation'],
+                               expected['translation'],
+                               atol=1e-3)
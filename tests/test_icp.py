@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+from modelAlign.data_preprocessing import load_pose_track, load_rtk_track
+from modelAlign.align import aligner_yaw_3D, coarse_to_fine_align
+from modelAlign.icp import icp_align, rtk_tree
+from modelAlign.app import alignment
+
+
+def _load_test_data():
+    base_path = Path(__file__).parent
+    poses = load_pose_track(str(base_path / 'rtk_test_data_2/cameras'))
+    rtk_data, _, _ = load_rtk_track(str(base_path / 'rtk_test_data_2/rtk'))
+    return poses, rtk_data
+
+
+def _angle(R, other_R):
+    return np.degrees(
+        np.arccos(np.clip((np.trace(R.T @ other_R) - 1) / 2, -1, 1)))
+
+
+def test_rtk_tree():
+    _, rtk_data = _load_test_data()
+    tree = rtk_tree(rtk_data)
+    assert rtk_tree(dict(rtk_data)) is tree, "Tree not reused."
+    distances, indices = tree.tree.query(tree.positions[:5])
+    np.testing.assert_array_equal(indices, np.arange(5))
+
+
+def test_icp_align():
+    poses, rtk_data = _load_test_data()
+    R, t, error = coarse_to_fine_align(poses, rtk_data, mode='yaw')
+    # Timestamps that are off by far more than any time shift interval
+    shifted_poses = dict(poses, timeStamp=poses['timeStamp'] + 1000.0)
+    icp_R, icp_t, icp_error, diagnostics = icp_align(shifted_poses,
+                                                     rtk_data,
+                                                     return_diagnostics=True)
+    assert _angle(R, icp_R) < 3, "Rotation too far."
+    assert np.linalg.norm(icp_t - t) < 1, "Translation too far."
+    assert icp_error < error, "Nearest neighbour error not smaller."
+    # The trimmed matches, 80% of the poses
+    assert diagnostics.count == pytest.approx(0.8 * len(poses['timeStamp']),
+                                              abs=2)
+    assert diagnostics.iterations >= 1
+    # Started at the time-based transform it stays there
+    seeded_R, seeded_t, _ = icp_align(poses, rtk_data, init=(R, t))
+    assert _angle(icp_R, seeded_R) < 3, "Seeded rotation too far."
+    time_R, _, _ = icp_align(poses, rtk_data, mode='3d', init='time')
+    assert _angle(R, time_R) < 3, "Time seeded rotation too far."
+    with pytest.raises(ValueError):
+        icp_align(poses, rtk_data, init='gps')
+
+
+def test_icp_align_stops():
+    poses, rtk_data = _load_test_data()
+    R, t, _ = coarse_to_fine_align(poses, rtk_data, mode='yaw')
+    solved = []
+
+    def diverging_solve(sources, targets):
+        R, t, error = aligner_yaw_3D(sources, targets)
+        solved.append((R, t))
+        # Every solve after the first moves one meter further away
+        return R, t + [len(solved) - 1, 0, 0], error
+
+    with patch('modelAlign.icp.aligner_yaw_3D', diverging_solve):
+        icp_R, icp_t, _, diagnostics = icp_align(poses,
+                                                 rtk_data,
+                                                 init=(R, t),
+                                                 tolerance=0.0,
+                                                 return_diagnostics=True)
+    # The transform that made the matches worse is undone
+    assert len(solved) >= 2 and not diagnostics.converged
+    np.testing.assert_array_equal(icp_t, solved[0][1])
+    # One kept match cannot be solved, the seed is returned
+    seed_R, seed_t, error, diagnostics = icp_align(poses,
+                                                   rtk_data,
+                                                   init=(R, t),
+                                                   trim=0.0,
+                                                   return_diagnostics=True)
+    np.testing.assert_array_equal(seed_R, R)
+    np.testing.assert_array_equal(seed_t, t)
+    assert not diagnostics.converged and error is not None
+
+
+def test_alignment_icp():
+    base_path = Path(__file__).parent
+    result = alignment(str(base_path / 'rtk_test_data_2/rtk'),
+                       str(base_path / 'rtk_test_data_2/cameras'),
+                       mode='yaw',
+                       matching='icp')
+    assert result['type'] == 'LocaltoWGS84'
+    with pytest.raises(ValueError):
+        alignment(str(base_path / 'rtk_test_data_2/rtk'),
+                  str(base_path / 'rtk_test_data_2/cameras'),
+                  matching='gps')
@@ -0,0 +1,107 @@
+import copy
+import shutil
+import numpy as np
+from pathlib import Path
+from modelAlign.data_preprocessing import load_poses, load_rtk_data
+from modelAlign.ingest import CaptureIngestor, TrackBuffer
+
+
+def _copy_files(source_folder, target_folder, filenames):
+    target_folder.mkdir(exist_ok=True)
+    for filename in filenames:
+        shutil.copy(source_folder / filename, target_folder / filename)
+
+
+def test_track_buffer():
+    buffer = TrackBuffer({'timeStamp': np.float64, 'x': np.float64},
+                         initial_capacity=2)
+    buffer.extend({'timeStamp': [3.0, 1.0], 'x': [30.0, 10.0]}, source=0)
+    buffer.extend({'timeStamp': [4.0, 5.0], 'x': [40.0, 50.0]}, source=1)
+    # Out of order rows are merged into the tail
+    buffer.extend({'timeStamp': [2.0], 'x': [20.0]}, source=2)
+    track = buffer.to_track()
+    assert track['timeStamp'].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert track['x'].tolist() == [10.0, 20.0, 30.0, 40.0, 50.0]
+    buffer.remove_source(0)
+    assert buffer.to_track()['timeStamp'].tolist() == [2.0, 4.0, 5.0]
+    # The returned track is not affected by later changes
+    assert track['timeStamp'].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert len(buffer) == 3, "Length not match."
+    # Rows of several files merged at once keep their own source
+    buffer.extend({'timeStamp': [7.0, 6.0, 1.5], 'x': [70.0, 60.0, 15.0]},
+                  source=np.array([3, 4, 3]))
+    buffer.remove_source([3, 1])
+    assert buffer.to_track()['timeStamp'].tolist() == [2.0, 6.0]
+
+
+def test_capture_ingestor(tmp_path):
+    base_path = Path(__file__).parent / 'rtk_test_data_2'
+    pose_names = sorted(p.name for p in (base_path / 'cameras').iterdir())
+    rtk_names = sorted(p.name for p in (base_path / 'rtk').iterdir())
+    pose_folder, rtk_folder = tmp_path / 'cameras', tmp_path / 'rtk'
+    # Start with the first half of the capture
+    _copy_files(base_path / 'cameras', pose_folder,
+                pose_names[:len(pose_names) // 2])
+    _copy_files(base_path / 'rtk', rtk_folder, rtk_names[:len(rtk_names) // 2])
+    ingestor = CaptureIngestor(str(pose_folder), str(rtk_folder))
+    counts = ingestor.refresh()
+    assert counts['poses'] == len(pose_names) // 2, "Pose count not match."
+    assert ingestor.refresh() == {'poses': 0, 'rtk': 0}, "Files parsed twice."
+    # Append the rest, including an incomplete file that is retried later
+    _copy_files(base_path / 'cameras', pose_folder,
+                pose_names[len(pose_names) // 2:])
+    _copy_files(base_path / 'rtk', rtk_folder, rtk_names[len(rtk_names) // 2:])
+    (rtk_folder / 'partial.json').write_text('{"rtkData" : [{"timeS')
+    counts = ingestor.refresh()
+    assert counts['poses'] == len(pose_names) - len(pose_names) // 2
+    (rtk_folder / 'partial.json').unlink()
+    # Same tracks as loading the whole folders
+    poses = load_poses(str(base_path / 'cameras'))
+    rtk_data, origin = load_rtk_data(str(base_path / 'rtk'))
+    assert ingestor.origin == origin, "Origin not match."
+    for key in ['timeStamp', 'x', 'y', 'z']:
+        np.testing.assert_array_equal(ingestor.poses[key],
+                                      [pose[key] for pose in poses])
+        np.testing.assert_array_equal(ingestor.rtk_data[key],
+                                      [datum[key] for datum in rtk_data])
+    R, t, error = ingestor.align(mode='yaw')
+    assert R.shape == (3, 3), "Size not match."
+    assert 0 <= error < 0.5, "Error not correct."
+
+
+def test_capture_ingestor_check_modified(tmp_path):
+    base_path = Path(__file__).parent / 'rtk_test_data_2'
+    pose_names = sorted(p.name for p in (base_path / 'cameras').iterdir())[:5]
+    rtk_names = sorted(p.name for p in (base_path / 'rtk').iterdir())[:5]
+    pose_folder, rtk_folder = tmp_path / 'cameras', tmp_path / 'rtk'
+    _copy_files(base_path / 'cameras', pose_folder, pose_names)
+    _copy_files(base_path / 'rtk', rtk_folder, rtk_names)
+    ingestor = CaptureIngestor(str(pose_folder),
+                               str(rtk_folder),
+                               check_modified=True)
+    ingestor.refresh()
+    diagnostics = copy.deepcopy(ingestor.diagnostics)
+    # Rewriting a file replaces its samples instead of duplicating them
+    modified = pose_folder / pose_names[0]
+    modified.write_text(modified.read_text() + '\n')
+    assert ingestor.refresh()['poses'] == 1, "Modified file not re-parsed."
+    assert len(ingestor.poses['timeStamp']) == 5, "Samples duplicated."
+    modified = rtk_folder / rtk_names[0]
+    modified.write_text(modified.read_text() + '\n')
+    assert ingestor.refresh()['rtk'] == 1, "Modified file not re-parsed."
+    assert ingestor.diagnostics == diagnostics, "Diagnostics counted twice."
+
+
+def test_capture_ingestor_compact():
+    base_path = Path(__file__).parent / 'rtk_test_data_2'
+    ingestor = CaptureIngestor(str(base_path / 'cameras'),
+                               str(base_path / 'rtk'),
+                               compact=True)
+    ingestor.refresh()
+    assert ingestor.poses['x'].dtype == np.float32
+    assert ingestor.rtk_data['z'].dtype == np.float32
+    assert ingestor.rtk_data['timeStamp'].dtype == np.float64
+    rtk_data, _ = load_rtk_data(str(base_path / 'rtk'))
+    np.testing.assert_allclose(ingestor.rtk_data['x'],
+                               [datum['x'] for datum in rtk_data],
+                               atol=1e-5)
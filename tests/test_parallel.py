@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from modelAlign.parallel import SharedTracks, attach_tracks, map_shared
+from modelAlign.data_preprocessing import load_poses, load_rtk_data
+from modelAlign.align import coarse_aligner_3D
+
+
+def _column_sums(tracks, key):
+    return {name: float(track[key].sum()) for name, track in tracks.items()}
+
+
+def _fail(tracks):
+    raise RuntimeError('worker failure')
+
+
+def test_shared_tracks():
+    track = {
+        'timeStamp': np.arange(10, dtype=float),
+        'x': np.linspace(0, 1, 10),
+        'diffStatus': np.arange(10, dtype=np.uint8),
+        'xyz': np.ones((10, 3))
+    }
+    with SharedTracks({'rtk': track}) as handle:
+        with attach_tracks(handle) as tracks:
+            for key, column in track.items():
+                assert tracks['rtk'][key].dtype == column.dtype, "Dtype not match."
+                np.testing.assert_array_equal(tracks['rtk'][key], column)
+            assert not tracks['rtk']['x'].flags.writeable, "View is writeable."
+        name = handle['rtk']['name']
+        assert map_shared(_column_sums, {'rtk': track}, [('x', )],
+                          2) == [{'rtk': 5.0}], "Worker result not match."
+    # The block is unlinked when the context exits
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=name)
+
+
+def test_shared_tracks_cleanup_on_failure():
+    track = {'timeStamp': np.arange(10, dtype=float)}
+    sharing = SharedTracks({'poses': track})
+    with pytest.raises(RuntimeError):
+        with sharing as handle:
+            map_shared(_fail, {'poses': track}, [()], 2)
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=handle['poses']['name'])
+
+
+def test_map_shared_executor():
+    track = {'x': np.arange(4, dtype=float)}
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        # The pool is reused across calls and left running
+        for scale in (1, 2):
+            scaled = {'rtk': {'x': track['x'] * scale}}
+            assert map_shared(_column_sums,
+                              scaled, [('x', )] * 3,
+                              executor=executor) == [{'rtk': 6.0 * scale}] * 3
+        assert executor.submit(abs, -1).result() == 1, "Pool shut down."
+        with pytest.raises(RuntimeError):
+            map_shared(_fail, {'poses': track}, [()], executor=executor)
+
+
+def test_coarse_aligner_workers():
+    base_path = Path(__file__).parent
+    poses = load_poses(str(base_path / 'rtk_test_data_2/cameras'))
+    rtk_data, _ = load_rtk_data(str(base_path / 'rtk_test_data_2/rtk'))
+    R, t, error, time_shift, diagnostics = coarse_aligner_3D(
+        poses, rtk_data, mode='yaw', return_diagnostics=True)
+    shared = coarse_aligner_3D(poses,
+                               rtk_data,
+                               mode='yaw',
+                               return_diagnostics=True,
+                               workers=3)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        pooled = coarse_aligner_3D(poses,
+                                   rtk_data,
+                                   mode='yaw',
+                                   workers=3,
+                                   executor=executor)
+    assert pooled[3] == pytest.approx(time_shift), "Time shift not match."
+    np.testing.assert_allclose(shared[0], R)
+    np.testing.assert_allclose(shared[1], t)
+    assert shared[2] == pytest.approx(error), "Error not match."
+    assert shared[3] == pytest.approx(time_shift), "Time shift not match."
+    np.testing.assert_allclose(shared[4].cost_curve.errors,
+                               diagnostics.cost_curve.errors)
+    assert shared[4].cost_curve.best_index == diagnostics.cost_curve.best_index
@@ -0,0 +1,88 @@
+import json
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from modelAlign.results_store import ResultsStore, alignment_record
+from modelAlign.results_store import diagnostics_summary
+from modelAlign.app import alignment, to_geoJson
+from modelAlign.align import track_fingerprint
+from modelAlign.data_preprocessing import load_pose_track, load_rtk_track
+
+
+def _insert_batch(store, worker):
+    records = [
+        alignment_record('capture-{}'.format(k % 5), {
+            'quaternion': [0.0, 0.0, 0.0, 1.0],
+            'translation': [worker, k, 0.0],
+            'origin': [31.2, 121.5]
+        },
+                         error=0.1 * k,
+                         created_at=1000.0 + worker * 100 + k)
+        for k in range(20)
+    ]
+    return store.insert_many(records)
+
+
+def test_results_store(tmp_path):
+    base_path = Path(__file__).parent / 'rtk_test_data_2'
+    geo_json, diagnostics = alignment(str(base_path / 'rtk'),
+                                      str(base_path / 'cameras'),
+                                      return_diagnostics=True)
+    poses = load_pose_track(str(base_path / 'cameras'))
+    rtk_track, _, _ = load_rtk_track(str(base_path / 'rtk'))
+    fingerprint = track_fingerprint(poses, rtk_track)
+    with ResultsStore(tmp_path / 'results.db') as store:
+        store.insert('session-a',
+                     geo_json,
+                     mode='3d',
+                     diagnostics=diagnostics,
+                     fingerprint=fingerprint,
+                     created_at=10.0)
+        store.insert('session-a', geo_json, error=0.5, created_at=20.0)
+        store.insert('session-b', geo_json, error=0.2, created_at=15.0)
+        record = store.query(capture='session-a')[0]
+        assert record['error'] == pytest.approx(diagnostics.mean_error)
+        assert record['time_shift'] == pytest.approx(diagnostics.time_shift)
+        assert record['fingerprint'] == fingerprint.hex()
+        assert record['diagnostics']['count'] == diagnostics.count
+        assert store.query(fingerprint=fingerprint)[0]['id'] == record['id']
+        assert store.latest('session-a')['created_at'] == 20.0
+        assert store.latest('unknown') is None
+        high = store.query(min_error=0.3)
+        assert [r['created_at'] for r in high] == [10.0, 20.0]
+        assert [r['capture'] for r in store.query(max_error=0.3)
+                ] == ['session-b']
+        assert len(store.query(since=12.0, until=20.0)) == 1
+        assert len(store.query(limit=2)) == 2
+        exported = store.export_geojson()
+        assert set(exported) == {'session-a', 'session-b'}
+        assert exported['session-b'] == geo_json, "Export not match."
+        assert json.loads(json.dumps(exported)) == exported
+
+
+def test_results_store_parallel_insert(tmp_path):
+    store = ResultsStore(tmp_path / 'results.db')
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        counts = list(executor.map(_insert_batch, [store] * 4, range(4)))
+    assert counts == [20] * 4
+    assert len(store.query()) == 80
+    latest = store.query(latest=True)
+    assert len(latest) == 5, "Not one record per capture."
+    # The last record of capture-4 is k=19 of worker 3
+    assert store.latest('capture-4')['created_at'] == 1319.0
+    assert len(store.query(min_error=1.5)) == 16
+    store.close()
+
+
+def test_diagnostics_summary():
+    summary = diagnostics_summary({
+        'count': 3,
+        'residuals': [[0, 0, 0]],
+        'percentiles': {
+            50: 0.1
+        },
+        'by_status': {}
+    })
+    assert summary == {'count': 3, 'percentiles': {'50': 0.1}}
+    geo_json = to_geoJson([[1, 0, 0], [0, 1, 0], [0, 0, 1]], [1, 2, 3], [4, 5])
+    assert alignment_record('a', geo_json)['error'] is None
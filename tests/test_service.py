@@ -0,0 +1,243 @@
+import asyncio
+import json
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from modelAlign.service import AlignmentService
+
+
+async def _request(port, method, target, body=b'', content_type=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    head = '{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n'.format(
+        method, target, len(body))
+    if content_type:
+        head += 'Content-Type: {}\r\n'.format(content_type)
+    writer.write(head.encode() + b'\r\n' + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status_line, _, payload = response.partition(b'\r\n\r\n')
+    return int(status_line.split()[1]), json.loads(payload)
+
+
+async def _wait_job(port, job_id):
+    while True:
+        status, job = await _request(port, 'GET', '/jobs/' + job_id)
+        assert status == 200, "Job not found."
+        if job['status'] not in ('queued', 'running'):
+            return job
+        await asyncio.sleep(0.05)
+
+
+def test_service_folder_job():
+    base_path = Path(__file__).parent
+    spec = {
+        'rtk_folder': str(base_path / 'rtk_test_data_2/rtk'),
+        'pose_folder': str(base_path / 'rtk_test_data_2/cameras'),
+        'mode': 'yaw'
+    }
+
+    async def scenario():
+        service = AlignmentService(workers=1, max_queue=4)
+        server = await service.serve('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            status, job = await _request(port, 'POST', '/jobs',
+                                         json.dumps(spec).encode())
+            assert status == 202, "Job not accepted."
+            job = await _wait_job(port, job['id'])
+            assert job['status'] == 'done', job['error']
+            assert job['result']['type'] == 'LocaltoWGS84', "Wrong result."
+            status, metrics = await _request(port, 'GET', '/metrics')
+            assert metrics['completed'] == 1, "Job not counted."
+            assert metrics['latency']['max'] >= metrics['run_time']['max']
+            status, _ = await _request(port, 'GET', '/jobs/unknown')
+            assert status == 404, "Unknown job found."
+            status, _ = await _request(port, 'POST', '/jobs', b'{}')
+            assert status == 400, "Invalid job accepted."
+        finally:
+            server.close()
+            await server.wait_closed()
+            await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_service_deduplication_and_backpressure():
+    release = threading.Event()
+
+    def runner(spec):
+        release.wait(10)
+        return {'pose_folder': spec['pose_folder']}
+
+    async def scenario():
+        service = AlignmentService(workers=1,
+                                   max_queue=1,
+                                   executor=ThreadPoolExecutor(1),
+                                   runner=runner)
+        await service.start()
+        try:
+            first = service.submit({'rtk_folder': 'rtk', 'pose_folder': 'a'})
+            # The same capture is collapsed into the in-flight job
+            assert service.submit({
+                'rtk_folder': 'rtk',
+                'pose_folder': 'a'
+            }) is first
+            await asyncio.sleep(0.05)
+            # First job running, one more fits into the queue
+            second = service.submit({'rtk_folder': 'rtk', 'pose_folder': 'b'})
+            status, _ = await service.handle(
+                'POST', '/jobs',
+                json.dumps({
+                    'rtk_folder': 'rtk',
+                    'pose_folder': 'c'
+                }).encode())
+            assert status == 503, "Queue full not reported."
+            release.set()
+            assert (await service.wait(second['id']))['status'] == 'done'
+            metrics = service.metrics()
+            assert metrics['deduplicated'] == 1, "Deduplication not counted."
+            assert metrics['rejected'] == 1, "Rejection not counted."
+            assert metrics['completed'] == 2, "Completion not counted."
+        finally:
+            release.set()
+            await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_service_archive_job(tmp_path):
+    base_path = Path(__file__).parent / 'rtk_test_data_2'
+    archive_path = tmp_path / 'capture.zip'
+    with zipfile.ZipFile(archive_path, 'w') as archive:
+        for path in base_path.rglob('*.json'):
+            archive.write(path, 'capture/' + str(path.relative_to(base_path)))
+
+    async def scenario():
+        service = AlignmentService(workers=1,
+                                   executor=ThreadPoolExecutor(1))
+        server = await service.serve('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            status, job = await _request(port, 'POST',
+                                         '/jobs/archive?mode=yaw',
+                                         archive_path.read_bytes())
+            assert status == 202, "Archive not accepted."
+            job = await _wait_job(port, job['id'])
+            assert job['status'] == 'done', job['error']
+            assert len(job['result']['origin']) == 2, "Wrong result."
+        finally:
+            server.close()
+            await server.wait_closed()
+            await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_service_archive_upload_does_not_block(monkeypatch):
+    hashing = threading.Event()
+    release = threading.Event()
+
+    def slow_hash(body):
+        hashing.set()
+        release.wait(10)
+        return 'digest'
+
+    async def scenario():
+        service = AlignmentService(workers=1, executor=ThreadPoolExecutor(1))
+        monkeypatch.setattr(service, '_hash_archive', slow_hash)
+        server = await service.serve('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            upload = asyncio.ensure_future(
+                _request(port, 'POST', '/jobs/archive', b'not an archive'))
+            while not hashing.is_set():
+                await asyncio.sleep(0.01)
+            # The event loop keeps serving while the upload is hashed
+            status, _ = await asyncio.wait_for(
+                _request(port, 'GET', '/metrics'), 5)
+            assert status == 200, "Metrics not served."
+            release.set()
+            status, job = await upload
+            assert status == 202, "Archive not accepted."
+            assert (await _wait_job(port, job['id']))['status'] == 'failed'
+        finally:
+            release.set()
+            server.close()
+            await server.wait_closed()
+            await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_service_concurrent_archive_uploads(monkeypatch, tmp_path):
+    uploads = 4
+    saving = threading.Barrier(uploads)
+    saved = []
+
+    def save_archive(body):
+        # Every upload passes the in-flight check before any is submitted
+        index = saving.wait(10)
+        path = tmp_path / 'upload-{}.archive'.format(index)
+        path.write_bytes(body)
+        saved.append(path)
+        return str(path)
+
+    async def scenario():
+        service = AlignmentService(workers=1, executor=ThreadPoolExecutor(1))
+        monkeypatch.setattr(service, '_save_archive', save_archive)
+        server = await service.serve('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            responses = await asyncio.gather(*[
+                _request(port, 'POST', '/jobs/archive', b'not an archive')
+                for _ in range(uploads)
+            ])
+            assert {status for status, _ in responses} == {202}
+            assert len({job['id'] for _, job in responses}) == 1, \
+                "Uploads not deduplicated."
+            await _wait_job(port, responses[0][1]['id'])
+        finally:
+            server.close()
+            await server.wait_closed()
+            await service.stop()
+
+    asyncio.run(scenario())
+    assert len(saved) == uploads, "Uploads not saved."
+    assert not any(path.exists() for path in saved), "Archive left behind."
+
+
+def test_service_job_retention():
+
+    async def scenario():
+        service = AlignmentService(workers=1,
+                                   executor=ThreadPoolExecutor(1),
+                                   runner=lambda spec: {},
+                                   max_finished_jobs=2)
+        await service.start()
+        try:
+            status, _ = await service.handle(
+                'POST', '/jobs',
+                json.dumps({
+                    'rtk_folder': 'rtk',
+                    'pose_folder': 'a',
+                    'mode': '4d'
+                }).encode())
+            assert status == 400, "Unknown mode accepted."
+            jobs = []
+            for name in 'abc':
+                job = service.submit({'rtk_folder': 'rtk', 'pose_folder': name})
+                jobs.append(await service.wait(job['id']))
+            # Only the two most recent finished jobs are kept
+            assert list(service.jobs) == [job['id'] for job in jobs[1:]]
+            assert service.metrics()['completed'] == 3
+            service.finished_job_ttl = 0.0
+            await asyncio.sleep(0.01)
+            service._evict_jobs()
+            assert service.jobs == {}, "Expired jobs kept."
+        finally:
+            await service.stop()
+
+    asyncio.run(scenario())
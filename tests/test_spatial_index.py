@@ -0,0 +1,123 @@
+import pickle
+import numpy as np
+import pytest
+from pathlib import Path
+from geoToolbox import cartesian_to_wgs84
+from modelAlign.spatial_index import SessionIndex, session_footprint
+from modelAlign.app import alignment
+from modelAlign.data_preprocessing import load_pose_track
+
+
+def _geo_json(origin, translation):
+    return {
+        'type': 'LocaltoWGS84',
+        'CoordinateSystem': 'WGS84',
+        'quaternion': [0.0, 0.0, 0.0, 1.0],
+        'translation': translation,
+        'origin': origin
+    }
+
+
+def _square(size):
+    # Y-up poses spanning [0, size] east and north of the origin
+    return {
+        'timeStamp': np.arange(4.0),
+        'x': np.array([0.0, size, size, 0.0]),
+        'y': np.zeros(4),
+        'z': np.array([0.0, 0.0, -size, -size])
+    }
+
+
+def test_session_footprint():
+    origin = [31.2, 121.5]
+    footprint = session_footprint(_square(100.0), _geo_json(origin, [0, 0, 0]))
+    (north, ), (east, ) = cartesian_to_wgs84(origin,
+                                             [np.array([100.0]),
+                                              np.array([100.0])])
+    assert footprint['south'] == pytest.approx(origin[0])
+    assert footprint['west'] == pytest.approx(origin[1])
+    assert footprint['north'] == pytest.approx(north)
+    assert footprint['east'] == pytest.approx(east)
+    with pytest.raises(ValueError):
+        session_footprint([], _geo_json(origin, [0, 0, 0]))
+
+
+def test_session_index(tmp_path):
+    origin = [31.2, 121.5]
+    index = SessionIndex(tmp_path / 'sessions.db')
+    # A 100 m square every kilometer east of the origin
+    for k in range(5):
+        index.insert('session-{}'.format(k), _square(100.0),
+                     _geo_json(origin, [1000.0 * k, 0.0, 0.0]))
+    assert len(index) == 5
+    footprint = session_footprint(_square(100.0),
+                                  _geo_json(origin, [2000.0, 0.0, 0.0]))
+    assert index.bbox(footprint['south'], footprint['west'],
+                      footprint['north'], footprint['east']) == ['session-2']
+    assert index.bbox(origin[0] - 1, origin[1] - 1, origin[0] + 1,
+                      origin[1] + 1) == ['session-{}'.format(k) for k in range(5)]
+    assert index.bbox(0, 0, 1, 1) == []
+    # 50 m north of session-1, 1080 m east of the origin
+    (latitude, ), (longitude, ) = cartesian_to_wgs84(
+        origin, [np.array([1080.0]), np.array([150.0])])
+    matches = index.radius(latitude, longitude, 1000.0)
+    assert [capture for capture, _ in matches
+            ] == ['session-1', 'session-2', 'session-0']
+    assert matches[0][1] == pytest.approx(50.0, abs=0.5)
+    assert matches[1][1] == pytest.approx(np.hypot(920.0, 50.0), abs=0.5)
+    assert [capture for capture, _ in index.radius(latitude, longitude, 950.0)
+            ] == ['session-1', 'session-2']
+    assert [capture for capture, _ in index.radius(latitude, longitude, 40.0)
+            ] == []
+    # Inserting a capture again moves it
+    index.insert('session-1', _square(100.0),
+                 _geo_json(origin, [5000.0, 0.0, 0.0]))
+    assert len(index) == 5
+    assert index.geo_json('session-1')['translation'] == [5000.0, 0.0, 0.0]
+    assert [capture for capture, _ in index.radius(latitude, longitude, 500.0)
+            ] == []
+    assert index.remove('session-4')
+    assert not index.remove('session-4')
+    index.close()
+    # The index persists and only pickles its path
+    reopened = pickle.loads(pickle.dumps(SessionIndex(index.path)))
+    assert len(reopened) == 4
+    assert reopened.geo_json('session-4') is None
+
+
+def test_session_index_radius_high_latitude(tmp_path):
+    center = [85.0, 10.0]
+    radius = 100000.0
+    # Inside the circle on its poleward west side, where the meridians are
+    # closer than at the center
+    north = radius * np.tan(np.radians(center[0])) * radius / 6371000.0
+    east = -np.sqrt(radius**2 - north**2) * 0.99
+    (latitude, ), (longitude, ) = cartesian_to_wgs84(
+        center, [np.array([east]), np.array([north])])
+    point = {
+        'south': latitude,
+        'north': latitude,
+        'west': longitude,
+        'east': longitude
+    }
+    with SessionIndex(tmp_path / 'sessions.db') as index:
+        index.insert_many([('poleward', _geo_json(center, [0, 0, 0]), point)])
+        found = index.radius(center[0], center[1], radius)
+        assert [capture for capture, _ in found] == ['poleward']
+        assert found[0][1] == pytest.approx(np.hypot(east, north), rel=1e-3)
+        # A circle around the pole covers every longitude
+        assert [
+            capture for capture, _ in index.radius(89.9, -170.0, 700000.0)
+        ] == ['poleward']
+
+
+def test_session_index_alignment(tmp_path):
+    base_path = Path(__file__).parent / 'rtk_test_data_2'
+    geo_json = alignment(str(base_path / 'rtk'), str(base_path / 'cameras'))
+    poses = load_pose_track(str(base_path / 'cameras'))
+    with SessionIndex(tmp_path / 'sessions.db') as index:
+        index.insert('capture', poses, geo_json)
+        latitude, longitude = geo_json['origin']
+        # The RTK origin is the first fix, close to the aligned trajectory
+        assert index.radius(latitude, longitude, 50.0)[0][0] == 'capture'
+        assert index.geo_json('capture') == geo_json
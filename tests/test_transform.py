@@ -0,0 +1,75 @@
+import pickle
+import numpy as np
+import pytest
+from pathlib import Path
+from scipy.spatial.transform import Rotation
+from geoToolbox import wgs84_to_cartesian
+from modelAlign.transform import AlignmentTransform
+from modelAlign.align import coarse_to_fine_align, Y_UP_TO_Z_UP
+from modelAlign.app import to_geoJson
+from modelAlign.data_preprocessing import load_pose_track, load_rtk_track
+
+
+@pytest.fixture
+def transform():
+    R = Rotation.from_euler('zyx', [30, 5, -3], degrees=True).as_matrix()
+    return AlignmentTransform(R, [10.0, -20.0, 3.0], [31.2, 121.5])
+
+
+def test_alignment_transform_geo_json(transform):
+    geo_json = to_geoJson(transform.R, transform.t, transform.origin)
+    assert transform.to_geo_json() == pytest.approx(geo_json)
+    restored = AlignmentTransform.from_geo_json(geo_json)
+    np.testing.assert_allclose(restored.R, transform.R, atol=1e-12)
+    np.testing.assert_array_equal(restored.t, transform.t)
+    with pytest.raises(ValueError):
+        transform.R[0, 0] = 0.0
+
+
+def test_alignment_transform_serialization(transform):
+    data = transform.to_bytes()
+    assert len(data) == 112
+    assert AlignmentTransform.from_bytes(data) == transform
+    assert pickle.loads(pickle.dumps(transform)) == transform
+    assert len(pickle.dumps(transform)) < 256
+    with pytest.raises(ValueError):
+        AlignmentTransform.from_bytes(data[:-8])
+
+
+def test_alignment_transform_mapping(transform):
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-500, 500, size=(1000, 3))
+    enu = transform.local_to_enu(points)
+    np.testing.assert_allclose(
+        enu, (transform.R @ Y_UP_TO_Z_UP @ points.T).T + transform.t)
+    np.testing.assert_allclose(transform.enu_to_local(enu), points, atol=1e-9)
+    wgs84 = transform.local_to_wgs84(points)
+    east, north = wgs84_to_cartesian([31.2, 121.5], [wgs84[:, 0], wgs84[:, 1]])
+    np.testing.assert_allclose(east, enu[:, 0], atol=1e-4)
+    np.testing.assert_allclose(north, enu[:, 1], atol=1e-4)
+    np.testing.assert_array_equal(wgs84[:, 2], enu[:, 2])
+    np.testing.assert_allclose(transform.wgs84_to_local(wgs84),
+                               points,
+                               atol=1e-4)
+    # The local point at the origin
+    origin_point = transform.enu_to_local([0.0, 0.0, 0.0])
+    assert origin_point.shape == (3, )
+    np.testing.assert_allclose(transform.local_to_wgs84(origin_point),
+                               [31.2, 121.5, 0.0],
+                               atol=1e-9)
+    assert transform.local_to_wgs84(np.zeros((0, 3))).shape == (0, 3)
+
+
+def test_alignment_transform_from_result():
+    base_path = Path(__file__).parent / 'rtk_test_data_2'
+    poses = load_pose_track(str(base_path / 'cameras'))
+    rtk_track, origin, _ = load_rtk_track(str(base_path / 'rtk'))
+    result = coarse_to_fine_align(poses, rtk_track)
+    transform = AlignmentTransform.from_result(result, origin)
+    points = np.column_stack([poses['x'], poses['y'], poses['z']])
+    enu = transform.local_to_enu(points)
+    # The aligned trajectory runs along the RTK track
+    rtk_points = np.column_stack([rtk_track['x'], rtk_track['y'],
+                                  rtk_track['z']])
+    distances = np.linalg.norm(enu[:, None] - rtk_points[None], axis=2)
+    assert np.median(distances.min(axis=1)) < 1.0
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from pathlib import Path
+from modelAlign.data_preprocessing import load_poses, load_rtk_data
+from modelAlign.align import associate_shifts, aligner_SVD_3D, aligner_yaw_3D
+from modelAlign.uncertainty import replica_weights, solve_replicas
+from modelAlign.uncertainty import bootstrap_alignment
+
+
+def _load_test_data():
+    base_path = Path(__file__).parent
+    poses = load_poses(str(base_path / 'rtk_test_data_2/cameras'))
+    rtk_data, _ = load_rtk_data(str(base_path / 'rtk_test_data_2/rtk'))
+    return poses, rtk_data
+
+
+def test_replica_weights():
+    rng = np.random.default_rng(0)
+    weights = replica_weights(50, 20, 'bootstrap', rng)
+    assert weights.shape == (20, 50), "Size not match."
+    assert np.all(weights.sum(axis=1) == 50), "Not 50 draws per replica."
+    weights = replica_weights(10, 5, 'jackknife')
+    assert weights.shape == (5, 10), "Size not match."
+    assert np.all(weights.sum(axis=0) == 4), "Not left out exactly once."
+    with pytest.raises(ValueError):
+        replica_weights(10, 5, 'unknown')
+
+
+def test_solve_replicas():
+    poses, rtk_data = _load_test_data()
+    shifted_poses, rtk_datas, mask, _ = associate_shifts(
+        poses, rtk_data, [0.0])
+    weights = np.ones((2, len(rtk_datas)))
+    weights[1, ::2] = 0
+    R, t, error = solve_replicas(shifted_poses[0], rtk_datas, mask[0],
+                                 weights)
+    # Unit weights give the single SVD alignment
+    expected_R, expected_t, _, diagnostics = aligner_SVD_3D(
+        shifted_poses[0][mask[0]], rtk_datas[mask[0]], return_diagnostics=True)
+    np.testing.assert_allclose(R[0], expected_R, atol=1e-9)
+    np.testing.assert_allclose(t[0], expected_t, atol=1e-9)
+    assert np.isclose(error[0], diagnostics.rmse), "RMSE not match."
+    # Zero weights drop the pairs
+    keep = mask[0].copy()
+    keep[::2] = False
+    expected_R, expected_t, _ = aligner_SVD_3D(shifted_poses[0][keep],
+                                               rtk_datas[keep])
+    np.testing.assert_allclose(R[1], expected_R, atol=1e-9)
+    np.testing.assert_allclose(t[1], expected_t, atol=1e-9)
+    R, t, error = solve_replicas(shifted_poses[0], rtk_datas, mask[0],
+                                 weights[:1], 'yaw')
+    expected_R, expected_t, _ = aligner_yaw_3D(shifted_poses[0][mask[0]],
+                                               rtk_datas[mask[0]])
+    np.testing.assert_allclose(R[0], expected_R, atol=1e-9)
+    np.testing.assert_allclose(t[0], expected_t, atol=1e-9)
+
+
+def test_bootstrap_alignment():
+    poses, rtk_data = _load_test_data()
+    result = bootstrap_alignment(poses, rtk_data, n_replicas=100, seed=0)
+    assert result.samples.shape == (100, 5), "Size not match."
+    assert result.covariance.shape == (5, 5), "Size not match."
+    assert np.all(np.linalg.eigvalsh(result.covariance) >= -1e-12)
+    for name, estimate in zip(result.parameter_names, result.estimate):
+        low, high = result.confidence_intervals[name]
+        assert low <= high, "Interval not ordered."
+        assert result.std[name] >= 0, "Std not positive."
+    low, high = result.confidence_intervals['yaw']
+    assert high - low < 0.05, "Yaw interval too wide."
+    # Same replicas when the shifts are spread over worker processes
+    parallel = bootstrap_alignment(poses,
+                                   rtk_data,
+                                   n_replicas=100,
+                                   seed=0,
+                                   workers=2)
+    np.testing.assert_allclose(parallel.samples, result.samples)
+    jackknife = bootstrap_alignment(poses,
+                                    rtk_data,
+                                    n_replicas=30,
+                                    method='jackknife',
+                                    mode='yaw')
+    assert jackknife.samples.shape == (30, 5), "Size not match."
+    low, high = jackknife.confidence_intervals['tx']
+    assert low < jackknife.estimate[1] < high, "Estimate outside interval."